@@ -1,10 +1,13 @@
+import copy
+import io
 import os
+import posixpath
 from os.path import join, splitext, exists, isdir, isfile
 import subprocess
 import logging
-
-from fs.opener import opener
-# from fs.zipfs import ZipFS
+import threading
+import zipfile
+from concurrent.futures import ThreadPoolExecutor, Future
 
 
 logger = logging.getLogger()
@@ -49,7 +52,8 @@ def run_fastqc(fastq_paths,
         # exit codes on failure, so we parse the output
         cmd_out = subprocess.check_output(cmd,
                                           shell=True,
-                                          stderr=subprocess.STDOUT)
+                                          stderr=subprocess.STDOUT,
+                                          universal_newlines=True)
     except subprocess.CalledProcessError:
         logger.error('FastQC stdout: %s', cmd_out)
         return None
@@ -68,43 +72,337 @@ def run_fastqc(fastq_paths,
     return output_directory
 
 
+class FastqcScheduler(object):
+    """
+    Runs FastQC across many projects at the granularity of single FASTQ
+    files, using a fixed (global) budget of cores.
+
+    Each FASTQ file is a separate single threaded FastQC job, so a small
+    project doesn't hold cores idle while a larger one finishes - jobs from
+    the next project are started as soon as cores become free. Jobs are run
+    in the order projects were submitted.
+
+    A Future is returned for each project, which completes when the last
+    FastQC job for that project finishes. An optional on_complete callback
+    (eg to parse the FastQC output for the project) is run as soon as that
+    happens, in the worker thread that ran the last job.
+    """
+    def __init__(self, fastqc_bin=None, threads=2):
+        """
+        :param fastqc_bin: The path to the FastQC executable.
+        :type fastqc_bin: str
+        :param threads: The total number of cores to use (ie, the
+                        maximum number of FastQC jobs running at once).
+        :type threads: int
+        """
+        self.fastqc_bin = fastqc_bin
+        self._executor = ThreadPoolExecutor(max_workers=max(1, threads))
+        self._jobs = []
+
+    def submit_project(self, fastq_paths, output_directory, on_complete=None):
+        """
+        Queues FastQC jobs for each FASTQ file in a project.
+
+        The returned Future's result is on_complete(output_directory), or
+        just output_directory if there is no on_complete callback. If
+        run_fastqc fails (returns None) for any file in the project, the
+        result is None.
+
+        :param fastq_paths: The FASTQ files in the project.
+        :type fastq_paths: list[str]
+        :param output_directory: The directory for FastQC output, which
+                                 must exist.
+        :type output_directory: str
+        :param on_complete: Called with the output directory when every
+                            job for the project has finished successfully.
+        :type on_complete: types.FunctionType
+        :rtype: concurrent.futures.Future
+        """
+        project_future = Future()
+        if not fastq_paths:
+            project_future.set_result(None)
+            return project_future
+
+        state = {'remaining': len(fastq_paths), 'failed': False}
+        lock = threading.Lock()
+
+        def _job_done(job_future):
+            # jobs cancelled at shutdown still count towards their
+            # project, rather than relying on result() raising an Exception
+            if job_future.cancelled():
+                logger.warning('FastQC - job cancelled')
+                failed = True
+            else:
+                try:
+                    failed = job_future.result() is None
+                except Exception as e:
+                    logger.error('FastQC - job failed: %s', e)
+                    failed = True
+
+            with lock:
+                state['failed'] = state['failed'] or failed
+                state['remaining'] -= 1
+                if state['remaining'] > 0:
+                    return
+
+            if state['failed']:
+                project_future.set_result(None)
+                return
+            try:
+                result = output_directory
+                if on_complete is not None:
+                    result = on_complete(output_directory)
+                project_future.set_result(result)
+            except Exception as e:
+                project_future.set_exception(e)
+
+        for fastq_path in fastq_paths:
+            job = self._executor.submit(run_fastqc,
+                                        [fastq_path],
+                                        output_directory=output_directory,
+                                        fastqc_bin=self.fastqc_bin,
+                                        threads=1)
+            job.add_done_callback(_job_done)
+            self._jobs.append(job)
+
+        return project_future
+
+    def shutdown(self, wait=True, cancel_pending=False):
+        """
+        :param wait: Wait for running jobs to finish.
+        :type wait: bool
+        :param cancel_pending: Cancel jobs that haven't started yet
+                               (their projects' results will be None).
+        :type cancel_pending: bool
+        """
+        if cancel_pending:
+            for job in self._jobs:
+                job.cancel()
+        self._executor.shutdown(wait=wait)
+
+
 def file_from_zip(zip_file_path, filename, mode='r'):
-    # eg rootpath =
-    # FastQC.out/15-02380-CE11-T13-L1_AACCAG_L001_R1_001_fastqc.zip
-    # ie   fastq_filename + '_fastqc.zip'
+    """
+    Returns a (text) file-like object for the first member of a zip file
+    with a matching basename, or None if there is no such member.
 
-    # fs.opener.opener magic detects a filesystem type if we give it
-    # a URI-like string, eg zip://foo/bla/file.zip
-    # (eg https://commons.apache.org/proper/commons-vfs/filesystems.html)
-    # So we munge the path to a zip file to become a compatible URI
-    # (an http, ftp, webdav url could also be used)
-    if splitext(zip_file_path)[1] == '.zip':
-        zip_file_path = 'zip://' + zip_file_path
+    eg, for FastQC output:
+    FastQC.out/15-02380-CE11-T13-L1_AACCAG_L001_R1_001_fastqc.zip
+    ie   fastq_filename + '_fastqc.zip'
+    """
+    with zipfile.ZipFile(zip_file_path) as zf:
+        for name in zf.namelist():
+            if os.path.basename(name) == filename:
+                content = zf.read(name)
+                break
+        else:
+            return None
 
-    with opener.parse(zip_file_path)[0] as vfs:
-        for fn in vfs.walkfiles():
-            if os.path.basename(fn) == filename:
-                return vfs.open(fn, mode)
+    if 'b' in mode:
+        return io.BytesIO(content)
+    return io.StringIO(content.decode('utf-8'))
 
 
 def parse_file_from_zip(zip_file_path, filename, parser):
     return parser(file_from_zip(zip_file_path, filename))
 
 
+def _parse_summary_txt(fh):
+    summary = [tuple(line.strip().split('\t')) for line in fh]
+    return summary
+
+
+def _parse_data_txt(fh):
+    data = {'fastqc_version': fh.readline().split('\t')[1].strip()}
+    section = None
+    for l in fh:
+        line = l.strip()
+        if line[0:2] == '>>':
+            if line == '>>END_MODULE':
+                # end section
+                continue
+            else:
+                # start new section
+                section, qc_result = line[2:].split('\t')
+                data[section] = {'rows': [],
+                                 'qc_result': qc_result}
+                continue
+        if line[0] == '#':
+            column_labels = tuple(line[1:].split('\t'))
+            data[section]['column_labels'] = column_labels
+            continue
+        else:
+            data_row = tuple(line.split('\t'))
+            data[section]['rows'].append(data_row)
+
+    return data
+
+
+class FastqcResult(object):
+    """
+    The output of FastQC for a single FASTQ file (a *_fastqc.zip file).
+
+    The zip is opened once, on first use, with its members indexed by
+    basename and the (small) summary.txt and fastqc_data.txt members read
+    into memory. These are parsed lazily, and the parsed results kept, so
+    each is parsed at most once however many times it's used.
+
+    Use get_fastqc_result to share a single instance per zip file.
+    """
+    def __init__(self, zip_file_path):
+        """
+        :param zip_file_path: The path to the FastQC output zip file.
+        :type zip_file_path: str
+        """
+        self.zip_file_path = zip_file_path
+        self._members = None
+        self._raw = {}
+        self._parsed = {}
+        self._lock = threading.Lock()
+
+    def _load(self):
+        with zipfile.ZipFile(self.zip_file_path) as zf:
+            members = {}
+            for name in zf.namelist():
+                members.setdefault(os.path.basename(name), name)
+            for filename in ('summary.txt', 'fastqc_data.txt'):
+                if filename in members:
+                    self._raw[filename] = zf.read(members[filename])
+        self._members = members
+
+    @property
+    def members(self):
+        """
+        The names of members in the zip file, keyed by basename.
+
+        :rtype: dict
+        """
+        with self._lock:
+            if self._members is None:
+                self._load()
+            return self._members
+
+    def _parse(self, filename, parser):
+        with self._lock:
+            if filename not in self._parsed:
+                if self._members is None:
+                    self._load()
+                # the raw content is no longer needed once parsed
+                content = self._raw.pop(filename)
+                self._parsed[filename] = parser(
+                    io.StringIO(content.decode('utf-8')))
+            return self._parsed[filename]
+
+    @property
+    def summary(self):
+        """
+        The overall PASS/WARN/FAIL table from summary.txt (see
+        parse_summary_txt). This is shared by every user of this result,
+        so must not be modified.
+
+        :rtype: list[tuple]
+        """
+        return self._parse('summary.txt', _parse_summary_txt)
+
+    @property
+    def data(self):
+        """
+        The tables from fastqc_data.txt (see parse_data_txt). This is shared
+        by every user of this result, so must not be modified.
+
+        :rtype: dict
+        """
+        return self._parse('fastqc_data.txt', _parse_data_txt)
+
+    @property
+    def fastqc_version(self):
+        return self.data['fastqc_version']
+
+    def extract_report(self, output_directory, images=False):
+        """
+        Extracts fastqc_report.html into output_directory, keeping its path
+        within the zip. Only the report (and optionally the images it links
+        to) are extracted, not the rest of the zip.
+
+        :param output_directory: The directory to extract to.
+        :type output_directory: str
+        :param images: If True, the Images and Icons the report links to are
+                       also extracted (for FastQC versions that don't inline
+                       them in the report).
+        :type images: bool
+        :return: The path of the extracted report, or None if the zip
+                 doesn't contain one.
+        :rtype: str
+        """
+        members = self.members
+        report_name = members.get('fastqc_report.html', None)
+        if report_name is None:
+            return None
+
+        names = [report_name]
+        if images:
+            report_dir = posixpath.dirname(report_name)
+            prefixes = tuple(posixpath.join(report_dir, d, '')
+                             for d in ('Images', 'Icons'))
+            names.extend(name for name in members.values()
+                         if name.startswith(prefixes))
+
+        with zipfile.ZipFile(self.zip_file_path) as zf:
+            for name in names:
+                zf.extract(name, output_directory)
+
+        return join(output_directory, *report_name.split('/'))
+
+
+# FastqcResult instances, keyed by absolute zip file path
+_results = {}
+_results_lock = threading.Lock()
+
+
+def get_fastqc_result(zip_file_path):
+    """
+    Returns the shared FastqcResult for a FastQC output zip file, so the
+    zip is only opened and parsed once during an ingestion.
+
+    :param zip_file_path: The path to the FastQC output zip file.
+    :type zip_file_path: str
+    :rtype: FastqcResult
+    """
+    key = os.path.abspath(zip_file_path)
+    with _results_lock:
+        result = _results.get(key, None)
+        if result is None:
+            result = FastqcResult(zip_file_path)
+            _results[key] = result
+        return result
+
+
+def clear_fastqc_results(fastqc_out_dir=None):
+    """
+    Discards shared FastqcResults (eg once a project has been ingested)
+    for zip files in fastqc_out_dir, or all of them.
+
+    :param fastqc_out_dir: A FastQC output directory.
+    :type fastqc_out_dir: str
+    """
+    with _results_lock:
+        if fastqc_out_dir is None:
+            _results.clear()
+            return
+        prefix = os.path.join(os.path.abspath(fastqc_out_dir), '')
+        for key in [k for k in _results if k.startswith(prefix)]:
+            del _results[key]
+
+
 def parse_summary_txt(zip_file_path):
     """
     Extract the overall PASS/WARN/FAIL summary.txt table from FastQC results
     contained in a zip file.
-    """
-
-    def _parse(fh):
-        summary = [tuple(line.strip().split('\t')) for line in fh]
-        return summary
 
-    qc_summary = parse_file_from_zip(zip_file_path,
-                                     'summary.txt',
-                                     _parse)
-    return qc_summary
+    The zip is only parsed once (see get_fastqc_result), but each call
+    returns a new copy of the table that the caller is free to modify.
+    """
+    return list(get_fastqc_result(zip_file_path).summary)
 
 
 def parse_data_txt(zip_file_path):
@@ -131,39 +429,79 @@ def parse_data_txt(zip_file_path):
 
      The FastQC version is stored under data['fastqc_version'].
 
+     The zip is only parsed once (see get_fastqc_result), but each call
+     returns a new copy of the tables that the caller is free to modify.
+
     :type zip_file_path: str
     :return: dict
     """
-    def _parse(fh):
-        data = {'fastqc_version': fh.readline().split('\t')[1].strip()}
-        section = None
-        for l in fh:
-            line = l.strip()
-            if line[0:2] == '>>':
-                if line == '>>END_MODULE':
-                    # end section
-                    continue
-                else:
-                    # start new section
-                    section, qc_result = line[2:].split('\t')
-                    data[section] = {'rows': [],
-                                     'qc_result': qc_result}
-                    continue
-            if line[0] == '#':
-                column_labels = tuple(line[1:].split('\t'))
-                data[section]['column_labels'] = column_labels
-                continue
-            else:
-                data_row = tuple(line.split('\t'))
-                data[section]['rows'].append(data_row)
+    return copy.deepcopy(get_fastqc_result(zip_file_path).data)
 
-        return data
 
-    qc_data = parse_file_from_zip(zip_file_path,
-                                  'fastqc_data.txt',
-                                  _parse)
-
-    return qc_data
+class FastqcProjectSummary(dict):
+    """
+    The FastQC results for all samples in a project, as a dictionary with a
+    list of per-sample dicts under 'samples' (see
+    get_fastqc_summary_for_project in illumina_uploader).
+
+    Samples can be looked up by FASTQ filename or sample_id in constant time
+    via indexes. The indexes are built when the summary is created, and kept
+    up to date as samples are added with add_sample (or the 'samples' list is
+    replaced) - samples appended to the list directly aren't indexed. The
+    indexes aren't part of the dictionary itself, so the summary serializes
+    to JSON exactly as a plain dict does.
+    """
+    def __init__(self, *args, **kwargs):
+        super(FastqcProjectSummary, self).__init__(*args, **kwargs)
+        self._lock = threading.Lock()
+        self._by_filename = {}
+        self._by_sample_id = {}
+        self._reindex()
+
+    def __setitem__(self, key, value):
+        super(FastqcProjectSummary, self).__setitem__(key, value)
+        if key == 'samples':
+            self._reindex()
+
+    def _reindex(self):
+        with self._lock:
+            # built aside then swapped in, so concurrent readers never see
+            # a partially built index
+            by_filename, by_sample_id = {}, {}
+            for sample in self.get('samples', []):
+                by_filename.setdefault(sample.get('filename'), sample)
+                by_sample_id.setdefault(sample.get('sample_id'), sample)
+            self._by_filename = by_filename
+            self._by_sample_id = by_sample_id
+
+    def add_sample(self, sample):
+        """
+        Appends a sample to the 'samples' list, and indexes it.
+
+        :type sample: dict
+        """
+        with self._lock:
+            self.setdefault('samples', []).append(sample)
+            self._by_filename.setdefault(sample.get('filename'), sample)
+            self._by_sample_id.setdefault(sample.get('sample_id'), sample)
+
+    def get_sample_by_filename(self, filename):
+        """
+        :param filename: The FASTQ filename (without any directory).
+        :type filename: str
+        :return: The sample's FastQC results, or None.
+        :rtype: dict | None
+        """
+        return self._by_filename.get(filename, None)
+
+    def get_sample_by_id(self, sample_id):
+        """
+        :param sample_id: The sample_id (eg Q1N_S7_L004_R1_001).
+        :type sample_id: str
+        :return: The sample's FastQC results, or None.
+        :rtype: dict | None
+        """
+        return self._by_sample_id.get(sample_id, None)
 
 
 def extract_basic_stats(fastqc_data, sample_id):
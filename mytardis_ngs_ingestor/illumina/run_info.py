@@ -2,20 +2,44 @@ from __future__ import absolute_import, division, print_function
 from builtins import (bytes, str, open, super, range,
                       zip, round, input, int, pow, object)
 import logging
+import mmap
 import os
 from os.path import join, splitext, exists, isdir, isfile
-from pathlib2 import Path
 import subprocess
 import re
 import csv
-from collections import OrderedDict
+import struct
+import zlib
+from collections import OrderedDict, namedtuple
 from dateutil import parser as dateparser
 import xmltodict
 
+from ..utils.parallel import imap_ordered
+from ..utils.inventory import scan_tree, DEFAULT_SCAN_THREADS
+from ..utils.checksums import MultiHasher
+
 logger = logging.getLogger()
 
+GZIP_MAGIC = b'\x1f\x8b'
+# Compressed FASTQ data is read from disk in blocks of this size
+DEFAULT_GZIP_READ_BLOCKSIZE = 4 * 1024 * 1024
 
-def parse_samplesheet(file_path, standardize_keys=True):
+
+class SampleSheet(object):
+    """
+    A SampleSheet.csv, parsed once, with the differences between the old
+    plain CSV (IEMv3) and newer INI-style (IEMv4) formats hidden.
+
+    Iterating over a SampleSheet (or indexing it) gives the sample rows as
+    dicts, as returned by parse_samplesheet. Samples can also be looked up
+    by sample ID, sample name, (name, lane), (name, index, lane) or
+    project, via hash indexes built when the file is parsed. Sample names
+    are the SampleName column, or the SampleID for IEMv3 sheets, which
+    have no SampleName (matching the FASTQ filenames bcl2fastq generates).
+
+    The original lines of the file are kept, so per-project CSV files can
+    be generated without reading the file again (see project_csv_lines).
+    """
 
     # Old plain CSV format, IEM v3:
     # FCID,Lane,SampleID,SampleRef,Index,Description,Control,Recipe,
@@ -37,88 +61,277 @@ def parse_samplesheet(file_path, standardize_keys=True):
     # .. >snip< ..
     #
 
-    lines = []
-    with open(file_path, "rU") as f:
-        lines = f.readlines()
+    def __init__(self, file_path, standardize_keys=True):
+        """
+        :param file_path: The path to the SampleSheet.csv file.
+        :type file_path: str
+        :param standardize_keys: For IEMv4 sheets, remove underscores from
+                                 column labels (eg Sample_ID -> SampleID), to
+                                 be consistent with IEMv3 sheets.
+        :type standardize_keys: bool
+        """
+        self.file_path = file_path
+        self.chemistry = None
+        self.iem_version = 3
+
+        # universal newlines
+        with open(file_path, 'r') as f:
+            lines = [l.rstrip('\r\n') for l in f]
+
+        data_start = 0
+        if lines and '[Header]' in lines[0]:
+            self.iem_version = 4
+            section = None
+            for i, l in enumerate(lines):
+                if l[:1] == '[':
+                    section = l[1:].split(']')[0]
+                if section == 'Header' and l.startswith('Assay,'):
+                    self.chemistry = l.split(',')[1].strip()
+                if section == 'Data':
+                    data_start = i + 1
+                    break
+
+        # the column labels line, then a line per sample (and possibly
+        # '#' comment lines)
+        self._data_lines = lines[data_start:]
+
+        self._rows = []
+        self._row_lines = []
+        reader = csv.reader(self._data_lines)
+        column_labels = next(reader, [])
+        if self.iem_version == 4 and standardize_keys:
+            # remove any underscores to make names consistent between
+            # old and new style samplesheets (eg Sample_ID -> SampleID)
+            column_labels = [c.replace('_', '') for c in column_labels]
 
-    chemistry = None
+        for line_number, values in enumerate(reader, 1):
+            if not values or not any(values):
+                continue
+            if values[0].startswith('#'):
+                # eg, the IEMv3 trailer: #_IEMVERSION_3_TruSeq LT,,,,,,,,,
+                if self.iem_version == 3:
+                    self.chemistry = values[0].split('_')[-1].strip()
+                continue
+            self._rows.append(dict(zip(column_labels, values)))
+            self._row_lines.append(line_number)
+
+        self._build_indexes()
+
+    def _build_indexes(self):
+        self._by_sample_id = {}
+        self._by_sample_name = {}
+        self._by_name_lane = {}
+        self._by_name_index_lane = {}
+        self._by_project = OrderedDict()
+        for position, row in enumerate(self._rows):
+            sample_id = self._value(row, 'SampleID')
+            name = self.get_sample_name(row)
+            lane = self.get_lane(row)
+            index = self.get_index_sequence(row)
+            project = self._value(row, 'SampleProject')
+
+            self._by_sample_id.setdefault(sample_id, []).append(position)
+            self._by_sample_name.setdefault(name, []).append(position)
+            self._by_name_lane.setdefault((name, lane), position)
+            self._by_name_index_lane.setdefault((name, index, lane), position)
+            self._by_project.setdefault(project, []).append(position)
+
+    def _value(self, row, label):
+        # look up a column, with or without underscores in its label
+        for k, v in row.items():
+            if k == label or k.replace('_', '') == label:
+                return v
+        return None
+
+    def get_sample_name(self, row):
+        """
+        The sample name for a row - the SampleName, or the SampleID for
+        sheets with no SampleName column (IEMv3).
+
+        :type row: dict
+        :rtype: str
+        """
+        return self._value(row, 'SampleName') or self._value(row, 'SampleID')
+
+    def get_lane(self, row):
+        """
+        :type row: dict
+        :return: The lane as an integer, or None if there is no lane.
+        :rtype: int | None
+        """
+        lane = self._value(row, 'Lane')
+        try:
+            return int(lane)
+        except (TypeError, ValueError):
+            return None
+
+    def get_index_sequence(self, row):
+        """
+        The index sequence of a row ('Index' in IEMv3, 'index' in IEMv4).
+
+        :type row: dict
+        :rtype: str
+        """
+        return self._value(row, 'Index') or self._value(row, 'index') or ''
+
+    @property
+    def samples(self):
+        """
+        :return: A list of rows (as dicts) for every sample.
+        :rtype: list[dict]
+        """
+        return list(self._rows)
+
+    def __iter__(self):
+        return iter(self._rows)
+
+    def __len__(self):
+        return len(self._rows)
+
+    def __getitem__(self, i):
+        return self._rows[i]
+
+    @property
+    def project_ids(self):
+        """
+        :return: The unique projects in the sheet, in the order first seen.
+        :rtype: list[str]
+        """
+        return list(self._by_project.keys())
+
+    def samples_by_id(self, sample_id):
+        """
+        :rtype: list[dict]
+        """
+        return [self._rows[i] for i in self._by_sample_id.get(sample_id, [])]
+
+    def samples_by_name(self, sample_name):
+        """
+        :rtype: list[dict]
+        """
+        return [self._rows[i]
+                for i in self._by_sample_name.get(sample_name, [])]
+
+    def samples_by_project(self, proj_id):
+        """
+        :rtype: list[dict]
+        """
+        return [self._rows[i] for i in self._by_project.get(proj_id, [])]
+
+    def find_sample_position(self, sample_name, lane=None, index=None):
+        """
+        Returns the position (row number, from 0) of a sample in the sheet,
+        matching the sample name and, if given, the lane and index sequence
+        (eg, as parsed from a FASTQ filename by
+        parse_sample_info_from_filename). Returns None if there is no match.
+
+        :type sample_name: str
+        :type lane: int
+        :type index: str
+        :rtype: int | None
+        """
+        if lane is not None and index is not None:
+            return self._by_name_index_lane.get((sample_name, index, lane),
+                                                None)
+        if lane is not None:
+            return self._by_name_lane.get((sample_name, lane), None)
+
+        positions = self._by_sample_name.get(sample_name, [])
+        return positions[0] if positions else None
+
+    def find_sample(self, sample_name, lane=None, index=None):
+        """
+        Returns the row for a sample (see find_sample_position), or None.
+
+        :rtype: dict | None
+        """
+        position = self.find_sample_position(sample_name,
+                                             lane=lane,
+                                             index=index)
+        if position is None:
+            return None
+        return self._rows[position]
+
+    def project_csv_lines(self, proj_id, newline='\r\n'):
+        """
+        Returns the lines of a CSV file containing just the samples for a
+        project - the column labels line, the lines for the project's
+        samples and any '#' comment lines, as they appear in the original
+        file (INI-style IEMv4 sections before [Data] aren't included).
+
+        :param proj_id: The project ID.
+        :type proj_id: str
+        :param newline: The line ending used for each line.
+        :type newline: str
+        :rtype: list[str]
+        """
+        keep = set(self._row_lines[i]
+                   for i in self._by_project.get(proj_id, []))
+        outlines = []
+        for line_number, line in enumerate(self._data_lines):
+            line = line.strip()
+            if line_number == 0 or line_number in keep or line[:1] == '#':
+                outlines.append(line + newline)
+        return outlines
+
+
+# SampleSheets, keyed by absolute path
+_samplesheets = {}
+
+
+def get_samplesheet(file_path):
+    """
+    Returns a SampleSheet for the file, parsing it only the first time
+    it's requested (or if it has been modified since).
 
-    # IEM v4 INI-style CSV
-    if '[Header]' in lines[0]:
-        section = None
-        for i, l in enumerate(lines):
-            if l[0] == '[':
-                section = l[1:].split(']')[0]
-            if section == 'Header' and l.startswith('Assay,'):
-                chemistry = l.split(',')[1].strip()
-            if section == 'Data':
-                data_index = i
-                break
+    :param file_path: The path to the SampleSheet.csv file.
+    :type file_path: str
+    :rtype: SampleSheet
+    """
+    key = os.path.abspath(file_path)
+    st = os.stat(key)
+    cached = _samplesheets.get(key, None)
+    if cached is not None and cached[0] == (st.st_mtime, st.st_size):
+        return cached[1]
 
-        reader = csv.DictReader(lines[data_index+1:])
+    samplesheet = SampleSheet(file_path)
+    _samplesheets[key] = ((st.st_mtime, st.st_size), samplesheet)
+    return samplesheet
 
-        if standardize_keys:
-            samples = []
-            # remove any underscores to make names consistent between
-            # old and new style samplesheets (eg Sample_ID -> SampleID)
-            for r in [row for row in reader]:
-                r = {k.replace('_', ''): r[k] for k in r.keys()}
-                samples.append(r)
-        else:
-            samples = [row for row in reader]
 
-        return samples, chemistry
-    else:  # Plain CSV (IEM v3 ?)
-        reader = csv.DictReader(lines)
-        samples = [row for row in reader]
-        lastlinebit = samples[-1:][0].get('FCID', None)
-        if lastlinebit is not None:
-            chemistry = lastlinebit.split('_')[-1].strip()
-        del samples[-1:]
-        return samples, chemistry
+def parse_samplesheet(file_path, standardize_keys=True):
+    """
+    Returns a list of samples (as dicts) and the chemistry from a
+    SampleSheet.csv file (see SampleSheet).
+
+    :type file_path: str
+    :type standardize_keys: bool
+    :rtype: (list[dict], str)
+    """
+    samplesheet = SampleSheet(file_path, standardize_keys=standardize_keys)
+    return samplesheet.samples, samplesheet.chemistry
 
 
 def filter_samplesheet_by_project(file_path, proj_id,
                                   project_column_label='SampleProject'):
 
     """
-    Windows \r\n
-
-    :param file_path:
-    :type file_path:
-    :param proj_id:
-    :type proj_id:
-    :param project_column_label:
-    :type project_column_label:
-    :return:
-    :rtype:
+    Returns the lines of SampleSheet.csv for a single project (along with
+    the column labels, and any comment lines), with Windows \r\n line
+    endings.
+
+    :param file_path: The path to the SampleSheet.csv file.
+    :type file_path: str
+    :param proj_id: The project ID.
+    :type proj_id: str
+    :param project_column_label: Unused, kept for compatibility - the
+                                 SampleProject (or Sample_Project) column
+                                 is always used.
+    :type project_column_label: str
+    :return: The lines for the project.
+    :rtype: list[str]
     """
-    # FCID,Lane,SampleID,SampleRef,Index,Description,Control,Recipe,
-    # Operator,SampleProject
-    #
-    # last line: #_IEMVERSION_3_TruSeq LT,,,,,,,,,
-    outlines = []
-    with open(file_path, "rU") as f:
-        header = f.readline().strip()
-
-        # skip any INI-style headers down to the CSV sample list in the [Data]
-        if '[Header]' in header:
-            while not '[Data]' in header:
-                header = f.readline()
-            header = f.readline().strip()
-
-        s = header.split(',')
-        # old samplesheet formats have no underscores in column labels,
-        # newer (IEMv4) ones do. by removing underscores here, we can find
-        # 'SampleProject' and 'Sample_Project', whichever exists
-        s_no_underscores = [c.replace('_', '') for c in s]
-        project_column_index = s_no_underscores.index(project_column_label)
-        outlines.append(header + '\r\n')
-        for l in f:
-            s = l.strip().split(',')
-            if s[project_column_index] == proj_id or l[0] == '#':
-                outlines.append(l.strip() + '\r\n')
-    return outlines
+    return get_samplesheet(file_path).project_csv_lines(proj_id)
 
 
 def samplesheet_to_dict(samplesheet_rows, key='SampleID'):
@@ -142,17 +355,248 @@ def get_project_ids_from_samplesheet(samplesheet, include_no_index_name=None):
     return projects
 
 
-def get_number_of_reads_fastq(filepath):
+def _read_bgzf_block(fh):
+    """
+    Read a single BGZF block (a complete gzip member with a 'BC' extra
+    subfield giving the block size) from a file handle.
+
+    Returns a tuple of (raw_block_bytes, header_length), or (None, None) at
+    the end of the file. Raises ValueError if the data isn't BGZF.
+
+    :type fh: file
+    :rtype: (bytes, int)
+    """
+    header = fh.read(12)
+    if not header:
+        return None, None
+    if len(header) < 12 or header[:2] != GZIP_MAGIC or \
+            not (ord(header[3:4]) & 4):
+        raise ValueError("Not a BGZF block")
+
+    xlen = struct.unpack('<H', header[10:12])[0]
+    extra = fh.read(xlen)
+    bsize = None
+    offset = 0
+    while offset + 4 <= len(extra):
+        si1, si2, slen = struct.unpack('<ccH', extra[offset:offset + 4])
+        if si1 == b'B' and si2 == b'C' and slen == 2:
+            bsize = struct.unpack('<H', extra[offset + 4:offset + 6])[0]
+            break
+        offset += 4 + slen
+
+    if bsize is None:
+        raise ValueError("Not a BGZF block")
+
+    remaining = bsize + 1 - 12 - xlen
+    block = header + extra + fh.read(remaining)
+    return block, 12 + xlen
+
+
+def _inflate_bgzf_block(block_and_header_length):
+    block, header_length = block_and_header_length
+    # the block is a raw deflate stream followed by the CRC32 and ISIZE
+    return zlib.decompress(block[header_length:-8], -zlib.MAX_WBITS)
+
+
+def _is_bgzf(filepath):
+    with open(filepath, 'rb') as fh:
+        try:
+            block, header_length = _read_bgzf_block(fh)
+        except (ValueError, struct.error):
+            return False
+    return block is not None
+
+
+def iter_fastq_data(filepath,
+                    threads=1,
+                    blocksize=DEFAULT_GZIP_READ_BLOCKSIZE,
+                    on_raw_data=None):
+    """
+    Stream the decompressed contents of a (gzipped) FASTQ file, in order,
+    as a series of large byte strings (not split on line boundaries).
+
+    Compressed data is read in large blocks. For BGZF files (eg as
+    written by bcl2fastq 2.x) blocks are independent and are inflated
+    in batches, in parallel when threads > 1 (zlib releases the GIL while
+    decompressing). Plain gzip files (including multi-member files) are
+    inflated in a single stream. Uncompressed files are read as-is.
+
+    :param filepath: Path to the (gzipped) FASTQ file
+    :type filepath: str
+    :param threads: The number of threads used to inflate BGZF blocks.
+    :type threads: int
+    :param blocksize: The size of reads from disk for non-BGZF files.
+    :type blocksize: int
+    :param on_raw_data: An optional callable, given each chunk of raw (ie
+                        compressed) bytes of the file in order, eg for
+                        checksumming during the same pass.
+    :type on_raw_data: types.FunctionType
+    :rtype: collections.Iterator[bytes]
+    """
+    with open(filepath, 'rb') as fh:
+        magic = fh.read(2)
+        fh.seek(0)
+
+        if magic != GZIP_MAGIC:
+            for chunk in iter(lambda: fh.read(blocksize), b''):
+                if on_raw_data is not None:
+                    on_raw_data(chunk)
+                yield chunk
+            return
+
+        if _is_bgzf(filepath):
+            # group BGZF blocks (each <= 64 kb) into larger batches so
+            # thread overhead is small relative to the work done
+            blocks_per_batch = max(1, blocksize // (64 * 1024))
+
+            def _batches():
+                batch = []
+                while True:
+                    block, header_length = _read_bgzf_block(fh)
+                    if block is None:
+                        break
+                    if on_raw_data is not None:
+                        on_raw_data(block)
+                    batch.append((block, header_length))
+                    if len(batch) >= blocks_per_batch:
+                        yield batch
+                        batch = []
+                if batch:
+                    yield batch
+
+            def _inflate_batch(batch):
+                return b''.join([_inflate_bgzf_block(b) for b in batch])
+
+            for _, data in imap_ordered(_inflate_batch, _batches(),
+                                        threads=threads):
+                yield data
+            return
+
+        inflater = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        for chunk in iter(lambda: fh.read(blocksize), b''):
+            if on_raw_data is not None:
+                on_raw_data(chunk)
+            while chunk:
+                data = inflater.decompress(chunk)
+                if data:
+                    yield data
+                # a gzip file can contain multiple concatenated members
+                # (BGZF files are an example), each needing a new
+                # decompressor
+                chunk = inflater.unused_data
+                if chunk:
+                    data = inflater.flush()
+                    if data:
+                        yield data
+                    inflater = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        data = inflater.flush()
+        if data:
+            yield data
+
+
+def get_number_of_reads_fastq(filepath, threads=1):
     """
     Count the number of reads in a (gzipped) FASTQ file.
     Assumes fours lines per read.
 
+    The file is decompressed in-process in large blocks and newlines are
+    counted without splitting the data into lines. BGZF files are inflated
+    in parallel when threads > 1.
+
     :type filepath: str
+    :param threads: The number of threads used to inflate BGZF blocks.
+    :type threads: int
     :rtype: int
     """
-    num = subprocess.check_output("zcat %s | echo $((`wc -l`/4))" % filepath,
-                                  shell=True)
-    return int(num.strip())
+    lines = 0
+    for data in iter_fastq_data(filepath, threads=threads):
+        lines += data.count(b'\n')
+    return lines // 4
+
+
+def get_fastq_stats(filepath, threads=1, digests=None):
+    """
+    Calculate basic statistics for a (gzipped) FASTQ file in a single pass
+    over the file, along with checksums of the file as stored on disk
+    (ie the compressed file). All the digest algorithms given (eg
+    ['md5', 'sha512']) are calculated in the same pass.
+
+    Returns a tuple of (stats, digests), where stats has the same keys as
+    produced from FastQC output by fastqc.extract_basic_stats
+    (number_of_reads, read_length, percent_gc), plus min_read_length. As
+    with FastQC, %GC excludes N bases and read_length is the longest read.
+    digests is a dictionary of hex digests keyed by algorithm name (see
+    utils.checksums.digest_file).
+
+    eg ({'number_of_reads': 2000, 'read_length': 51,
+         'min_read_length': 35, 'percent_gc': 41.0},
+        {'md5': 'd41d8cd98f00b204e9800998ecf8427e'})
+
+    :param filepath: Path to the (gzipped) FASTQ file
+    :type filepath: str
+    :param threads: The number of threads used to inflate BGZF blocks.
+    :type threads: int
+    :param digests: Digest algorithm names (default: md5 only).
+    :type digests: list[str]
+    :rtype: (dict, dict)
+    """
+    hasher = MultiHasher(digests or ('md5',))
+
+    number_of_reads = 0
+    min_length = None
+    max_length = 0
+    gc_bases = 0
+    n_bases = 0
+    total_bases = 0
+
+    # the line number (modulo 4) of the first complete line in each
+    # chunk, and any incomplete line carried over from the previous chunk
+    line_offset = 0
+    partial = b''
+    for data in iter_fastq_data(filepath,
+                                threads=threads,
+                                on_raw_data=hasher.update):
+        lines = (partial + data).split(b'\n')
+        partial = lines.pop()
+
+        # the sequence is the second line of each four line record
+        seqs = lines[(1 - line_offset) % 4::4]
+        line_offset = (line_offset + len(lines)) % 4
+        if not seqs:
+            continue
+
+        lengths = [len(seq) for seq in seqs]
+        number_of_reads += len(seqs)
+        total_bases += sum(lengths)
+        max_length = max(max_length, max(lengths))
+        shortest = min(lengths)
+        if min_length is None or shortest < min_length:
+            min_length = shortest
+
+        bases = b''.join(seqs)
+        gc_bases += bases.count(b'G') + bases.count(b'C')
+        n_bases += bases.count(b'N')
+
+    # a final sequence line without a trailing newline
+    if partial and line_offset == 1:
+        number_of_reads += 1
+        total_bases += len(partial)
+        max_length = max(max_length, len(partial))
+        if min_length is None or len(partial) < min_length:
+            min_length = len(partial)
+        gc_bases += partial.count(b'G') + partial.count(b'C')
+        n_bases += partial.count(b'N')
+
+    percent_gc = 0.0
+    if total_bases - n_bases > 0:
+        percent_gc = round(gc_bases * 100.0 / (total_bases - n_bases))
+
+    stats = {'number_of_reads': number_of_reads,
+             'read_length': max_length,
+             'min_read_length': min_length or 0,
+             'percent_gc': float(percent_gc)}
+
+    return stats, hasher.hexdigests()
 
 
 def get_read_length_fastq(filepath):
@@ -394,89 +838,235 @@ def get_run_id_from_path(run_path):
     return os.path.basename(run_path.strip(os.path.sep))
 
 
-# TODO: We could actually make patterns like these one a config option
-# (either raw Python regex with named groups, or write a translator to
-#  simplify the syntax so we can write {sample_id}_bla_{index} in the config
-#  and have it converted to a regex with named groups internally)
-# https://docs.python.org/2/howto/regex.html#non-capturing-and-named-groups
-#
+# Components of regexes to match common fastq.gz filenames output
+# by Illumina software. It's easier and more extensible to combine
+# these than attempt to create and maintain one big regex. Filename
+# patterns can refer to these as {name}, eg '{sample_name}_{lane}', or use
+# raw Python regexes with named groups.
+FILENAME_FIELD_REGEXES = {
+    'sample_name': r'(?P<sample_name>.*)',
+    'undetermined_sample_name': r'(?P<sample_name>.*_Undetermined)',
+    'index': r'(?P<index>[ATGC-]{6,33})',
+    # 'dual_index': r'(?P<index>[ATGC]{6,12})-?(?P<index2>[ATGC]{6,12})?',
+    'lane': r'L0{0,3}(?P<lane>\d+)',
+    # Usually R1 or R2, can be I1 etc if index reads are output seperately
+    'read': r'[RI](?P<read>\d)',
+    'set_number': r'(?P<set_number>\d+)',
+    'sample_number': r'S(?P<sample_number>\d+)',
+}
+
+# Tried in order, the first match wins. The suffix (eg .fastq.gz) is
+# appended to each.
+DEFAULT_FILENAME_PATTERNS = [
+    # Undetermined indices files like this:
+    # lane1_Undetermined_L001_R1_001.fastq.gz
+    '{undetermined_sample_name}_{lane}_{read}_{set_number}',
+
+    # bcl2fastq 2.x style filenames:
+    # {sample_name}_{sample_number}_L00{lane}_R{read}_001.fastq.gz
+    '{sample_name}_{sample_number}_{lane}_{read}_{set_number}',
+
+    # bcl2fastq 1.8.4 style filenames:
+    # {sample_name}_{index}_L00{lane}_R{read}_001.fastq.gz
+    '{sample_name}_{index}_{lane}_{read}_{set_number}',
+]
+
+# Parsed filenames memoized by each matcher, before the memo is reset
+DEFAULT_FILENAME_CACHE_SIZE = 100000
+
+
+class FastqFilenameMatcher(object):
+    """
+    Parses sample information (sample_name, lane, read etc) from FASTQ
+    filenames output by Illumina software, using a list of patterns that
+    are compiled once.
+
+    Results are memoized per filename, since the same filenames are parsed
+    repeatedly (eg when sorting and summarizing FastQC results).
+    """
+    _int_fields = ('sample_number', 'lane', 'read', 'set_number')
+
+    def __init__(self, patterns=None, suffix='.fastq.gz',
+                 cache_size=DEFAULT_FILENAME_CACHE_SIZE):
+        """
+        :param patterns: Filename patterns (without the suffix), either
+                         raw regexes with named groups, or using {name}
+                         for the fields in FILENAME_FIELD_REGEXES. Defaults
+                         to DEFAULT_FILENAME_PATTERNS.
+        :type patterns: list[str]
+        :param suffix: The filename suffix (eg .fastq.gz, _fastqc.zip).
+        :type suffix: str
+        :param cache_size: The maximum number of filenames memoized.
+        :type cache_size: int
+        """
+        if not patterns:
+            patterns = DEFAULT_FILENAME_PATTERNS
+        self.suffix = suffix
+        self.cache_size = cache_size
+        self._regexes = [re.compile(self._expand_pattern(p) +
+                                    re.escape(suffix) + '$')
+                         for p in patterns]
+        self._cache = {}
+
+    @staticmethod
+    def _expand_pattern(pattern):
+        # only known field names are substituted, so regex quantifiers
+        # like {6,33} are left alone
+        return re.sub(r'{(\w+)}',
+                      lambda m: FILENAME_FIELD_REGEXES.get(m.group(1),
+                                                           m.group(0)),
+                      pattern)
+
+    def _parse(self, filename):
+        for regex in self._regexes:
+            m = regex.match(filename)
+            if m is not None:
+                d = m.groupdict()
+                for k in self._int_fields:
+                    if d.get(k, None) is not None:
+                        d[k] = int(d[k])
+                return d
+        return None
+
+    def match(self, filepath):
+        """
+        :param filepath: A filename (possibly including a path).
+        :type filepath: str
+        :return: The named fields from the first matching pattern, or None
+                 if no pattern matches.
+        :rtype: dict | None
+        """
+        filename = os.path.basename(filepath)
+        try:
+            d = self._cache[filename]
+        except KeyError:
+            d = self._parse(filename)
+            if len(self._cache) >= self.cache_size:
+                self._cache = {}
+            self._cache[filename] = d
+        # callers may modify the dictionary they get back
+        return dict(d) if d is not None else None
+
+
+_filename_patterns = None
+_filename_matchers = {}
+
+
+def set_fastq_filename_patterns(patterns=None):
+    """
+    Sets the filename patterns used by parse_sample_info_from_filename
+    (eg from the fastq_filename_patterns config option). None restores
+    the defaults.
+
+    :param patterns: Filename patterns, see FastqFilenameMatcher.
+    :type patterns: list[str]
+    """
+    global _filename_patterns, _filename_matchers
+    _filename_patterns = list(patterns) if patterns else None
+    _filename_matchers = {}
+
+
+def get_filename_matcher(suffix='.fastq.gz'):
+    """
+    Returns the shared FastqFilenameMatcher for a filename suffix, using
+    the patterns set by set_fastq_filename_patterns.
+
+    :type suffix: str
+    :rtype: FastqFilenameMatcher
+    """
+    matcher = _filename_matchers.get(suffix, None)
+    if matcher is None:
+        matcher = FastqFilenameMatcher(_filename_patterns, suffix=suffix)
+        _filename_matchers[suffix] = matcher
+    return matcher
+
+
 # (All these problems of differences between v2.x and v1.8.4 and CSV vs.
 #  IEMv4 SampleSheets are begging for a SampleSheet data container
 #  object to abstract out differences in sample sheets, and an IlluminaRun
 #  object with a list of DemultiplexedProject objects to abstract out
 #  differences in directory structure)
 def parse_sample_info_from_filename(filepath, suffix='.fastq.gz'):
-    filename = os.path.basename(filepath)
-
-    def change_dict_types(d, keys, map_fn, ignore_missing_keys=True):
-        for k in keys:
-            if k in d:
-                d[k] = map_fn(d[k])
-            elif not ignore_missing_keys:
-                raise KeyError("%s not found" % k)
-        return d
-
-    # Components of regexes to match common fastq.gz filenames output
-    # by Illumina software. It's easier and more extensible to combine
-    # these than attempt to create and maintain one big regex
-    sample_name_re = r'(?P<sample_name>.*)'
-    undetermined_sample_name_re = r'(?P<sample_name>.*_Undetermined)'
-    index_re = r'(?P<index>[ATGC-]{6,33})'
-    # dual_index_re = r'(?P<index>[ATGC]{6,12})-?(?P<index2>[ATGC]{6,12})?'
-    lane_re = r'L0{0,3}(?P<lane>\d+)'
-    # Usually R1 or R2, can be I1 etc if index reads are output seperately
-    read_re = r'[RI](?P<read>\d)'
-    # index_read_re = r'I(?P<read>\d)'
-    set_number_re = r'(?P<set_number>\d+)'
-    sample_number_re = r'S(?P<sample_number>\d+)'
-    extension_re = r'%s$' % suffix
-
-    filename_regexes = [
-        # Undetermined indices files like this:
-        # lane1_Undetermined_L001_R1_001.fastq.gz
-        r'_'.join([undetermined_sample_name_re, lane_re, read_re, set_number_re]),
-
-        # bcl2fastq 2.x style filenames:
-        # {sample_name}_{sample_number}_L00{lane}_R{read}_001.fastq.gz
-        r'_'.join([sample_name_re, sample_number_re, lane_re, read_re,
-                   set_number_re]),
-
-        # bcl2fastq 1.8.4 style filenames:
-        # {sample_name}_{index}_L00{lane}_R{read}_001.fastq.gz
-        r'_'.join([sample_name_re, index_re, lane_re, read_re, set_number_re]),
-    ]
-
-    filename_regexes = [r + extension_re for r in filename_regexes]
-
-    # path_regexes = [
-    #     r'(?P<project_id>.*)/Sample_(?P<sample_id>.*)/'
-    #     r'(?P<project_id>.*)/(?P<sample_id>.*)/',
-    #     r'',
-    # ]
-
-    # combined_re = r'(%s)' % '|'.join(filename_regexes)
-    # combined_re = r'(%s)(%s)' % ('|'.join(path_regexes),
-    #                              '|'.join(filename_regexes))
-
-    for regex in filename_regexes:
-        m = re.match(regex, filename)
-        if m is not None:
-            break
+    return get_filename_matcher(suffix).match(filepath)
 
-    if m is not None:
-        d = m.groupdict()
-        d = change_dict_types(d, ['sample_number', 'lane', 'read',
-                                  'set_number'], int)
-        return d
 
-    return None
+# A FASTQ file found in a bcl2fastq output directory. 'path' is relative
+# to the output directory (or absolute), 'project' and 'sample' come from
+# the Project/Sample directories containing the file (sample is None if
+# there is no Sample directory), 'fields' is the dictionary returned by
+# parse_sample_info_from_filename (None if the filename isn't recognized)
+# and 'stat' is the os.stat_result for the file.
+FastqFileRecord = namedtuple('FastqFileRecord',
+                             ['path', 'size', 'mtime', 'project', 'sample',
+                              'fields', 'stat'])
+
+
+def get_fastq_inventory(basepath,
+                        suffix='.fastq.gz',
+                        absolute_paths=False,
+                        catch_undetermined=True,
+                        threads=DEFAULT_SCAN_THREADS):
+    """
+    Finds all the FASTQ files below basepath (eg a bcl2fastq output
+    directory), possibly nested in Project/Sample directories, in a single
+    pass - directories are listed in parallel and each FASTQ file is stat'd
+    and has its filename parsed once.
+
+    :param basepath: Path to directory tree of fastq.gz files - eg, bcl2fastq
+                     output directory
+    :type basepath: str
+    :param suffix: The filename suffix of FASTQ files.
+    :type suffix: str
+    :param absolute_paths: Record absolute paths rather than paths relative
+                           to basepath.
+    :type absolute_paths: bool
+    :param catch_undetermined: Assign Undetermined reads to the
+                               'Undetermined_indices' project.
+    :type catch_undetermined: bool
+    :param threads: The maximum number of directories listed concurrently.
+    :type threads: int
+    :return: A list of records, sorted by path.
+    :rtype: list[FastqFileRecord]
+    """
+    records = []
+    for fqpath, stat in scan_tree(basepath,
+                                  match=lambda fn: fn.endswith(suffix),
+                                  threads=threads):
+        project = u''
+        sample = None
+        parts = fqpath.split('/')
+        fqfile = parts[-1]
+        if len(parts) == 3:
+            project, sample = parts[0], parts[1]
+        if len(parts) == 2:
+            project = parts[0]
+
+        if catch_undetermined and 'Undetermined' in fqfile:
+            project = u'Undetermined_indices'
+
+        if absolute_paths:
+            fqpath = join(basepath, fqpath)
+        else:
+            fqpath = os.path.normpath(fqpath)
+
+        records.append(FastqFileRecord(
+            path=fqpath,
+            size=stat.st_size,
+            mtime=stat.st_mtime,
+            project=project,
+            sample=sample,
+            fields=parse_sample_info_from_filename(fqfile, suffix=suffix),
+            stat=stat))
+
+    return records
 
 
 def get_sample_project_mapping(basepath,
                                samplesheet=None,
                                suffix='.fastq.gz',
                                absolute_paths=False,
-                               catch_undetermined=True):
+                               catch_undetermined=True,
+                               inventory=None):
     """
     Given a path containing fastq.gz files, possibily nested in Project/Sample
     directories, return a data structure mapping fastq-samples to projects.
@@ -486,55 +1076,256 @@ def get_sample_project_mapping(basepath,
     :param basepath: Path to directory tree of fastq.gz files - eg, bcl2fastq
                      output directory
     :type basepath: str
+    :param inventory: The records returned by get_fastq_inventory for
+                      basepath, if already available.
+    :type inventory: list[FastqFileRecord]
     :return: Dictionary lists, {project_id : [relative fastq.gz paths]}
     :rtype: OrderedDict
     """
 
-    from fs.opener import opener
+    if inventory is None:
+        inventory = get_fastq_inventory(basepath,
+                                        suffix=suffix,
+                                        absolute_paths=absolute_paths,
+                                        catch_undetermined=catch_undetermined)
+
+    # TODO: we currently don't deal with Project_ prefixes, really
+    #       the project ID doesn't include Project_. If we strip
+    #       this here, maybe we need to include the project directory
+    #       in the fastq paths so we can know the path and project id
+    #       - will require fixes to downstream code that
+    #       does join(bcl2fastq_output_dir, project_id, fastq_file)
+    project_mapping = OrderedDict()
+    for record in inventory:
+        project_mapping.setdefault(record.project, []).append(record.path)
 
-    fq_files = []
-    with opener.opendir(basepath) as vfs:
-        for fn in vfs.walkfiles():
-            if suffix in fn:
-                fq_files.append(fn.lstrip('/').lstrip('\\'))
+    # TODO: Use the SampleSheet.csv to validate or hint
 
-    fq_files = sorted(fq_files)
+    return project_mapping
 
-    project_mapping = OrderedDict()
-    for fqpath in fq_files:
-        project = ''
-        fqfile = fqpath
-        parts = Path(fqpath).parts
-        if len(parts) == 3:
-            project, sample_id, fqfile = map(str, parts)
-        if len(parts) == 2:
-            project, fqfile = map(str, parts)
-        if len(parts) == 1:
-            fqfile = str(parts[0])
 
-        if catch_undetermined and 'Undetermined' in fqfile:
-            project = u'Undetermined_indices'
+# The smallest size (in bytes) a complete file of each type can be - any
+# smaller and it can't even hold the file header, indicating a failed
+# (or still in progress) transfer from the instrument. Longer suffixes
+# are listed first.
+MIN_VALID_FILE_SIZES = OrderedDict([
+    # an empty gzip member (header, empty deflate block, trailer)
+    ('.bcl.gz', 20),
+    ('.fastq.gz', 20),
+    # a 4 byte cluster count, then one byte per cluster
+    ('.bcl', 4),
+    # version, header size, bits per basecall & qscore, number of bins
+    ('.cbcl', 12),
+    ('.fastq', 1),
+])
+BCL_SUFFIXES = ('.bcl', '.bcl.gz', '.cbcl')
+FASTQ_SUFFIXES = ('.fastq', '.fastq.gz')
+
+# Lane directories (L001/) in BaseCalls, FASTQ filenames
+# (Sample_S1_L001_R1_001.fastq.gz) and older BCL filenames (s_1_1101.bcl)
+_LANE_RE = re.compile(r'(?:^|[/_])(?:L0*|s_)(\d+)(?=[/_])')
+
+
+def find_truncated_files(basepath,
+                         suffixes=BCL_SUFFIXES,
+                         first_only=False,
+                         threads=DEFAULT_SCAN_THREADS):
+    """
+    Finds files below basepath (eg Data/Intensities/BaseCalls, or the
+    bcl2fastq output directory) that are zero size, or too small to be
+    a valid file of their type (see MIN_VALID_FILE_SIZES).
 
-        # TODO: we currently don't deal with Project_ prefixes, really
-        #       the project ID doesn't include Project_. If we strip
-        #       this here, maybe we need to include the project directory
-        #       in the fastq paths so we can know the path and project id
-        #       - will require fixes to downstream code that
-        #       does join(bcl2fastq_output_dir, project_id, fastq_file)
+    Directories are listed in parallel, in-process, so this is much faster
+    than running find over runs with millions of BCL files on NFS.
 
-        # TODO: also incorporate sample_id in this datastructure
-        if project not in project_mapping:
-            project_mapping[project] = []
-        if absolute_paths:
-            fqpath = join(basepath, fqpath)
-        project_mapping[project].append(fqpath)
+    :param basepath: The top level directory.
+    :type basepath: str
+    :param suffixes: The suffixes of files to check.
+    :type suffixes: list[str]
+    :param first_only: Stop at the first truncated file found - enough to
+                       know if a run is bad, without listing the whole tree.
+    :type first_only: bool
+    :param threads: The maximum number of directories listed concurrently.
+    :type threads: int
+    :return: Paths (relative to basepath) of truncated files, by lane number.
+             Files that can't be assigned to a lane are under None.
+    :rtype: OrderedDict[int, list[str]]
+    """
+    min_sizes = [(sfx, MIN_VALID_FILE_SIZES.get(sfx, 1))
+                 for sfx in sorted(suffixes, key=len, reverse=True)]
+
+    def _min_size(filename):
+        for sfx, min_size in min_sizes:
+            if filename.endswith(sfx):
+                return min_size
+        return None
+
+    def _is_truncated(relpath, stat):
+        return stat.st_size < _min_size(relpath)
+
+    truncated = scan_tree(basepath,
+                          match=lambda fn: _min_size(fn) is not None,
+                          select=_is_truncated,
+                          limit=1 if first_only else None,
+                          threads=threads)
+
+    by_lane = {}
+    for relpath, stat in truncated:
+        m = _LANE_RE.search(relpath)
+        lane = int(m.group(1)) if m is not None else None
+        by_lane.setdefault(lane, []).append(relpath)
+
+    return OrderedDict(sorted(by_lane.items(),
+                              key=lambda l: (l[0] is None, l[0])))
+
+
+# Lines in RTA logs (Data/RTALogs/*) matching these (Python regexes)
+# indicate a problem during the run or the transfer from the instrument.
+# Patterns without any regex special characters are searched for as plain
+# strings, which is much faster than a regex (so 'fail', 'Fail' rather
+# than '[fF]ail').
+DEFAULT_RTA_FAILURE_PATTERNS = ['fail', 'Fail']
+_REGEX_SPECIAL_CHARS = frozenset('.^$*+?{}[]\\|()')
+
+# A line in an RTA log matching one of the failure patterns. 'line_number'
+# starts at 1, 'timestamp' is a datetime (None if the line doesn't start
+# with one).
+RtaLogHit = namedtuple('RtaLogHit',
+                       ['file', 'line_number', 'timestamp', 'line'])
+
+# Eg '9/7/2013 18:12:53.149', '9/7/2013,18:12:53.149' (RTA 1.x/2.x)
+# or '2017-02-17 10:46:02' (RTA 3.x)
+_RTA_LOG_TIMESTAMP_RE = re.compile(
+    r'^\s*(\d{1,4}[/-]\d{1,2}[/-]\d{1,4}[\s,]+\d{1,2}:\d{2}:\d{2}'
+    r'(?:\.\d+)?(?:\s*[AP]M)?)')
+
+
+def _parse_rta_log_timestamp(line):
+    m = _RTA_LOG_TIMESTAMP_RE.match(line)
+    if m is None:
+        return None
+    try:
+        return dateparser.parse(m.group(1).replace(',', ' '))
+    except (ValueError, OverflowError):
+        return None
+
+
+def scan_rta_log(log_path, patterns=None):
+    """
+    Finds the lines in an RTA log file matching any of the failure
+    patterns.
+
+    The file is memory mapped and searched in place, rather than being
+    read line by line, so large logs are scanned quickly and without
+    copying them into memory.
+
+    :param log_path: The path to the log file.
+    :type log_path: str
+    :param patterns: Python regexes, default DEFAULT_RTA_FAILURE_PATTERNS.
+    :type patterns: list[str]
+    :rtype: list[RtaLogHit]
+    """
+    if not patterns:
+        patterns = DEFAULT_RTA_FAILURE_PATTERNS
+    literals = [p.encode('utf-8') for p in patterns
+                if not _REGEX_SPECIAL_CHARS.intersection(p)]
+    regexes = [p.encode('utf-8') for p in patterns
+               if _REGEX_SPECIAL_CHARS.intersection(p)]
+    regex = None
+    if regexes:
+        regex = re.compile(b'|'.join(b'(?:' + p + b')' for p in regexes))
+
+    hits = []
+    with open(log_path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            # empty files can't be mapped
+            return hits
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        # the next match of each pattern at or after some position, as
+        # (start, end), or None if there are no more matches. Each is only
+        # searched for again once we've moved past it.
+        next_matches = {}
+
+        def _next_match(pos):
+            for lit in literals:
+                nm = next_matches.get(lit, (-1, -1))
+                if nm is not None and nm[0] < pos:
+                    start = mm.find(lit, pos)
+                    nm = (start, start + len(lit)) if start != -1 else None
+                    next_matches[lit] = nm
+            if regex is not None:
+                nm = next_matches.get(regex, (-1, -1))
+                if nm is not None and nm[0] < pos:
+                    m = regex.search(mm, pos)
+                    nm = m.span() if m is not None else None
+                    next_matches[regex] = nm
+            found = [nm for nm in next_matches.values() if nm is not None]
+            return min(found) if found else None
 
-    # TODO: Use the SampleSheet.csv to validate or hint
-    # TODO: Also assign sample_id, sample_name, lane, read, etc
-    #       we could use parse_sample_info_from_filename for this,
-    #       and/or use the FASTQ header(s)
+        try:
+            line_number = 1
+            counted_to = 0
+            pos = 0
+            while True:
+                match = _next_match(pos)
+                if match is None:
+                    break
+                match_start, match_end = match
+                line_start = mm.rfind(b'\n', 0, match_start) + 1
+                line_end = mm.find(b'\n', match_end)
+                if line_end == -1:
+                    line_end = len(mm)
+                line_number += mm[counted_to:line_start].count(b'\n')
+                counted_to = line_start
+
+                line = mm[line_start:line_end].decode('utf-8', 'replace')
+                line = line.rstrip(u'\r')
+                hits.append(RtaLogHit(file=log_path,
+                                      line_number=line_number,
+                                      timestamp=_parse_rta_log_timestamp(line),
+                                      line=line))
+                # one hit per line
+                pos = line_end + 1
+        finally:
+            mm.close()
+
+    return hits
+
+
+def _scan_rta_log_worker(args):
+    log_path, patterns = args
+    return scan_rta_log(log_path, patterns)
+
+
+def scan_rta_logs(rtalogs_path, patterns=None, processes=1):
+    """
+    Scans all the log files in an RTALogs directory for lines matching the
+    failure patterns (see scan_rta_log), optionally in parallel using a pool
+    of worker processes.
+
+    :param rtalogs_path: The RTALogs (or Data/RTALogs) directory.
+    :type rtalogs_path: str
+    :param patterns: Python regexes, default DEFAULT_RTA_FAILURE_PATTERNS.
+    :type patterns: list[str]
+    :param processes: The number of worker processes.
+    :type processes: int
+    :return: The matching lines, ordered by log filename and line number.
+    :rtype: list[RtaLogHit]
+    """
+    log_paths = sorted(join(rtalogs_path, fn)
+                       for fn in os.listdir(rtalogs_path)
+                       if isfile(join(rtalogs_path, fn)))
+    jobs = [(log_path, patterns) for log_path in log_paths]
 
-    return project_mapping
+    if not processes or processes <= 1 or len(jobs) <= 1:
+        results = [_scan_rta_log_worker(job) for job in jobs]
+    else:
+        from concurrent.futures import ProcessPoolExecutor
+        with ProcessPoolExecutor(max_workers=processes) as executor:
+            results = list(executor.map(_scan_rta_log_worker, jobs))
+
+    return [hit for hits in results for hit in hits]
 
 
 def undetermined_reads_in_root(basepath):
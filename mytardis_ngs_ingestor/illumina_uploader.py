@@ -11,18 +11,27 @@ import sys
 import shutil
 from datetime import datetime
 import subprocess
-from tempfile import mkdtemp
+from tempfile import mkdtemp, gettempdir
 import atexit
 
 import os
+import logging
 from os.path import join, splitext, exists, isdir, isfile
 import json
+from collections import deque
 
 from semantic_version import Version as SemanticVersion
 from distutils.version import LooseVersion
 
 from illumina import fastqc
 from utils.standalone_html import make_html_images_inline
+from utils.parallel import imap_ordered
+from utils import checksums
+from utils import file_cache
+from utils import journal
+from utils import inventory
+from utils import checksum_sidecars
+from utils import lookup_cache
 
 import mytardis_uploader
 from mytardis_uploader import MyTardisUploader
@@ -41,14 +50,18 @@ from models import DemultiplexedSamplesBase, FastqcOutputBase, \
     IlluminaRunConfigBase
 
 from mytardis_ngs_ingestor.illumina import run_info, fastqc
-from mytardis_ngs_ingestor.illumina.run_info import parse_samplesheet, \
-    samplesheet_to_dict, get_project_ids_from_samplesheet, \
-    get_number_of_reads_fastq, \
+from mytardis_ngs_ingestor.illumina.run_info import get_samplesheet, \
+    get_project_ids_from_samplesheet, \
+    get_number_of_reads_fastq, get_fastq_stats, \
     get_read_length_fastq, rta_complete_parser, runinfo_parser, \
     illumina_config_parser, get_run_id_from_path, get_demultiplexer_info, \
     get_sample_id_from_fastq_filename, get_sample_name_from_fastq_filename, \
-    parse_sample_info_from_filename, filter_samplesheet_by_project, \
-    get_sample_project_mapping, undetermined_reads_in_root
+    parse_sample_info_from_filename, get_fastq_inventory, \
+    get_sample_project_mapping, undetermined_reads_in_root, \
+    find_truncated_files, BCL_SUFFIXES, FASTQ_SUFFIXES, scan_rta_logs
+
+# replaced by the configured logger when run as a command
+logger = logging.getLogger('mytardis_ngs_uploader')
 
 # a module level list of temporary directories that have been
 # created, so these can be cleaned up upon premature exit
@@ -60,6 +73,16 @@ INSTRUMENT_TYPE_NAMES = {
     'Shock': 'MiSeq'
 }
 
+# The number of projects FastQC is run on ahead of the project currently
+# being registered with the server
+DEFAULT_PIPELINE_DEPTH = 2
+
+# Datafiles with pending checksums are queued in <journal_dir>/<run_id><this>
+CHECKSUM_QUEUE_SUFFIX = '.checksum_queue'
+# Queued Datafiles whose checksums couldn't be set are reported in
+# <journal_dir>/<run_id><this>
+CHECKSUM_FAILURES_SUFFIX = '.checksum_failures'
+
 class DemultiplexedSamples(DemultiplexedSamplesBase):
     pass
 
@@ -112,8 +135,7 @@ def create_run_experiment_object(run_path):
     raw_model_name = instrument_config.get('system:instrumenttype', '')
     instrument_model = INSTRUMENT_TYPE_NAMES.get(raw_model_name, raw_model_name)
     instrument_id = runinfo_parameters.get('instrument_id', '')
-    samplesheet, chemistry = parse_samplesheet(join(run_path,
-                                                    'SampleSheet.csv'))
+    samplesheet = get_samplesheet(join(run_path, 'SampleSheet.csv'))
 
     # the MyTardis ParameterSet
     run = IlluminaSequencingRun()
@@ -123,7 +145,7 @@ def create_run_experiment_object(run_path):
     # run.run_path = run_path
     run.run_id = get_run_id_from_path(run_path)
     run.rta_version = rta_version
-    run.chemistry = chemistry
+    run.chemistry = samplesheet.chemistry
     run.operator_name = samplesheet[0].get('Operator', '')
     run._samplesheet = samplesheet
 
@@ -231,11 +253,7 @@ def create_fastqc_dataset_on_server(fastqc_dataset, uploader):
     return uploader.create_dataset(fastqc_dataset.package())
 
 
-def run_fastqc_on_project(fastq_files,
-                          proj_path,
-                          output_directory=None,
-                          fastqc_bin=None,
-                          threads=2):
+def _prepare_fastqc_output_directory(proj_path, output_directory=None):
     if output_directory is None:
         output_directory = get_fastqc_output_directory(proj_path)
         if exists(output_directory):
@@ -256,6 +274,19 @@ def run_fastqc_on_project(fastq_files,
                      output_directory)
         return None
 
+    return output_directory
+
+
+def run_fastqc_on_project(fastq_files,
+                          proj_path,
+                          output_directory=None,
+                          fastqc_bin=None,
+                          threads=2):
+    output_directory = _prepare_fastqc_output_directory(proj_path,
+                                                        output_directory)
+    if output_directory is None:
+        return None
+
     fqc_output_directory = fastqc.run_fastqc(fastq_files,
                                              output_directory=output_directory,
                                              fastqc_bin=fastqc_bin,
@@ -263,6 +294,72 @@ def run_fastqc_on_project(fastq_files,
     return fqc_output_directory
 
 
+def pipeline_fastqc_for_projects(project_fastq_mapping,
+                                 bcl2fastq_output_dir,
+                                 samplesheet,
+                                 scheduler=None,
+                                 depth=DEFAULT_PIPELINE_DEPTH):
+    """
+    The QC stage of the ingestion pipeline. Yields (proj_id, fastq_files,
+    fastqc_job) tuples for each project in order, while FastQC for up to
+    'depth' following projects is queued on the scheduler (see
+    fastqc.FastqcScheduler), so QC of the next projects overlaps with
+    registering the current one on the server.
+
+    FastQC is only run for projects that don't already have FastQC
+    output, writing to temporary directories, since we don't expect to have
+    write permissions to the primary data directory. For these projects
+    fastqc_job is a Future with the result (fastqc_out_dir, fastqc_summary),
+    with the summary parsed as soon as the last FastQC job for the project
+    finishes, or None if FastQC failed. Otherwise (or if scheduler is None)
+    fastqc_job is None.
+
+    :param project_fastq_mapping: Lists of FASTQ files, keyed by project ID.
+    :type project_fastq_mapping: dict
+    :param bcl2fastq_output_dir: The bcl2fastq output directory.
+    :type bcl2fastq_output_dir: str
+    :param samplesheet: The parsed SampleSheet.csv.
+    :type samplesheet: illumina.run_info.SampleSheet
+    :param scheduler: The scheduler to run FastQC jobs on.
+    :type scheduler: fastqc.FastqcScheduler
+    :param depth: The maximum number of projects queued for FastQC ahead
+                  of the project currently yielded.
+    :type depth: int
+    :rtype: collections.Iterator[(str, list[str], concurrent.futures.Future)]
+    """
+
+    def _summarize(fastqc_out_dir):
+        return (fastqc_out_dir,
+                get_fastqc_summary_for_project(fastqc_out_dir, samplesheet))
+
+    def _submit(proj_id, fastq_files):
+        if scheduler is None:
+            return None
+
+        proj_path = get_project_path(proj_id, bcl2fastq_output_dir)
+        if exists(get_fastqc_output_directory(proj_path)):
+            return None
+
+        output_directory = _prepare_fastqc_output_directory(
+            proj_path,
+            output_directory=create_tmp_dir())
+        if output_directory is None:
+            return None
+
+        return scheduler.submit_project(fastq_files,
+                                        output_directory,
+                                        on_complete=_summarize)
+
+    pending = deque()
+    for proj_id, fastq_files in project_fastq_mapping.items():
+        pending.append((proj_id, fastq_files, _submit(proj_id, fastq_files)))
+        if len(pending) > depth:
+            yield pending.popleft()
+
+    while pending:
+        yield pending.popleft()
+
+
 def add_suffix_to_parameter_set(parameters, suffix, divider='__'):
     """
     Adds a suffix ('__suffix') to the keys of a dictionary of MyTardis
@@ -488,127 +585,339 @@ def register_project_fastq_datafiles(run_id,
                                      dataset_url,
                                      uploader,
                                      fastqc_data=None,
-                                     fast_mode=False):
-
-    sample_dict = samplesheet_to_dict(samplesheet)
+                                     fast_mode=False,
+                                     threads=1,
+                                     decompress_threads=1,
+                                     metadata_cache=None,
+                                     run_journal=None,
+                                     fastq_records=None,
+                                     checksum_sidecars=None,
+                                     checksum_queue=None):
+    """
+    Registers (or uploads) the FASTQ files for a project as Datafiles in the
+    given Dataset.
+
+    Metadata for each file is assembled in order in the calling thread, while
+    the time consuming steps (counting reads, checksumming and the
+    dataset_file request) run in a pool of 'threads' workers. Logging remains
+    in the order of fastq_files. If any file fails, remaining work is
+    cancelled and the exception is raised.
+
+    In shared storage mode the Datafiles are registered in batches of
+    uploader.datafile_batch_size, rather than one request per file.
+
+    :type run_id: str
+    :type fastq_files: list[str]
+    :type samplesheet: illumina.run_info.SampleSheet
+    :type dataset_url: str
+    :type uploader: mytardis_uploader.MyTardisUploader
+    :type fastqc_data: illumina.fastqc.FastqcProjectSummary | dict
+    :type fast_mode: bool
+    :param threads: The number of files to process concurrently.
+    :type threads: int
+    :param decompress_threads: The number of threads used to decompress
+                               each (BGZF) FASTQ file when calculating
+                               read statistics.
+    :type decompress_threads: int
+    :param metadata_cache: An optional cache of checksums and read
+                           statistics from previous runs, so these are only
+                           calculated for new or modified files.
+    :type metadata_cache: utils.file_cache.FileMetadataCache
+    :param run_journal: An optional journal where each registered Datafile
+                        is recorded. FASTQ files already recorded there are
+                        skipped.
+    :type run_journal: utils.journal.IngestJournal
+    :param fastq_records: An optional dictionary of records from
+                          get_fastq_inventory, keyed by FASTQ path, so
+                          files that were already stat'd and had their
+                          filenames parsed aren't stat'd or parsed again.
+    :type fastq_records: dict[str, illumina.run_info.FastqFileRecord]
+    :param checksum_sidecars: If given, checksums already written alongside
+                              FASTQ files (eg by the demultiplexing
+                              pipeline) are used rather than hashing the
+                              files again.
+    :type checksum_sidecars: utils.checksum_sidecars.ChecksumSidecars
+    :param checksum_queue: If given, Datafiles that would need to be hashed
+                           are registered with pending checksums and queued
+                           here, to be set later by backfill_checksums.
+    :type checksum_queue: utils.journal.IngestJournal
+    """
+    if fastq_records is None:
+        fastq_records = {}
 
-    # Upload datafiles for the FASTQ reads in the project,
-    # for each Sample_ directory
-    for fastq_path in fastq_files:
+    # indexed by FASTQ filename, for constant time lookups per file
+    if not isinstance(fastqc_data, fastqc.FastqcProjectSummary):
+        fastqc_data = fastqc.FastqcProjectSummary(fastqc_data or {})
 
-            sample_id = get_sample_id_from_fastq_filename(fastq_path)
+    batch_size = 1
+    if uploader.storage_mode == 'shared':
+        batch_size = uploader.datafile_batch_size
 
-            # sample_name may not be in the SampleSheet dict
-            # if we are dealing the unaligned reads (eg sample_names
-            # lane1, lane2 etc)
-            # So, we grab either the info for the sample_name, or
-            # we use an empty dict (where all params will then be
-            # the default missing values)
+    def _prepare(fastq_path):
+        """
+        Assemble the parameters for a single FASTQ file. Returns None if
+        the file should be skipped.
+        """
+        sample_id = get_sample_id_from_fastq_filename(fastq_path)
+
+        # sample_name may not be in the SampleSheet dict
+        # if we are dealing the unaligned reads (eg sample_names
+        # lane1, lane2 etc)
+        # So, we grab either the info for the sample_name, or
+        # we use an empty dict (where all params will then be
+        # the default missing values)
+
+        # TODO: ensure we can also deal with unbarcoded runs,
+        #       where Index is "NoIndex" and sample_names are
+        #       lane1, lane2 etc.
+
+        # the read number isn't encoded in SampleSheet.csv, so we
+        # extract it from the FASTQ filename instead
+        record = fastq_records.get(fastq_path, None)
+        if record is not None:
+            info_from_fn = record.fields
+        else:
+            info_from_fn = parse_sample_info_from_filename(fastq_path)
+        if info_from_fn is not None:
+            read = info_from_fn.get('read', None)
+            sample_name = info_from_fn.get('sample_name', None)
+        else:
+            logger.warning("Unrecognized FASTQ filename pattern - "
+                           "skipping: %s", fastq_path)
+            return None
 
-            # TODO: ensure we can also deal with unbarcoded runs,
-            #       where Index is "NoIndex" and sample_names are
-            #       lane1, lane2 etc.
+        sampleinfo = samplesheet.find_sample(
+            sample_name,
+            lane=info_from_fn.get('lane', None)) or \
+            samplesheet.find_sample(sample_name) or {}
+
+        reference_genome = sampleinfo.get('SampleRef', '')
+        index_sequence = samplesheet.get_index_sequence(sampleinfo)
+        is_control = sampleinfo.get('Control', '')
+        recipe = sampleinfo.get('Recipe', '')
+        operator = sampleinfo.get('Operator', '')
+        description = sampleinfo.get('Description', '')
+        project = sampleinfo.get('SampleProject', '')
+        lane = sampleinfo.get('Lane', None)
+        if lane is not None:
+            lane = int(lane)
+        # flowcell ID is already attached to the Dataset metadata
+        # and can be inferrd from the sample_id, so we don't make
+        # a special field for it
+        # fcid = sampleinfo.get('FCID')
+
+        parameters = {'run_id': run_id,
+                      'sample_id': sample_id,
+                      'sample_name': sample_name,
+                      'reference_genome': reference_genome,
+                      'index_sequence': index_sequence,
+                      'is_control': is_control,
+                      'recipe': recipe,
+                      'operator_name': operator,
+                      'description': description,
+                      'project': project,
+                      'lane': lane,
+                      'read': read,
+                      }
+
+        calculate_stats = False
+        # grab the FastQC data for just this FASTQ file
+        sample_fqcdata = fastqc_data.get_sample_by_filename(
+            os.path.basename(fastq_path))
+        if sample_fqcdata is not None:
+            basic_stats = sample_fqcdata['basic_stats']
+            parameters.update(basic_stats)
+        elif not fast_mode:
+            # If there is no FastQC data with read counts etc for
+            # this sample (eg for Undetermined_indicies) we calculate
+            # our own
+            logger.info("Calculating number of reads, read length and "
+                        "%%GC for: %s", fastq_path)
+            calculate_stats = True
+
+        return parameters, calculate_stats
+
+    def _register(job):
+        fastq_path, parameters, calculate_stats = job
+        record = fastq_records.get(fastq_path, None)
+
+        digests = None  # will be calculated
+        # checksums from the pipeline, chosen to be verified by hashing
+        unverified_digests = None
+        if not fast_mode:
+            stat = record.stat if record is not None else \
+                os.stat(fastq_path)
+        if fast_mode:
+            digests = {'md5': '__undetermined__'}
+        elif checksum_sidecars is not None:
+            sidecar_digests = checksum_sidecars.get(fastq_path,
+                                                    uploader.digests,
+                                                    stat=stat)
+            if sidecar_digests is not None:
+                if checksum_sidecars.spot_check():
+                    unverified_digests = sidecar_digests
+                else:
+                    digests = sidecar_digests
+
+        # with deferred checksums, files are hashed later by the
+        # backfill-checksums command (unless being spot checked), and files
+        # that are uploaded are hashed as they're sent (stream_digests below)
+        hash_now = (checksum_queue is None and
+                    uploader.storage_mode != 'upload') or \
+            unverified_digests is not None
+
+        if not fast_mode and metadata_cache is not None:
+            cached = metadata_cache.get(fastq_path, stat=stat) or {}
+            if digests is None and unverified_digests is None:
+                digests = cached.get('digests', None)
+                if digests is None and 'md5sum' in cached:
+                    # cached before other digests were supported
+                    digests = {'md5': cached['md5sum']}
+                if digests is not None and \
+                        not all(a in digests for a in uploader.digests):
+                    digests = None
+            stats = cached.get('stats', None)
+            if calculate_stats and stats is not None:
+                parameters.update(stats)
+                calculate_stats = False
+            if digests is None and not calculate_stats and hash_now:
+                digests = uploader._digest_file_calc(fastq_path)
+                cached['digests'] = digests
+                metadata_cache.put(fastq_path, cached, stat=stat)
+        elif unverified_digests is not None and not calculate_stats:
+            digests = uploader._digest_file_calc(fastq_path)
+
+        if calculate_stats:
+            # read counts, read length and all the checksums in one pass
+            # over the file
+            stats, digests = get_fastq_stats(
+                fastq_path,
+                threads=decompress_threads,
+                digests=uploader.digests)
+            parameters.update(stats)
+            if metadata_cache is not None:
+                metadata_cache.put(fastq_path,
+                                   {'digests': digests, 'stats': stats},
+                                   stat=stat)
+
+        if unverified_digests is not None:
+            checksum_sidecars.verify(fastq_path, unverified_digests, digests)
+
+        checksum_pending = digests is None and checksum_queue is not None
+        if checksum_pending:
+            digests = dict((a, checksums.PENDING_CHECKSUM)
+                           for a in uploader.digests)
+
+        fq_datafile = DataFile()
+        datafile_params = FastqRawReads()
+        datafile_params.from_dict(parameters, existing_only=True)
+        fq_datafile.parameters = datafile_params
+        datafile_parameter_sets = fq_datafile.package_parameter_sets()
+
+        replica_url = fastq_path
+        if uploader.storage_mode == 'shared':
+            replica_url = get_shared_storage_replica_url(
+                uploader.storage_box_location,
+                fastq_path)
+
+        pending_checksum = None
+        if checksum_pending:
+            pending_checksum = {'digests': list(uploader.digests),
+                                'size': stat.st_size,
+                                'mtime': stat.st_mtime}
+
+        # any digests we don't have yet are calculated while the file is
+        # uploaded, so it's only read once
+        stream_digests = []
+        if uploader.storage_mode == 'upload' and not fast_mode:
+            stream_digests = [a for a in uploader.digests
+                              if a not in (digests or {})]
 
-            # the read number isn't encoded in SampleSheet.csv, so we
-            # extract it from the FASTQ filename instead
-            info_from_fn = parse_sample_info_from_filename(fastq_path)
-            if info_from_fn is not None:
-                read = info_from_fn.get('read', None)
-                sample_name = info_from_fn.get('sample_name', None)
-            else:
-                logger.warning("Unrecognized FASTQ filename pattern - "
-                               "skipping: %s", fastq_path)
+        try:
+            file_dict = uploader.datafile_dict(
+                fastq_path,
+                dataset_url,
+                parameter_sets_list=datafile_parameter_sets,
+                replica_url=replica_url,
+                digests=digests,
+                file_size=record.size if record is not None else None,
+                calculate_digests=not stream_digests,
+            )
+            if batch_size > 1:
+                # registered by the calling thread, with the rest of the batch
+                return file_dict, pending_checksum
+
+            datafile_url = uploader._register_datafile(
+                file_dict,
+                file_path=fastq_path,
+                stream_digests=stream_digests)
+            _registered(fastq_path, datafile_url, pending_checksum)
+            return datafile_url
+        except (Exception, SystemExit) as ex:
+            logger.error("Failed to register Datafile: "
+                         "%s", fastq_path)
+            logger.debug("Exception: %s", ex)
+            raise
+
+    def _registered(fastq_path, datafile_url, pending_checksum):
+        if run_journal is not None:
+            run_journal.record('fastq_datafile', datafile_url,
+                               name=fastq_path)
+        if pending_checksum is not None:
+            pending_checksum = dict(pending_checksum, datafile=datafile_url)
+            checksum_queue.record('pending_checksum', pending_checksum,
+                                  name=fastq_path)
+
+    def _jobs():
+        for fastq_path in fastq_files:
+            if run_journal is not None and \
+                    run_journal.is_complete('fastq_datafile',
+                                            name=fastq_path):
+                logger.info("Skipping Datafile already added: %s (%s)",
+                            fastq_path,
+                            run_journal.get('fastq_datafile',
+                                            name=fastq_path))
                 continue
+            prepared = _prepare(fastq_path)
+            if prepared is not None:
+                parameters, calculate_stats = prepared
+                yield fastq_path, parameters, calculate_stats
 
-            sampleinfo = sample_dict.get(sample_name, {})
-
-            reference_genome = sampleinfo.get('SampleRef', '')
-            index_sequence = sampleinfo.get('Index', '')
-            is_control = sampleinfo.get('Control', '')
-            recipe = sampleinfo.get('Recipe', '')
-            operator = sampleinfo.get('Operator', '')
-            description = sampleinfo.get('Description', '')
-            project = sampleinfo.get('SampleProject', '')
-            lane = sampleinfo.get('Lane', None)
-            if lane is not None:
-                lane = int(lane)
-            # flowcell ID is already attached to the Dataset metadata
-            # and can be inferrd from the sample_id, so we don't make
-            # a special field for it
-            # fcid = sampleinfo.get('FCID')
-
-            parameters = {'run_id': run_id,
-                          'sample_id': sample_id,
-                          'sample_name': sample_name,
-                          'reference_genome': reference_genome,
-                          'index_sequence': index_sequence,
-                          'is_control': is_control,
-                          'recipe': recipe,
-                          'operator_name': operator,
-                          'description': description,
-                          'project': project,
-                          'lane': lane,
-                          'read': read,
-                          }
-
-            fqc_completed_list = []
-            if fastqc_data:
-                fqc_completed_list = [s['filename']
-                                      for s in fastqc_data.get('samples', [])]
-
-            filename = os.path.basename(fastq_path)
-            if filename in fqc_completed_list:
-                # grab the FastQC data for just this FASTQ file
-                sample_fqcdata = next((s for s in fastqc_data['samples'] if
-                                       s['filename'] == filename), None)
-                basic_stats = sample_fqcdata['basic_stats']
-                parameters.update(basic_stats)
-            elif not fast_mode:
-                # If there is no FastQC data with read counts etc for
-                # this sample (eg for Undetermined_indicies) we calculate
-                # our own
-                logger.info("Calculating number of reads for: %s",
-                            fastq_path)
-                parameters['number_of_reads'] = \
-                    get_number_of_reads_fastq(fastq_path)
-                logger.info("Calculating read length for: %s", fastq_path)
-                parameters['read_length'] = \
-                    get_read_length_fastq(fastq_path)
-
-            fq_datafile = DataFile()
-            datafile_params = FastqRawReads()
-            datafile_params.from_dict(parameters, existing_only=True)
-            fq_datafile.parameters = datafile_params
-            datafile_parameter_sets = fq_datafile.package_parameter_sets()
-
-            replica_url = fastq_path
-            if uploader.storage_mode == 'shared':
-                replica_url = get_shared_storage_replica_url(
-                    uploader.storage_box_location,
-                    fastq_path)
+    batch = []
 
-            if fast_mode:
-                md5_checksum = '__undetermined__'
-            else:
-                md5_checksum = None  # will be calculated
+    def _register_batch():
+        def _batch_registered(i, datafile_url):
+            # recorded as they're created, so if a later Datafile in the
+            # batch fails, resuming doesn't register these again
+            fastq_path, _, pending_checksum = batch[i]
+            _registered(fastq_path, datafile_url, pending_checksum)
+            logger.info("Added Datafile: %s (%s)", fastq_path, dataset_url)
 
-            try:
-                uploader.upload_file(
-                    fastq_path,
-                    dataset_url,
-                    parameter_sets_list=datafile_parameter_sets,
-                    replica_url=replica_url,
-                    md5_checksum=md5_checksum,
-                )
-            except Exception as ex:
-                logger.error("Failed to register Datafile: "
-                             "%s", fastq_path)
-                logger.debug("Exception: %s", ex)
-                raise ex
+        try:
+            uploader.register_datafiles(
+                [file_dict for _, file_dict, _ in batch],
+                on_registered=_batch_registered)
+        except (Exception, SystemExit) as ex:
+            logger.error("Failed to register Datafiles: %s",
+                         ', '.join(fastq_path for fastq_path, _, _ in batch))
+            logger.debug("Exception: %s", ex)
+            raise
+        del batch[:]
 
+    # Upload datafiles for the FASTQ reads in the project,
+    # for each Sample_ directory
+    for job, result in imap_ordered(_register, _jobs(), threads=threads):
+        if batch_size > 1:
+            file_dict, pending_checksum = result
+            batch.append((job[0], file_dict, pending_checksum))
+            if len(batch) >= batch_size:
+                _register_batch()
+        else:
             logger.info("Added Datafile: %s (%s)",
-                        fastq_path,
+                        job[0],
                         dataset_url)
+    if batch:
+        _register_batch()
 
 
 def get_sample_id_from_fastqc_zip_filename(filepath):
@@ -655,7 +964,7 @@ def register_project_fastqc_datafiles(run_id,
     for fastqc_zip_path in get_fastqc_zip_files(fastqc_out_dir):
 
             fastqc_version = \
-                fastqc.parse_data_txt(fastqc_zip_path)['fastqc_version']
+                fastqc.get_fastqc_result(fastqc_zip_path).fastqc_version
             sample_id = get_sample_name_from_fastqc_filename(fastqc_zip_path)
             parameters = {'run_id': run_id,
                           'project': proj_id,
@@ -721,28 +1030,39 @@ def upload_fastqc_reports(fastqc_out_dir, dataset_url, uploader):
     """
 
     for fastqc_zip_path in get_fastqc_zip_files(fastqc_out_dir):
-        fastqc_data_tables = fastqc.parse_data_txt(fastqc_zip_path)
-        fqc_version = fastqc_data_tables['fastqc_version']
+        fastqc_result = fastqc.get_fastqc_result(fastqc_zip_path)
+        fqc_version = fastqc_result.fastqc_version
 
         # Depending on the version of FastQC used and specific
         #       commandline options, we may or may not have an HTML
         #       report with inline (Base64) images. As such:
         #       * if html file exists & FastQC version is,
         #         >= 0.11.3, upload that file (assume inline images)
-        #       * if FastQC version is < 0.11.3, extra the zip file to /tmp,
-        #         create an inline images version, then upload that
+        #       * if FastQC version is < 0.11.3, extract the report and
+        #         its images to /tmp, create an inline images version,
+        #         then upload that
         #
         #       Currently FastQC always generates a zip file alongside
         #       any other output, irrespective of command line options.
         #       For this reason, we always just extract from the zip, since
-        #       we know it should be there
-        with TmpZipExtract(fastqc_zip_path) as tmp_path:
+        #       we know it should be there. Only the members we need are
+        #       extracted, found via the (shared) index of the zip.
+        inline_images = LooseVersion(fqc_version) >= LooseVersion('0.11.3')
+        tmp_path = mkdtemp()
+        try:
+            report_file = fastqc_result.extract_report(
+                tmp_path,
+                images=not inline_images)
+            if report_file is None:
+                logger.error("No fastqc_report.html found in: %s",
+                             fastqc_zip_path)
+                continue
+
             sample_id = get_sample_id_from_fastqc_zip_filename(fastqc_zip_path)
-            report_dir = join(tmp_path, sample_id + "_fastqc")
-            report_file = join(report_dir, 'fastqc_report.html')
+            report_dir = os.path.dirname(report_file)
             inline_report_filename = generate_fastqc_report_filename(sample_id)
             inline_report_abspath = join(report_dir, inline_report_filename)
-            if LooseVersion(fqc_version) < LooseVersion('0.11.3'):
+            if not inline_images:
                 # convert fastqc_report.html to version with inline images
                 make_html_images_inline(report_file, inline_report_abspath)
             else:
@@ -752,6 +1072,8 @@ def upload_fastqc_reports(fastqc_out_dir, dataset_url, uploader):
             logger.info("Added Datafile (FastQC report): %s (%s)",
                         inline_report_abspath,
                         dataset_url)
+        finally:
+            shutil.rmtree(tmp_path)
 
 
 def get_fastqc_summary_for_project(fastqc_out_dir, samplesheet):
@@ -787,12 +1109,12 @@ def get_fastqc_summary_for_project(fastqc_out_dir, samplesheet):
     :param fastqc_out_dir: Path of the output directory containing
                            *_fastqc.zip files.
     :type fastqc_out_dir: str
-    :param samplesheet: A list of samplesheet lines as dicts, as output by
-                        parse_samplesheet.
-    :type samplesheet: list[dict]
-    :rtype project_summary: dict
+    :param samplesheet: The parsed SampleSheet.csv.
+    :type samplesheet: illumina.run_info.SampleSheet
+    :rtype project_summary: illumina.fastqc.FastqcProjectSummary
     """
-    project_summary = {u'samples': [], u'fastqc_version': None}
+    project_summary = fastqc.FastqcProjectSummary(
+        {u'samples': [], u'fastqc_version': None})
     fqc_detailed_data = {}
 
     def find_sample_index(a):
@@ -816,56 +1138,43 @@ def get_fastqc_summary_for_project(fastqc_out_dir, samplesheet):
 
         # otherwise, fall back to finding the sample in the samplesheet
         # to get it's index
-        for i, s in enumerate(samplesheet):
-            if s['SampleID'] == a['sample_name'] and \
-                    (s.get('Index', None) == a['index'] or
-                             s.get('index', None) == a['index']) and \
-                            int(s['Lane']) == a['lane']:
-                return i
-
-        return None
+        return samplesheet.find_sample_position(a.get('sample_name', None),
+                                                lane=a.get('lane', None),
+                                                index=a.get('index', None))
 
-    def sort_fqc_sample_cmp(a, b):
+    def fqc_sample_sort_key(fastqc_zip_path):
         """
-        Sorting comparison (cmp) function to order FastQC output filenames
-        to the equivalent ordering in SampleSheet.csv
-
-        :param a: The path to a FastQC output zip file.
-        :param b: The path to a FastQC output zip file.
-        :type a: str
-        :type b: str
-        :rtype order: int
+        Sort key to order FastQC output filenames to the equivalent ordering
+        in SampleSheet.csv. Filenames are parsed once per zip, and samples
+        found via the SampleSheet indexes, so sorting stays O(N log N).
+
+        For the same sample, lanes and reads are in descending order and set
+        numbers ascending. Custom filename patterns (see
+        run_info.set_fastq_filename_patterns) needn't include these fields,
+        and any that are missing are treated as 0. Files that can't be
+        found in the SampleSheet sort last, in their original order.
+
+        :param fastqc_zip_path: The path to a FastQC output zip file.
+        :type fastqc_zip_path: str
+        :rtype: tuple
         """
-        aa = parse_sample_info_from_filename(a, '_fastqc.zip')
-        bb = parse_sample_info_from_filename(b, '_fastqc.zip')
-        ai = find_sample_index(aa)
-        bi = find_sample_index(bb)
-        if ai is None or bi is None:
-            return 0
-        if ai > bi:
-            return 1
-        if ai < bi:
-            return -1
-        if ai == bi:
-            if aa['lane'] < bb['lane']:
-                return 1
-            if aa['lane'] > bb['lane']:
-                return -1
-            if aa['lane'] == bb['lane']:
-                if aa['read'] < bb['read']:
-                    return 1
-                if aa['read'] > bb['read']:
-                    return -1
-                if aa['read'] == bb['read']:
-                    return -1 if aa['set_number'] < bb['set_number'] else 1
-
-        return 0
-
-    fastqc_zips = list(get_fastqc_zip_files(fastqc_out_dir))
-    fastqc_zips.sort(cmp=sort_fqc_sample_cmp)
+        info = parse_sample_info_from_filename(fastqc_zip_path,
+                                               '_fastqc.zip')
+        position = find_sample_index(info)
+        if position is None:
+            return (1, 0, 0, 0, 0)
+        return (0,
+                position,
+                -(info.get('lane', None) or 0),
+                -(info.get('read', None) or 0),
+                info.get('set_number', None) or 0)
+
+    fastqc_zips = sorted(get_fastqc_zip_files(fastqc_out_dir),
+                         key=fqc_sample_sort_key)
 
     for fastqc_zip_path in fastqc_zips:
-        qc_pass_fail_table_raw = fastqc.parse_summary_txt(fastqc_zip_path)
+        fastqc_result = fastqc.get_fastqc_result(fastqc_zip_path)
+        qc_pass_fail_table_raw = fastqc_result.summary
         fastq_filename = qc_pass_fail_table_raw[0][2]
         fqfile_details = parse_sample_info_from_filename(fastq_filename)
         sample_id = get_sample_id_from_fastq_filename(fastq_filename)
@@ -877,7 +1186,7 @@ def get_fastqc_summary_for_project(fastqc_out_dir, samplesheet):
             qc_pass_fail_table.append((check, result))
 
         # project_summary.append((sample_id, qc_pass_fail_table))
-        fqc_detailed_data[sample_id] = fastqc.parse_data_txt(fastqc_zip_path)
+        fqc_detailed_data[sample_id] = fastqc_result.data
         basic_stats = fastqc.extract_basic_stats(fqc_detailed_data, sample_id)
         sample_name = fqfile_details.get('sample_name', None)
         lane = fqfile_details.get('lane', None)
@@ -889,10 +1198,9 @@ def get_fastqc_summary_for_project(fastqc_out_dir, samplesheet):
         #       the actual FASTQ file and extract the index from there
         #       get the index for cases where it isn't in the filename
         if index is None:
-            for s in samplesheet:
-                if s.get('SampleName', None) == sample_name and \
-                   s.get('Lane', None) == str(lane):
-                    index = s.get('index', None) or s.get('Index', None)
+            sample = samplesheet.find_sample(sample_name, lane=lane)
+            if sample is not None:
+                index = samplesheet.get_index_sequence(sample) or None
 
         sample_data = {u'sample_id': sample_id,
                        u'sample_name': sample_name,
@@ -907,7 +1215,7 @@ def get_fastqc_summary_for_project(fastqc_out_dir, samplesheet):
                        u'illumina_sample_sheet': { },
                        }
 
-        project_summary[u'samples'].append(sample_data)
+        project_summary.add_sample(sample_data)
         project_summary[u'fastqc_version'] = \
             fqc_detailed_data[sample_id]['fastqc_version']
 
@@ -940,31 +1248,16 @@ def get_fastqc_zip_files(fastqc_out_path):
             yield fastqc_path
 
 
-def get_fastqc_output_directory(proj_path):
-    return join(proj_path, 'FastQC.out')
-
+def get_project_path(proj_id, bcl2fastq_output_dir):
+    if proj_id == 'Undetermined_indices' and \
+            undetermined_reads_in_root(bcl2fastq_output_dir):
+        return bcl2fastq_output_dir
 
-class TmpZipExtract:
-    """
-    A Context Manager class that unzips a zip file to a temporary path
-    and cleans up afterwards, when used with the 'with' statement.
-    """
-    def __init__(self, zip_file_path):
-        self.zip_file_path = zip_file_path
-        self.tmpdir = None
+    return join(bcl2fastq_output_dir, proj_id)
 
-    def __enter__(self):
-        from tempfile import mkdtemp
-        tmpdir = mkdtemp()
-        from zipfile import ZipFile
-        zf = ZipFile(self.zip_file_path)
-        zf.extractall(tmpdir)
-        self.tmpdir = tmpdir
-        return tmpdir
 
-    def __exit__(self, type, value, traceback):
-        import shutil
-        shutil.rmtree(self.tmpdir)
+def get_fastqc_output_directory(proj_path):
+    return join(proj_path, 'FastQC.out')
 
 
 def get_shared_storage_replica_url(storage_box_location, file_path):
@@ -1007,6 +1300,10 @@ def get_mytardis_seqfac_app_version(uploader):
     :return: The version string of the remote app
     :rtype: str
     """
+    version = uploader.lookups.get('app_version', uploader.tardis_app_name)
+    if version is not None:
+        return version
+
     url_template = urljoin(uploader.mytardis_url,
                            '/apps/' + uploader.tardis_app_name + '/api/%s')
     response = uploader._do_request('GET', 'version',
@@ -1018,6 +1315,8 @@ def get_mytardis_seqfac_app_version(uploader):
         raise ex
 
     version = d.get('version', None)
+    if version is not None:
+        uploader.lookups.put('app_version', uploader.tardis_app_name, version)
     return version
 
 
@@ -1117,8 +1416,7 @@ def pre_ingest_checks_instrument_run(options):
         return False
 
     try:
-        samplesheet, chemistry = parse_samplesheet(join(run_path,
-                                                        'SampleSheet.csv'))
+        get_samplesheet(join(run_path, 'SampleSheet.csv'))
     except IOError:
         logger.error("Aborting - unable to parse SampleSheet.csv file.")
         return False
@@ -1152,22 +1450,24 @@ def pre_ingest_checks_instrument_run(options):
             # sys.exit(1)
 
     # Check for zero sized .bcl files, indicative of a failed RTA transfer
-    zero_size_files = ''
     if not options.ignore_zero_sized_bcl_check:
         bcl_path = join(run_path, 'Data/Intensities/BaseCalls')
         if exists(bcl_path):
-            zero_size_files = run_command(
-                'find %s -size 0 -print | grep ".bcl(.gz)?"' % bcl_path)
+            truncated_bcls = find_truncated_files(bcl_path,
+                                                  suffixes=BCL_SUFFIXES)
+            if truncated_bcls:
+                log_truncated_files(truncated_bcls, 'BCL', bcl_path,
+                                    log_fn=logger.error)
+                logger.error("Aborting - some BCL files in %s are zero size "
+                             "or truncated. As a result, there may be issues "
+                             "with the demultiplexed FASTQ files. Use the "
+                             "flag --ignore-zero-sized-bcl-check if you "
+                             "really want to proceed.", bcl_path)
+                return False
         else:
             logger.warning('No Data/Intensities/BaseCalls directory found. '
                            'Skipping zero-sized bcl sanity check.')
 
-    if zero_size_files.strip():
-        logger.error("Aborting - some BCL files in %s are zero size."
-                     "As a result, there may be issues with the demultiplexed "
-                     "FASTQ files. Use the flag --ignore-zero-sized-bcl-check "
-                     "if you really want to proceed.")
-
     # Check for keyword '[fF]ail' in <run_path>/Data/RTALogs/*, indicative
     # of a failed transfer
     rtalogs_path = None
@@ -1177,13 +1477,23 @@ def pre_ingest_checks_instrument_run(options):
         rtalogs_path = join(run_path, 'RTALogs')
 
     if rtalogs_path:
-        fail_logs = run_command(
-            'grep [fF]ail %s/*' % rtalogs_path)
-
-        if fail_logs.strip():
-            logger.warn("WARNING - logs in Data/RTALogs contain failure "
-                        "messages: %s", p_path)
-            # return False
+        failure_hits = scan_rta_logs(
+            rtalogs_path,
+            patterns=options.rtalogs_failure_patterns,
+            processes=int(options.threads or 1))
+
+        if failure_hits:
+            for hit in failure_hits:
+                logger.warning("%s:%d: %s", os.path.basename(hit.file),
+                               hit.line_number, hit.line)
+            if options.abort_on_rtalogs_failures:
+                logger.error("Aborting - %d lines in logs in %s contain "
+                             "failure messages.",
+                             len(failure_hits), rtalogs_path)
+                return False
+            logger.warning("WARNING - %d lines in logs in %s contain "
+                           "failure messages.",
+                           len(failure_hits), rtalogs_path)
     else:
         logger.warn("WARNING - RTALogs or Data/RTALogs directory not found.")
 
@@ -1205,80 +1515,239 @@ def pre_ingest_checks_fastq_only(options):
                          bcl2fastq_output_dir)
             return False
 
-    zero_size_fastqs = run_command(
-            'find %s -size 0 -print | grep ".fastq(.gz)?"' %
-            bcl2fastq_output_dir)
-
-    if zero_size_fastqs.strip():
+    truncated_fastqs = find_truncated_files(bcl2fastq_output_dir,
+                                            suffixes=FASTQ_SUFFIXES)
+    if truncated_fastqs:
+        log_truncated_files(truncated_fastqs, 'FASTQ', bcl2fastq_output_dir)
         logger.warning("Some .fastq(.gz) files are zero size.")
 
     return True
 
 
+def log_truncated_files(truncated_files, file_type, basepath,
+                        log_fn=None):
+    """
+    Logs a summary per lane of the files found by find_truncated_files.
+
+    :param truncated_files: Relative paths of files, by lane number.
+    :type truncated_files: dict[int, list[str]]
+    :param file_type: Eg 'BCL', 'FASTQ'.
+    :type file_type: str
+    :param basepath: The directory the paths are relative to.
+    :type basepath: str
+    :param log_fn: The logging function (default logger.warning).
+    :type log_fn: types.FunctionType
+    """
+    if log_fn is None:
+        log_fn = logger.warning
+    for lane, files in truncated_files.items():
+        lane_label = ('Lane %s' % lane) if lane is not None else 'No lane'
+        log_fn("%s: %d %s files are zero size or truncated in %s, "
+               "eg: %s", lane_label, len(files), file_type, basepath,
+               ', '.join(files[:3]))
+
+
+def add_ingest_config_args(argparser):
+    """
+    Adds the options specific to ingesting Illumina runs to an argument
+    parser (used with mytardis_uploader.get_config).
+
+    :type argparser: argparse.ArgumentParser
+    """
+    argparser.add_argument('--fastq-only',
+                           dest='fastq_only',
+                           action='store_true',
+                           help="Ingest just the FASTQ files and "
+                                "ignore any instrument / run specific "
+                                "files or metadata extraction. FastQC "
+                                "reports are generated if the --run-fastqc"
+                                "flag is also given.")
+    argparser.add_argument('--threads',
+                           dest='threads',
+                           type=int,
+                           metavar='THREADS')
+    argparser.add_argument('--datafile-threads',
+                           dest='datafile_threads',
+                           type=int,
+                           default=1,
+                           metavar='DATAFILE_THREADS',
+                           help="The number of FASTQ files to checksum, "
+                                "count reads for and register with the "
+                                "server concurrently.")
+    argparser.add_argument('--cache-dir',
+                           dest='cache_dir',
+                           type=str,
+                           default=None,
+                           metavar='CACHE_DIR',
+                           help="A directory to cache checksums and read "
+                                "statistics of FASTQ files in, so they "
+                                "aren't recalculated for unchanged files "
+                                "when a run is ingested again.")
+    argparser.add_argument('--cache-max-entries',
+                           dest='cache_max_entries',
+                           type=int,
+                           default=file_cache.DEFAULT_MAX_ENTRIES,
+                           metavar='CACHE_MAX_ENTRIES',
+                           help="The maximum number of files in the "
+                                "cache. Least recently used entries are "
+                                "evicted beyond this.")
+    argparser.add_argument('--clear-cache',
+                           dest='clear_cache',
+                           action='store_true',
+                           help="Remove all entries from the cache "
+                                "(--cache-dir) before ingesting.")
+    argparser.add_argument('--pipeline-depth',
+                           dest='pipeline_depth',
+                           type=int,
+                           default=DEFAULT_PIPELINE_DEPTH,
+                           metavar='PIPELINE_DEPTH',
+                           help="The number of projects to run FastQC "
+                                "on ahead of the project currently "
+                                "being registered with the server.")
+    argparser.add_argument('--resume',
+                           dest='resume',
+                           action='store_true',
+                           help="Resume a previous failed ingestion of "
+                                "the run, skipping the Experiments, "
+                                "Datasets and Datafiles recorded in "
+                                "its journal as already created.")
+    argparser.add_argument('--restart',
+                           dest='restart',
+                           action='store_true',
+                           help="Discard the journal of a previous failed "
+                                "ingestion of the run and start again "
+                                "from scratch.")
+    argparser.add_argument('--journal-dir',
+                           dest='journal_dir',
+                           type=str,
+                           default=None,
+                           metavar='JOURNAL_DIR',
+                           help="The directory where the journal of "
+                                "each ingestion is written (default: "
+                                "CACHE_DIR if set, otherwise the system "
+                                "temporary directory).")
+    argparser.add_argument('--fastq-filename-patterns',
+                           dest='fastq_filename_patterns',
+                           nargs='+',
+                           default=None,
+                           metavar='FASTQ_FILENAME_PATTERNS',
+                           help="Patterns used to parse the sample "
+                                "name, lane, read etc from FASTQ "
+                                "filenames (without the .fastq.gz "
+                                "suffix), tried in order. Either Python "
+                                "regexes with named groups, or using "
+                                "{sample_name}, {undetermined_sample_"
+                                "name}, {index}, {lane}, {read}, "
+                                "{set_number} and {sample_number}.")
+    argparser.add_argument('--rtalogs-failure-patterns',
+                           dest='rtalogs_failure_patterns',
+                           nargs='+',
+                           default=None,
+                           metavar='RTALOGS_FAILURE_PATTERNS',
+                           help="Python regexes matching lines in the "
+                                "RTALogs that indicate a failed run or "
+                                "transfer (default: 'fail', 'Fail').")
+    argparser.add_argument('--abort-on-rtalogs-failures',
+                           dest='abort_on_rtalogs_failures',
+                           action='store_true',
+                           help="Don't ingest the run if any lines in "
+                                "the RTALogs match the failure "
+                                "patterns, rather than just logging "
+                                "them.")
+    argparser.add_argument('--defer-checksums',
+                           dest='defer_checksums',
+                           action='store_true',
+                           help="Register FASTQ Datafiles without "
+                                "waiting for their checksums, which are "
+                                "queued in JOURNAL_DIR (or CACHE_DIR) "
+                                "and set later by the backfill-checksums "
+                                "command. Only with --storage-mode "
+                                "shared.")
+    argparser.add_argument('--trust-checksum-files',
+                           dest='trust_checksum_files',
+                           action='store_true',
+                           help="Use checksums already written next to "
+                                "FASTQ files (eg reads.fastq.gz.md5, or "
+                                "md5sum-style manifests) rather than "
+                                "hashing the files again. Checksum files "
+                                "older than the file they describe are "
+                                "ignored.")
+    argparser.add_argument('--checksum-manifest-names',
+                           dest='checksum_manifest_names',
+                           nargs='+',
+                           default=list(
+                               checksum_sidecars.DEFAULT_MANIFEST_NAMES),
+                           metavar='CHECKSUM_MANIFEST_NAMES',
+                           help="The filenames of md5sum-style "
+                                "manifests, looked for in the directory "
+                                "of each FASTQ file and its parent.")
+    argparser.add_argument('--checksum-spot-check-fraction',
+                           dest='checksum_spot_check_fraction',
+                           type=float,
+                           default=checksum_sidecars.
+                           DEFAULT_SPOT_CHECK_FRACTION,
+                           metavar='CHECKSUM_SPOT_CHECK_FRACTION',
+                           help="The fraction of files with trusted "
+                                "checksums that are hashed anyway to "
+                                "verify them (0.0 - 1.0).")
+    argparser.add_argument('--run-fastqc',
+                           dest='run_fastqc',
+                           type=bool,
+                           default=False,
+                           metavar='RUN_FASTQC')
+    argparser.add_argument('--fastqc-bin',
+                           dest='fastqc_bin',
+                           type=str,
+                           metavar='FASTQC_BIN')
+    argparser.add_argument('--bcl2fastq-output-path',
+                           dest='bcl2fastq_output_path',
+                           default='{run_path}/Data/Intensities/BaseCalls',
+                           type=str,
+                           metavar='BCL2FASTQ_OUTPUT_PATH',
+                           help='The path to the bcl2fastq output '
+                                '(fastq.gz files in project/sample '
+                                'directories). The template strings '
+                                '{run_path} and {run_id} can be used to '
+                                'specify a path relative to the run '
+                                'folder, or another path that includes the '
+                                'run_id.')
+    argparser.add_argument('--dump-fixtures',
+                           dest='dump_fixtures',
+                           action='store_true')
+    argparser.add_argument('--live-storage-box-name',
+                           dest='live_storage_box_name',
+                           default='live',
+                           type=str,
+                           metavar='LIVE_STORAGE_BOX_NAME')
+    argparser.add_argument('--replace-duplicate-runs',
+                           dest='replace_duplicate_runs',
+                           type=bool,
+                           default=False,
+                           metavar='REPLACE_DUPLICATE_RUNS')
+    argparser.add_argument('--ignore-zero-sized-bcl-check',
+                           dest='ignore_zero_sized_bcl_check',
+                           type=bool,
+                           default=False,
+                           metavar='IGNORE_ZERO_SIZED_BCL_CHECK')
+
+
 def ingest_run(run_path=None):
     global logger
     logger = setup_logging()
     # set logger for these modules to our logger
     run_info.logger = logger
     fastqc.logger = logger
+    checksums.logger = logger
+    file_cache.logger = logger
+    journal.logger = logger
+    inventory.logger = logger
+    checksum_sidecars.logger = logger
+    lookup_cache.logger = logger
 
     global TMPDIRS
     TMPDIRS = []
 
-    def extra_config_options(argparser):
-        argparser.add_argument('--fastq-only',
-                               dest='fastq_only',
-                               action='store_true',
-                               help="Ingest just the FASTQ files and "
-                                    "ignore any instrument / run specific "
-                                    "files or metadata extraction. FastQC "
-                                    "reports are generated if the --run-fastqc"
-                                    "flag is also given.")
-        argparser.add_argument('--threads',
-                               dest='threads',
-                               type=int,
-                               metavar='THREADS')
-        argparser.add_argument('--run-fastqc',
-                               dest='run_fastqc',
-                               type=bool,
-                               default=False,
-                               metavar='RUN_FASTQC')
-        argparser.add_argument('--fastqc-bin',
-                               dest='fastqc_bin',
-                               type=str,
-                               metavar='FASTQC_BIN')
-        argparser.add_argument('--bcl2fastq-output-path',
-                               dest='bcl2fastq_output_path',
-                               default='{run_path}/Data/Intensities/BaseCalls',
-                               type=str,
-                               metavar='BCL2FASTQ_OUTPUT_PATH',
-                               help='The path to the bcl2fastq output '
-                                    '(fastq.gz files in project/sample '
-                                    'directories). The template strings '
-                                    '{run_path} and {run_id} can be used to '
-                                    'specify a path relative to the run '
-                                    'folder, or another path that includes the '
-                                    'run_id.')
-        argparser.add_argument('--dump-fixtures',
-                               dest='dump_fixtures',
-                               action='store_true')
-        argparser.add_argument('--live-storage-box-name',
-                               dest='live_storage_box_name',
-                               default='live',
-                               type=str,
-                               metavar='LIVE_STORAGE_BOX_NAME')
-        argparser.add_argument('--replace-duplicate-runs',
-                               dest='replace_duplicate_runs',
-                               type=bool,
-                               default=False,
-                               metavar='REPLACE_DUPLICATE_RUNS')
-        argparser.add_argument('--ignore-zero-sized-bcl-check',
-                               dest='ignore_zero_sized_bcl_check',
-                               type=bool,
-                               default=False,
-                               metavar='IGNORE_ZERO_SIZED_BCL_CHECK')
-
-    parser, options = get_config(add_extra_options_fn=extra_config_options)
+    parser, options = get_config(add_extra_options_fn=add_ingest_config_args)
 
     if options.dump_fixtures:
         dump_schema_fixtures_as_json()
@@ -1286,6 +1755,45 @@ def ingest_run(run_path=None):
 
     validate_config(parser, options)
 
+    if options.defer_checksums and options.storage_mode != 'shared':
+        parser.error("--defer-checksums requires --storage-mode shared")
+    if options.defer_checksums and not (options.journal_dir or
+                                        options.cache_dir):
+        # the queue of pending checksums must outlive the ingestion, so
+        # can't go in the temporary directory
+        parser.error("--defer-checksums requires --journal-dir or "
+                     "--cache-dir")
+
+    if options.fastq_filename_patterns:
+        run_info.set_fastq_filename_patterns(options.fastq_filename_patterns)
+
+    metadata_cache = None
+    if options.cache_dir:
+        metadata_cache = file_cache.FileMetadataCache(
+            options.cache_dir,
+            max_entries=options.cache_max_entries)
+        if options.clear_cache:
+            metadata_cache.invalidate()
+            logger.info("Cleared cache: %s", metadata_cache.db_path)
+
+    # Instruments, groups, users etc looked up on the server, kept between
+    # runs in the cache directory
+    lookups_path = None
+    if options.cache_dir:
+        lookups_path = join(options.cache_dir,
+                            lookup_cache.DEFAULT_LOOKUP_CACHE_FILENAME)
+    lookups = lookup_cache.LookupCache(ttl=options.lookup_cache_ttl,
+                                       cache_path=lookups_path,
+                                       namespace=options.url)
+    if options.clear_cache:
+        lookups.invalidate()
+
+    sidecars = None
+    if options.trust_checksum_files and not options.fast:
+        sidecars = checksum_sidecars.ChecksumSidecars(
+            manifest_names=options.checksum_manifest_names,
+            spot_check_fraction=options.checksum_spot_check_fraction)
+
     # Before creating any records on the server we first check that certain
     # prerequisite files exist, that the run is complete and is generally in a
     # 'sane' state suitable for ingestion.
@@ -1296,6 +1804,9 @@ def ingest_run(run_path=None):
     # exclude_patterns = \
     #     get_exclude_patterns_as_regex_list(options.exclude)
 
+    # Each worker thread registering datafiles may hold a connection
+    pool_size = max(options.connection_pool_size, options.datafile_threads)
+
     uploader = MyTardisUploader(
         options.url,
         options.username,
@@ -1306,6 +1817,12 @@ def ingest_run(run_path=None):
         storage_box_name=options.storage_box_name,
         verify_certificate=options.verify_certificate,
         fast_mode=options.fast,
+        pool_maxsize=pool_size,
+        digests=options.digests,
+        datafile_batch_size=options.datafile_batch_size,
+        lookups=lookups,
+        upload_chunk_size=options.upload_chunk_size,
+        streamed_checksums=options.streamed_checksums,
     )
 
     # This uploader instance is associated with a MyTardis storage box
@@ -1324,6 +1841,11 @@ def ingest_run(run_path=None):
         storage_box_name=options.live_storage_box_name,
         verify_certificate=options.verify_certificate,
         fast_mode=options.fast,
+        pool_maxsize=options.connection_pool_size,
+        digests=options.digests,
+        lookups=lookups,
+        upload_chunk_size=options.upload_chunk_size,
+        streamed_checksums=options.streamed_checksums,
     )
 
     # this custom attribute on the uploader is the name of the
@@ -1333,6 +1855,10 @@ def ingest_run(run_path=None):
 
     ingestor_version = mytardis_uploader.__version__
     seqfac_app_version = get_mytardis_seqfac_app_version(uploader)
+    if not is_server_version_compatible(ingestor_version, seqfac_app_version):
+        # the server may have been upgraded since the version was cached
+        lookups.invalidate('app_version')
+        seqfac_app_version = get_mytardis_seqfac_app_version(uploader)
     logger.info("Verifying MyTardis server app '%s' matches the ingestor "
                 "version (%s)." % (uploader.tardis_app_name,
                                    ingestor_version))
@@ -1355,6 +1881,33 @@ def ingest_run(run_path=None):
     # run_id = get_run_id_from_path(run_path)
     run_id = run_expt.parameters.run_id
 
+    # Each server object is recorded in the journal as it's created, so a
+    # failed ingestion can be continued with --resume
+    journal_dir = options.journal_dir or options.cache_dir or gettempdir()
+    journal_path = join(journal_dir, '%s.journal' % run_id)
+    if exists(journal_path) and not (options.resume or options.restart):
+        logger.error("A journal of a previous failed ingestion of this run "
+                     "exists: %s. Use --resume to continue that ingestion, "
+                     "or --restart to discard it.", journal_path)
+        sys.exit(1)
+
+    # A journal being resumed is loaded now, so the Experiments it created
+    # aren't treated as duplicates. Otherwise it's created after the
+    # duplicate check, so a run that turns out to be a duplicate leaves
+    # any existing journal alone.
+    run_journal = None
+    if options.resume:
+        run_journal = journal.IngestJournal(journal_path, resume=True)
+
+    # Datafiles registered before their checksums are calculated, for
+    # the backfill-checksums command. Unlike the run journal, this
+    # outlives the ingestion.
+    checksum_queue = None
+    if options.defer_checksums:
+        checksum_queue = journal.IngestJournal(
+            join(journal_dir, '%s%s' % (run_id, CHECKSUM_QUEUE_SUFFIX)),
+            resume=True)
+
     duplicate_runs = get_experiments_from_server_by_run_id(
         uploader, run_id,
         'http://www.tardis.edu.au/schemas/ngs/run/illumina')
@@ -1362,6 +1915,18 @@ def ingest_run(run_path=None):
         uploader, run_id,
         'http://www.tardis.edu.au/schemas/ngs/project')
 
+    # Experiments created by the ingestion we are resuming aren't duplicates
+    resumed_expt_urls = []
+    if run_journal is not None:
+        resumed_expt_urls = [run_journal.get('run_experiment')] + \
+            run_journal.values('project_experiment')
+    resumed_expt_ids = [uploader._resource_uri_to_id(url)
+                        for url in resumed_expt_urls if url]
+    duplicate_runs = [i for i in duplicate_runs
+                      if i not in resumed_expt_ids]
+    duplicate_projects = [i for i in duplicate_projects
+                          if i not in resumed_expt_ids]
+
     if duplicate_runs or duplicate_projects:
         matching = [str(i) for i in duplicate_runs]
         matching += [str(i) for i in duplicate_projects]
@@ -1374,6 +1939,9 @@ def ingest_run(run_path=None):
                          "ingesting: %s (%s)", run_id, ', '.join(matching))
             raise Exception()
 
+    if run_journal is None:
+        run_journal = journal.IngestJournal(journal_path)
+
     # The directory where bcl2fastq puts its output,
     # in Project_* directories
     bcl2fastq_output_dir = get_bcl2fastq_output_dir(options,
@@ -1394,45 +1962,78 @@ def ingest_run(run_path=None):
                                 run_id,
                                 datetime.now().isoformat(' '))
 
-    try:
-        run_expt_url = create_experiment_on_server(run_expt, uploader)
+    run_expt_url = run_journal.get('run_experiment')
+    if run_expt_url:
+        logger.info("Skipping Run Experiment already created: %s (%s)",
+                    run_id,
+                    run_expt_url)
+    else:
+        try:
+            run_expt_url = create_experiment_on_server(run_expt, uploader)
 
-        # Take just the path of the experiment, eg /api/v1/experiment/187/
-        run_expt_url = urlparse(run_expt_url).path
+            # Take just the path of the experiment, eg /api/v1/experiment/187/
+            run_expt_url = urlparse(run_expt_url).path
+
+        except Exception as e:
+            logger.error("Failed to create Experiment for sequencing run: %s",
+                         run_path)
+            logger.error("Exception: %s: %s", type(e).__name__, e)
+            raise e
 
-        for group in options.experiment_owner_groups:
-            uploader.share_experiment_with_group(run_expt_url, group)
+        # recorded before sharing, so if sharing fails a resumed ingestion
+        # shares this Experiment rather than creating another
+        run_journal.record('run_experiment', run_expt_url)
+        logger.info("Created Run Experiment: %s (%s)",
+                    run_id,
+                    run_expt_url)
 
-    except Exception as e:
-        logger.error("Failed to create Experiment for sequencing run: %s",
-                     run_path)
-        logger.error("Exception: %s: %s", type(e).__name__, e)
-        raise e
+    if not run_journal.is_complete('run_experiment_shared'):
+        try:
+            for group in options.experiment_owner_groups:
+                uploader.share_experiment_with_group(run_expt_url, group)
+        except Exception as e:
+            logger.error("Failed to share Experiment for sequencing run: "
+                         "%s (%s)", run_path, run_expt_url)
+            logger.error("Exception: %s: %s", type(e).__name__, e)
+            raise e
 
-    logger.info("Created Run Experiment: %s (%s)",
-                run_id,
-                run_expt_url)
+        run_journal.record('run_experiment_shared')
 
     samplesheet_path = join(run_path, 'SampleSheet.csv')
-    samplesheet, chemistry = parse_samplesheet(samplesheet_path)
+    samplesheet = get_samplesheet(samplesheet_path)
 
     # Under the Run Experiment we create a Dataset with the IlluminaRunConfig
     # schema containing the SampleSheet.csv, maybe also some logs and
     # config files
-    try:
-        config_dataset_url = create_run_config_dataset_on_server(run_expt,
-                                                                 run_expt_url,
-                                                                 uploader)
-        config_dataset_url = urlparse(config_dataset_url).path
-        uploader.upload_file(samplesheet_path, config_dataset_url)
-        logger.info("Created config & logs dataset for sequencing run: %s",
-                    config_dataset_url)
-    except Exception as e:
-        logger.error("Failed to create config & logs dataset for sequencing "
-                     "run: %s",
-                     run_path)
-        logger.error("Exception: %s: %s", type(e).__name__, e)
-        raise e
+    config_dataset_url = run_journal.get('config_dataset')
+    if not config_dataset_url:
+        try:
+            config_dataset_url = create_run_config_dataset_on_server(
+                run_expt,
+                run_expt_url,
+                uploader)
+            config_dataset_url = urlparse(config_dataset_url).path
+        except Exception as e:
+            logger.error("Failed to create config & logs dataset for "
+                         "sequencing run: %s",
+                         run_path)
+            logger.error("Exception: %s: %s", type(e).__name__, e)
+            raise e
+
+        run_journal.record('config_dataset', config_dataset_url)
+        logger.info("Created config & logs dataset for sequencing run: "
+                    "%s", config_dataset_url)
+
+    if not run_journal.is_complete('config_samplesheet'):
+        try:
+            uploader.upload_file(samplesheet_path, config_dataset_url)
+        except Exception as e:
+            logger.error("Failed to upload SampleSheet.csv for sequencing "
+                         "run: %s (%s)", run_path, config_dataset_url)
+            logger.error("Exception: %s: %s", type(e).__name__, e)
+            raise e
+
+        run_journal.record('config_samplesheet')
 
     if not demultiplexer_info.get('version', None):
         logger.error("Can't determine demultiplexer version - aborting")
@@ -1440,192 +2041,449 @@ def ingest_run(run_path=None):
 
     demultiplexer_version_num = demultiplexer_info.get('version_number', '')
 
-    project_fastq_mapping = get_sample_project_mapping(bcl2fastq_output_dir,
-                                                       absolute_paths=True)
+    # a single (parallel) pass over the output directory, so FASTQ files
+    # aren't stat'd or have their filenames parsed again when registered
+    fastq_inventory = get_fastq_inventory(bcl2fastq_output_dir,
+                                          absolute_paths=True)
+    fastq_records = dict((r.path, r) for r in fastq_inventory)
+    project_fastq_mapping = get_sample_project_mapping(
+        bcl2fastq_output_dir,
+        inventory=fastq_inventory)
+
+    # FastQC runs on a shared pool of cores for the next projects while
+    # the current project is registered on the server, so each project's
+    # results are (hopefully) ready by the time we get to it
+    fastqc_scheduler = None
+    if options.run_fastqc and not options.fast:
+        fastqc_scheduler = fastqc.FastqcScheduler(
+            fastqc_bin=options.fastqc_bin,
+            threads=int(options.threads))
 
-    for proj_id, fastq_files in project_fastq_mapping.items():
-        proj_path = join(bcl2fastq_output_dir, proj_id)
+    try:
+        for proj_id, fastq_files, fastqc_job in pipeline_fastqc_for_projects(
+                project_fastq_mapping,
+                bcl2fastq_output_dir,
+                samplesheet,
+                scheduler=fastqc_scheduler,
+                depth=options.pipeline_depth):
+            proj_path = get_project_path(proj_id, bcl2fastq_output_dir)
+
+            proj_expt = create_project_experiment_object(
+                proj_id,
+                run_expt,
+                run_expt_link=run_expt_url)
+
+            proj_expt.parameters.ingestor_useragent = uploader.user_agent
+            proj_expt.parameters.demultiplexing_program = \
+                run_expt.parameters.demultiplexing_program
+            proj_expt.parameters.demultiplexing_commandline_options = \
+                run_expt.parameters.demultiplexing_commandline_options
+
+            fastqc_out_dir = get_fastqc_output_directory(proj_path)
+
+            fqc_summary = {}
+            if fastqc_job is not None:
+                # Wait for FastQC (scheduled above) to finish for this
+                # project
+                fastqc_result = fastqc_job.result()
+                if fastqc_result is None:
+                    fastqc_out_dir = None
+                else:
+                    fastqc_out_dir, fqc_summary = fastqc_result
+            elif fastqc_out_dir is not None and exists(fastqc_out_dir):
+                fqc_summary = get_fastqc_summary_for_project(fastqc_out_dir,
+                                                             samplesheet)
+
+            # Create an Experiment for each real Project in the run
+            # (except Undetermined_indices Datasets which will only be
+            #  associated with the parent 'run' Experiment)
+            project_url = run_journal.get('project_experiment', name=proj_id)
+            if project_url:
+                logger.info("Skipping Project Experiment already created: "
+                            "%s (%s)",
+                            project_url,
+                            proj_id)
+            elif proj_id != 'Undetermined_indices':
+                try:
+                    project_url = create_experiment_on_server(proj_expt,
+                                                              uploader)
+
+                    project_url = urlparse(project_url).path
+
+                except Exception as e:
+                    logger.error("Failed to create Experiment for project: "
+                                 "%s",
+                                 proj_id)
+                    logger.debug("Exception: %s", e)
+                    raise e
+
+                run_journal.record('project_experiment', project_url,
+                                   name=proj_id)
+                logger.info("Created Project Experiment: %s (%s)",
+                            project_url,
+                            proj_id)
+
+            if project_url and \
+                    not run_journal.is_complete('project_experiment_shared',
+                                                name=proj_id):
+                try:
+                    for group in options.experiment_owner_groups:
+                        uploader.share_experiment_with_group(project_url,
+                                                             group)
+                except Exception as e:
+                    logger.error("Failed to share Experiment for project: "
+                                 "%s (%s)",
+                                 project_url,
+                                 proj_id)
+                    logger.debug("Exception: %s", e)
+                    raise e
+
+                run_journal.record('project_experiment_shared',
+                                   name=proj_id)
+
+            # We associate Undetermined_indices Datasets with the overall
+            # 'run' Experiment only (unlike proper Project Datasets which also
+            # have their own Project Experiment).
+            if proj_id == 'Undetermined_indices':
+                parent_expt_urls = [run_expt_url]
+            else:
+                parent_expt_urls = [project_url, run_expt_url]
+
+            ############################################
+            # Create the FastQC Dataset for the project
+            fqc_dataset_url = run_journal.get('fastqc_dataset', name=proj_id)
+            if fqc_dataset_url:
+                logger.info("Skipping FastQC Dataset already created: "
+                            "%s (%s)",
+                            fqc_dataset_url,
+                            proj_id)
+                proj_expt.parameters.fastqc_dataset = fqc_dataset_url
+            elif fastqc_out_dir is not None and exists(fastqc_out_dir):
+                try:
+                    # TODO: fq_dataset_url should actually be a URL .. but ..
+                    # we have a chicken-egg problem here - we want the URL
+                    # for the FASTQ dataset here, to add as a parameter, but
+                    # we are adding the FastQC dataset URL so we can add it's
+                    # URL to the FASTQ dataset.
+                    # We need to be able to update the FastQC dataset
+                    # parameters in a second API call after we've added the
+                    # FASTQ dataset.
+                    # fq_dataset_url = "%s__%s" % (run_id, proj_id)
+                    fq_dataset_url = project_url  # placeholder
+
+                    # Then discard parts, repopulate some parameters
+                    fqc_dataset = create_fastqc_dataset_object(
+                        run_id,
+                        proj_id,
+                        proj_expt.end_time,
+                        parent_expt_urls,
+                        fq_dataset_url,
+                        fastqc_summary=fqc_summary)
+
+                    fqc_dataset.parameters.ingestor_useragent = \
+                        uploader.user_agent
+
+                    fqc_dataset_url = create_fastqc_dataset_on_server(
+                        fqc_dataset,
+                        uploader)
+
+                    # Take just the path, eg: /api/v1/dataset/363
+                    fqc_dataset_url = urlparse(fqc_dataset_url).path
+                    # Add the LINK parameter from the FASTQ dataset to it's
+                    # associated FastQC dataset
+                    proj_expt.parameters.fastqc_dataset = fqc_dataset_url
+
+                except Exception as e:
+                    logger.error("Failed to create FastQC Dataset for "
+                                 "Project: %s",
+                                 proj_id)
+                    logger.debug("Exception: %s", e)
+                    raise e
+
+                run_journal.record('fastqc_dataset', fqc_dataset_url,
+                                   name=proj_id)
+                logger.info("Created FastQC Dataset: %s (%s)",
+                            fqc_dataset_url,
+                            proj_id)
+
+            if fqc_dataset_url and \
+                    fastqc_out_dir is not None and \
+                    exists(fastqc_out_dir) and \
+                    not run_journal.is_complete('fastqc_datafiles',
+                                                name=proj_id):
+                # We don't add the FastQC zips for those in temporary
+                # directories eg, for 'Undetermined_indices' (since these
+                # won't be present on shared storage).
+                # We always upload the html reports to be serverd live
+                # (below).
+                if fastqc_out_dir and fastqc_out_dir not in TMPDIRS:
+                    register_project_fastqc_datafiles(run_id,
+                                                      proj_id,
+                                                      fastqc_out_dir,
+                                                      fqc_dataset_url,
+                                                      uploader,
+                                                      fast_mode=options.fast)
+
+                upload_fastqc_reports(fastqc_out_dir, fqc_dataset_url,
+                                      writable_storage_uploader)
+                run_journal.record('fastqc_datafiles', name=proj_id)
+
+            #################################################################
+            # Create the FASTQ Dataset for the project, associated with both
+            # the overall run Experiment, and the project Experiment
+            fq_dataset_url = run_journal.get('fastq_dataset', name=proj_id)
+            if fq_dataset_url:
+                logger.info("Skipping FASTQ Dataset already created: "
+                            "%s (%s)",
+                            fq_dataset_url,
+                            proj_id)
+            else:
+                try:
+                    fq_dataset_url = create_fastq_dataset_on_server(
+                        proj_id,
+                        proj_expt,
+                        parent_expt_urls,
+                        uploader,
+                        fastqc_summary=fqc_summary)
+                except Exception as e:
+                    logger.error("Failed to create Dataset for Project: %s",
+                                 proj_id)
+                    logger.debug("Exception: %s", e)
+                    raise e
 
-        proj_expt = create_project_experiment_object(
-            proj_id,
-            run_expt,
-            run_expt_link=run_expt_url)
+                # Take just the path, eg: /api/v1/dataset/363
+                fq_dataset_url = urlparse(fq_dataset_url).path
+
+                run_journal.record('fastq_dataset', fq_dataset_url,
+                                   name=proj_id)
+                logger.info("Created FASTQ Dataset: %s (%s)",
+                            fq_dataset_url,
+                            proj_id)
+
+                try:
+                    # Create a temporary SampleSheet.csv containing only lines
+                    # for the current Project, to be uploaded to the FASTQ
+                    # Dataset
+                    tmp_dir = create_tmp_dir()
+                    project_samplesheet_path = join(tmp_dir,
+                                                    'SampleSheet.csv')
+                    with open(project_samplesheet_path, 'w') as f:
+                        f.writelines(samplesheet.project_csv_lines(proj_id))
+
+                    writable_storage_uploader.upload_file(
+                        project_samplesheet_path,
+                        fq_dataset_url)
+                    if exists(tmp_dir):
+                        shutil.rmtree(tmp_dir)
+
+                    logger.info("Uploaded SampleSheet.csv for Project: "
+                                "%s (%s)",
+                                fq_dataset_url,
+                                proj_id)
+                except Exception as e:
+                    logger.error("Uploading SampleSheet.csv for Project "
+                                 "failed: %s (%s)", fq_dataset_url, proj_id)
+
+            register_project_fastq_datafiles(
+                run_id,
+                fastq_files,
+                samplesheet,
+                fq_dataset_url,
+                uploader,
+                fastqc_data=fqc_summary,
+                fast_mode=options.fast,
+                threads=options.datafile_threads,
+                decompress_threads=int(options.threads or 1),
+                metadata_cache=metadata_cache,
+                run_journal=run_journal,
+                fastq_records=fastq_records,
+                checksum_sidecars=sidecars,
+                checksum_queue=checksum_queue)
+
+            if fastqc_out_dir is not None:
+                fastqc.clear_fastqc_results(fastqc_out_dir)
+    finally:
+        # If ingestion fails, don't wait for FastQC jobs that haven't
+        # started yet
+        if fastqc_scheduler is not None:
+            fastqc_scheduler.shutdown(cancel_pending=True)
+
+    # Nothing left to resume
+    run_journal.remove()
+
+    lookups.save()
+
+    if checksum_queue is not None:
+        checksum_queue.close()
+        logger.info("Checksums for Datafiles in run %s are pending - run "
+                    "'%s backfill-checksums' to set them.",
+                    run_id, os.path.basename(sys.argv[0]))
 
-        proj_expt.parameters.ingestor_useragent = uploader.user_agent
-        proj_expt.parameters.demultiplexing_program = \
-            run_expt.parameters.demultiplexing_program
-        proj_expt.parameters.demultiplexing_commandline_options = \
-            run_expt.parameters.demultiplexing_commandline_options
+    logger.info("Ingestion of run %s complete !", run_id)
 
-        if proj_id == 'Undetermined_indices' and \
-                undetermined_reads_in_root(bcl2fastq_output_dir):
-            proj_path = bcl2fastq_output_dir
-
-        fastqc_out_dir = get_fastqc_output_directory(proj_path)
-
-        # Run FastQC if output doesn't exist.
-        # We output to a tmp dir since we don't expect to have write
-        # permissions to the primary data directory
-        if options.run_fastqc \
-                and not options.fast \
-                and not exists(fastqc_out_dir):
-            fqc_tmp_dir = create_tmp_dir()
-            fastqc_out_dir = run_fastqc_on_project(
-                fastq_files,
-                proj_path,
-                output_directory=fqc_tmp_dir,
-                fastqc_bin=options.fastqc_bin,
-                threads=int(options.threads)
-            )
 
-        fqc_summary = {}
-        if fastqc_out_dir is not None and exists(fastqc_out_dir):
-            fqc_summary = get_fastqc_summary_for_project(fastqc_out_dir,
-                                                         samplesheet)
+def _digest_queued_file(job):
+    # runs in a worker process, so must be a module level function
+    fastq_path, algorithms = job
+    return checksums.digest_file(fastq_path, algorithms)
 
-        # Create an Experiment for each real Project in the run
-        # (except Undetermined_indices Datasets which will only be associated
-        #  with the parent 'run' Experiment)
-        project_url = None
-        if proj_id != 'Undetermined_indices':
-            try:
-                project_url = create_experiment_on_server(proj_expt, uploader)
 
-                project_url = urlparse(project_url).path
+def backfill_checksums():
+    """
+    Calculates the checksums of FASTQ Datafiles registered with pending
+    checksums (--defer-checksums), hashing files in parallel in a pool of
+    worker processes (--threads), and sets them on the server.
 
-                for group in options.experiment_owner_groups:
-                    uploader.share_experiment_with_group(project_url, group)
+    Every run with a checksum queue in JOURNAL_DIR is processed (see
+    set_pending_checksums).
+    """
+    global logger
+    logger = setup_logging()
+    checksums.logger = logger
+    file_cache.logger = logger
+    journal.logger = logger
 
-            except Exception as e:
-                logger.error("Failed to create Experiment for project: %s",
-                             proj_id)
-                logger.debug("Exception: %s", e)
-                raise e
+    parser, options = get_config(add_extra_options_fn=add_ingest_config_args)
+    validate_config(parser, options, require_path=False)
 
-            logger.info("Created Project Experiment: %s (%s)",
-                        project_url,
-                        proj_id)
+    journal_dir = options.journal_dir or options.cache_dir
+    if not journal_dir:
+        parser.error("backfill-checksums requires --journal-dir or "
+                     "--cache-dir")
 
-        # We associate Undetermined_indices Datasets with the overall 'run'
-        # Experiment only (unlike proper Project Datasets which also have
-        # their own Project Experiment).
-        if proj_id == 'Undetermined_indices':
-            parent_expt_urls = [run_expt_url]
-        else:
-            parent_expt_urls = [project_url, run_expt_url]
+    uploader = MyTardisUploader(
+        options.url,
+        options.username,
+        password=options.password,
+        api_key=options.api_key,
+        verify_certificate=options.verify_certificate,
+        digests=options.digests,
+    )
 
-        ############################################
-        # Create the FastQC Dataset for the project
-        if fastqc_out_dir is not None and exists(fastqc_out_dir):
-            try:
-                # TODO: fq_dataset_url should actually be a URL .. but ..
-                # we have a chicken-egg problem here - we want the URL
-                # for the FASTQ dataset here, to add as a parameter, but
-                # we are adding the FastQC dataset URL so we can add it's
-                # URL to the FASTQ dataset.
-                # We need to be able to update the FastQC dataset parameters
-                # in a second API call after we've added the FASTQ dataset.
-                # fq_dataset_url = "%s__%s" % (run_id, proj_id)
-                fq_dataset_url = project_url  # placeholder
-
-                # Then discard parts, repopulate some parameters
-                fqc_dataset = create_fastqc_dataset_object(
-                    run_id,
-                    proj_id,
-                    proj_expt.end_time,
-                    parent_expt_urls,
-                    fq_dataset_url,
-                    fastqc_summary=fqc_summary)
+    metadata_cache = None
+    if options.cache_dir:
+        metadata_cache = file_cache.FileMetadataCache(
+            options.cache_dir,
+            max_entries=options.cache_max_entries)
 
-                fqc_dataset.parameters.ingestor_useragent = uploader.user_agent
+    try:
+        failed = set_pending_checksums(uploader,
+                                       journal_dir,
+                                       processes=int(options.threads or 1),
+                                       metadata_cache=metadata_cache)
+    finally:
+        if metadata_cache is not None:
+            metadata_cache.close()
+        uploader.close()
 
-                fqc_dataset_url = create_fastqc_dataset_on_server(fqc_dataset,
-                                                                  uploader)
+    if failed:
+        raise Exception("Couldn't set %d pending checksums" % failed)
 
-                # Take just the path, eg: /api/v1/dataset/363
-                fqc_dataset_url = urlparse(fqc_dataset_url).path
-                # Add the LINK parameter from the FASTQ dataset to it's
-                # associated FastQC dataset
-                proj_expt.parameters.fastqc_dataset = fqc_dataset_url
 
-            except Exception as e:
-                logger.error("Failed to create FastQC Dataset for Project: %s",
-                             proj_id)
-                logger.debug("Exception: %s", e)
-                raise e
-
-            logger.info("Created FastQC Dataset: %s (%s)",
-                        fqc_dataset_url,
-                        proj_id)
-
-            # We don't add the FastQC zips for those in temporary directories
-            # eg, for 'Undetermined_indices' (since these won't be present on
-            # shared storage).
-            # We always upload the html reports to be serverd live (below).
-            if fastqc_out_dir and fastqc_out_dir not in TMPDIRS:
-                register_project_fastqc_datafiles(run_id,
-                                                  proj_id,
-                                                  fastqc_out_dir,
-                                                  fqc_dataset_url,
-                                                  uploader,
-                                                  fast_mode=options.fast)
-
-            upload_fastqc_reports(fastqc_out_dir, fqc_dataset_url,
-                                  writable_storage_uploader)
-
-        #################################################################
-        # Create the FASTQ Dataset for the project, associated with both
-        # the overall run Experiment, and the project Experiment
-        try:
-            fq_dataset_url = create_fastq_dataset_on_server(
-                proj_id,
-                proj_expt,
-                parent_expt_urls,
-                uploader,
-                fastqc_summary=fqc_summary)
-        except Exception as e:
-            logger.error("Failed to create Dataset for Project: %s",
-                         proj_id)
-            logger.debug("Exception: %s", e)
-            raise e
+def set_pending_checksums(uploader, journal_dir, processes=1,
+                          metadata_cache=None):
+    """
+    Calculates and sets the pending checksums queued in every checksum
+    queue in journal_dir.
+
+    Datafiles are recorded in their queue as their checksums are set, so an
+    interrupted backfill can simply be run again. Datafiles whose FASTQ
+    file is missing or has been modified since it was registered are
+    recorded as failed, since hashing the file now wouldn't give the
+    checksum of the file that was registered. Once every Datafile in a
+    queue has been set or has failed, the queue is removed, or if any
+    failed it's kept as a report (<run_id>.checksum_failures).
+
+    :param uploader: The uploader used to set the checksums.
+    :type uploader: mytardis_uploader.MyTardisUploader
+    :param journal_dir: The directory containing the checksum queues.
+    :type journal_dir: str
+    :param processes: The number of files hashed at once.
+    :type processes: int
+    :param metadata_cache: If given, the checksums are also cached.
+    :type metadata_cache: utils.file_cache.FileMetadataCache
+    :return: The number of Datafiles that failed during this backfill.
+    :rtype: int
+    """
+    from concurrent.futures import ProcessPoolExecutor
+
+    queue_paths = []
+    if isdir(journal_dir):
+        queue_paths = sorted(join(journal_dir, f)
+                             for f in os.listdir(journal_dir)
+                             if f.endswith(CHECKSUM_QUEUE_SUFFIX))
+    if not queue_paths:
+        logger.info("No pending checksums in %s", journal_dir)
+        return 0
 
-        # Take just the path, eg: /api/v1/dataset/363
-        fq_dataset_url = urlparse(fq_dataset_url).path
+    def _is_finished(checksum_queue, fastq_path):
+        return checksum_queue.is_complete('checksum_done', name=fastq_path) \
+            or checksum_queue.is_complete('checksum_failed', name=fastq_path)
 
-        logger.info("Created FASTQ Dataset: %s (%s)", fq_dataset_url, proj_id)
+    failed = 0
+    for queue_path in queue_paths:
+        checksum_queue = journal.IngestJournal(queue_path, resume=True)
+        jobs = []
+        for fastq_path, pending in checksum_queue.items('pending_checksum'):
+            if _is_finished(checksum_queue, fastq_path):
+                continue
+            try:
+                stat = os.stat(fastq_path)
+            except OSError:
+                stat = None
+            if stat is None or stat.st_size != pending['size'] or \
+               stat.st_mtime != pending['mtime']:
+                logger.error("FASTQ file missing or modified since it was "
+                             "registered, not setting checksum: %s (%s)",
+                             fastq_path, pending['datafile'])
+                checksum_queue.record('checksum_failed',
+                                      'missing' if stat is None
+                                      else 'modified',
+                                      name=fastq_path)
+                failed += 1
+                continue
+            jobs.append((fastq_path, pending, stat))
 
+        logger.info("Calculating %d pending checksums from %s",
+                    len(jobs), queue_path)
+        executor = ProcessPoolExecutor(max_workers=processes)
+        futures = []
         try:
-            # Create a temporary SampleSheet.csv containing only lines for the
-            # current Project, to be uploaded to the FASTQ Dataset
-            tmp_dir = create_tmp_dir()
-            project_samplesheet_path = join(tmp_dir, 'SampleSheet.csv')
-            with open(project_samplesheet_path, 'w') as f:
-                lines = filter_samplesheet_by_project(samplesheet_path,
-                                                      proj_id)
-                f.writelines(lines)
-
-            writable_storage_uploader.upload_file(project_samplesheet_path,
-                                                  fq_dataset_url)
-            if exists(tmp_dir):
-                shutil.rmtree(tmp_dir)
-
-            logger.info("Uploaded SampleSheet.csv for Project: %s (%s)",
-                        fq_dataset_url,
-                        proj_id)
-        except Exception as e:
-            logger.error("Uploading SampleSheet.csv for Project failed: "
-                         "%s (%s)", fq_dataset_url, proj_id)
-
-        register_project_fastq_datafiles(
-            run_id,
-            fastq_files,
-            samplesheet,
-            fq_dataset_url,
-            uploader,
-            fastqc_data=fqc_summary,
-            fast_mode=options.fast)
+            futures = [(executor.submit(_digest_queued_file,
+                                        (fastq_path, pending['digests'])),
+                        fastq_path, pending, stat)
+                       for fastq_path, pending, stat in jobs]
+            for future, fastq_path, pending, stat in futures:
+                digests = future.result()
+                uploader.set_datafile_digests(pending['datafile'], digests)
+                checksum_queue.record('checksum_done', pending['datafile'],
+                                      name=fastq_path)
+                if metadata_cache is not None:
+                    cached = metadata_cache.get(fastq_path, stat=stat) or {}
+                    cached['digests'] = digests
+                    metadata_cache.put(fastq_path, cached, stat=stat)
+                logger.info("Set checksum of Datafile: %s (%s)",
+                            fastq_path, pending['datafile'])
+        finally:
+            for future in futures:
+                future[0].cancel()
+            executor.shutdown(wait=True)
+
+        pending_paths = [n for n, _ in checksum_queue.items('pending_checksum')]
+        if not all(_is_finished(checksum_queue, n) for n in pending_paths):
+            checksum_queue.close()
+        elif checksum_queue.items('checksum_failed'):
+            checksum_queue.close()
+            report_path = queue_path[:-len(CHECKSUM_QUEUE_SUFFIX)] + \
+                CHECKSUM_FAILURES_SUFFIX
+            os.rename(queue_path, report_path)
+            logger.error("Checksums for %d Datafiles couldn't be set, see: "
+                         "%s", len(checksum_queue.items('checksum_failed')),
+                         report_path)
+        else:
+            checksum_queue.remove()
 
-    logger.info("Ingestion of run %s complete !", run_id)
+    return failed
 
 
 @atexit.register
@@ -1639,15 +2497,19 @@ def _cleanup_tmp():
 
 def run_in_console():
     MyTardisUploader.user_agent_name = os.path.basename(sys.argv[0])
+    command, description = ingest_run, "Ingestion"
+    if len(sys.argv) > 1 and sys.argv[1] == 'backfill-checksums':
+        del sys.argv[1]
+        command, description = backfill_checksums, "Checksum backfill"
     try:
-        ingest_run()
+        command()
     except Exception as e:
         if e != SystemExit:
             import traceback
             # traceback.print_exc(file=sys.stdout)
             logger.debug((traceback.format_exc()))
         _cleanup_tmp()
-        logger.error("Ingestion failed.")
+        logger.error("%s failed.", description)
         sys.exit(1)
 
     # since atexit doesn't seem to work
@@ -12,17 +12,22 @@ from builtins import (bytes, str, open, super, range,
                       zip, round, input, int, pow, object)
 
 from __init__ import __version__
+from utils import checksums
+from utils import lookup_cache
+from utils import multipart
 import logging
 
 logger = logging.getLogger('mytardis_ngs_uploader')
 
 import six
 from six.moves.urllib.parse import urlparse, urljoin
+import copy
 import os
 import sys
 import mimetypes
 import json
 import requests
+from requests.adapters import HTTPAdapter
 from requests.auth import AuthBase, HTTPBasicAuth
 import backoff
 from time import strftime
@@ -40,6 +45,27 @@ except ImportError:
     pass
 
 DEFAULT_STORAGE_MODE = 'upload'
+# The number of per-host connection pools kept, and the maximum number of
+# keep-alive connections kept open to each host
+DEFAULT_POOL_CONNECTIONS = 4
+DEFAULT_POOL_MAXSIZE = 10
+# How checksums calculated while uploading a file are sent to the server:
+#   trailing - in the json_data form field, sent after the file
+#   patch    - in a PATCH request once the upload completes, for servers
+#              that need json_data before the file
+STREAMED_CHECKSUM_MODES = ('trailing', 'patch')
+# httplib (Python 2) can only stream request bodies that have a read method,
+# so uploads are sent through a MultipartBodyReader
+READABLE_UPLOAD_BODIES = six.PY2
+# The number of DataFiles registered per request in shared storage mode
+DEFAULT_DATAFILE_BATCH_SIZE = 100
+# Responses to a batched registration meaning the server doesn't accept
+# list PATCH requests for DataFiles (rather than that the DataFiles are bad)
+BATCH_REJECTED_STATUS_CODES = (405, 413, 501)
+# The maximum length of the filename__in query parameter used to find
+# DataFiles created by a batch, so query strings stay well below common
+# server URL length limits
+MAX_FILENAME_FILTER_LENGTH = 2000
 
 
 # http://stackoverflow.com/a/26853961
@@ -83,6 +109,13 @@ class MyTardisUploader:
                  storage_box_name='default',
                  verify_certificate=True,
                  fast_mode=False,
+                 pool_connections=DEFAULT_POOL_CONNECTIONS,
+                 pool_maxsize=DEFAULT_POOL_MAXSIZE,
+                 digests=checksums.DEFAULT_DIGESTS,
+                 datafile_batch_size=DEFAULT_DATAFILE_BATCH_SIZE,
+                 lookups=None,
+                 upload_chunk_size=multipart.DEFAULT_UPLOAD_CHUNK_SIZE,
+                 streamed_checksums=STREAMED_CHECKSUM_MODES[0],
                  ):
 
         self.mytardis_url = mytardis_url
@@ -100,6 +133,23 @@ class MyTardisUploader:
         # True, False, or the path to the certificate (.pem)
         self.verify_certificate = verify_certificate
         self.fast_mode = fast_mode
+        # checksums calculated for each file, in a single pass over the file
+        self.digests = tuple(digests or checksums.DEFAULT_DIGESTS)
+        self.datafile_batch_size = max(int(datafile_batch_size or 1), 1)
+        # set False if the server rejects a batch, so we stop trying
+        self.batch_registration = True
+        # set False if the server doesn't allow filename__in filters, so we
+        # look up DataFiles by filename one at a time
+        self.filename_in_filter = True
+        # server lookups (instruments, groups, users) that rarely change
+        if lookups is None:
+            lookups = lookup_cache.LookupCache(namespace=mytardis_url)
+        self.lookups = lookups
+        self.upload_chunk_size = upload_chunk_size
+        self.streamed_checksums = streamed_checksums
+        self.pool_connections = pool_connections
+        self.pool_maxsize = pool_maxsize
+        self.session = self._create_session()
 
         if self.api_key is not None:
             self.auth = TastyPieAuth(self.username, self.api_key)
@@ -108,6 +158,31 @@ class MyTardisUploader:
         else:
             self.auth = None
 
+    def _create_session(self):
+        """
+        Creates a requests Session with a pool of keep-alive connections, so
+        we don't do a new TCP (and TLS) handshake for every request.
+        The underlying urllib3 connection pools are thread-safe, so a single
+        session is shared between worker threads. When more than pool_maxsize
+        threads make requests to the same host at once, they block waiting
+        for a free connection rather than opening extra ones.
+
+        :rtype: requests.Session
+        """
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=self.pool_connections,
+                              pool_maxsize=self.pool_maxsize,
+                              pool_block=True)
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        return session
+
+    def close(self):
+        """
+        Closes any open connections held by the session.
+        """
+        self.session.close()
+
     def _json_request_headers(self):
         return {'Accept': 'application/json',
                 'Content-Type': 'application/json',
@@ -403,6 +478,11 @@ class MyTardisUploader:
                                 data=data,
                                 extra_headers=extra_headers)
 
+    def do_patch_request(self, action, data, extra_headers=None):
+        return self._do_request('PATCH', action,
+                                data=data,
+                                extra_headers=extra_headers)
+
     @backoff.on_exception(backoff.expo,
                           requests.exceptions.RequestException,
                           max_tries=8)
@@ -420,15 +500,20 @@ class MyTardisUploader:
         if extra_headers is not None:
             headers = merge_dicts(headers, extra_headers)
 
+        # a streamed body may have been partly sent by a failed attempt
+        rewind = getattr(data, 'rewind', None)
+        if rewind is not None:
+            rewind()
+
         try:
-            response = requests.request(method,
-                                        url,
-                                        data=data,
-                                        params=params,
-                                        headers=headers,
-                                        auth=self.auth,
-                                        verify=self.verify_certificate,
-                                        )
+            response = self.session.request(method,
+                                            url,
+                                            data=data,
+                                            params=params,
+                                            headers=headers,
+                                            auth=self.auth,
+                                            verify=self.verify_certificate,
+                                            )
             # 502 Bad Gateway triggers retries, since the proxy web
             # server (eg Nginx or Apache) in front of MyTardis could be
             # temporarily restarting
@@ -452,36 +537,75 @@ class MyTardisUploader:
         :return: string
         """
         if not blocksize:
-            blocksize = 128
-
-        import hashlib
-        md5 = hashlib.md5()
-        with open(file_path, 'rb') as f:
-            while True:
-                chunk = f.read(blocksize)
-                if not chunk:
-                    break
-                md5.update(chunk)
-        return md5.hexdigest()
-
-    def _send_datafile(self, data, filename=None):
-        # we need to use requests_toolbelt here to prepare the multipart
-        # encoded form data since vanilla requests can't stream files
-        # when POSTing forms of this type and will run out of RAM
-        # when encoding large files
-        # See: https://github.com/kennethreitz/requests/issues/1584
-        from requests_toolbelt import MultipartEncoder
-
-        with open(filename, 'rb') as f:
-            form = MultipartEncoder(fields={'json_data': data,
-                                            'attached_file': ('text/plain', f)})
-            headers = self._json_request_headers()
-            headers['Content-Type'] = form.content_type
-
-            response = self.do_post_request('dataset_file',
-                                            form,
-                                            extra_headers=headers)
-            return response
+            blocksize = checksums.DEFAULT_BLOCKSIZE
+
+        return checksums.md5_file(file_path, blocksize=blocksize)
+
+    def _digest_file_calc(self, file_path, blocksize=None):
+        """
+        Calculates all the configured digests of a file (self.digests) in
+        a single pass over the file. Returns a dictionary of hex digests
+        keyed by algorithm name, eg {'md5': '...', 'sha512': '...'}.
+
+        :type file_path: string
+        :type blocksize: int
+        :rtype: dict
+        """
+        if not blocksize:
+            blocksize = checksums.DEFAULT_BLOCKSIZE
+
+        return checksums.digest_file(file_path, self.digests,
+                                     blocksize=blocksize)
+
+    def _send_datafile(self, file_dict, filename=None, stream_digests=()):
+        # vanilla requests can't stream files when POSTing multipart forms
+        # and will run out of RAM when encoding large files
+        # (https://github.com/kennethreitz/requests/issues/1584), so we
+        # stream the file from a memory map with a precomputed
+        # Content-Length. The body can be sent again if the request is
+        # retried.
+        def _json_data(hexdigests):
+            return self.dict_to_json(
+                merge_dicts(file_dict,
+                            checksums.datafile_digest_fields(hexdigests)))
+
+        fields = []
+        trailing_fields = []
+        patch_digests = False
+        if stream_digests and self.streamed_checksums == 'trailing':
+            # the server parses the whole form before reading json_data,
+            # so it can follow the file, with the digests calculated
+            # while the file was sent
+            trailing_fields = [('json_data', _json_data)]
+        else:
+            pending = {}
+            if stream_digests:
+                pending = dict((a, checksums.PENDING_CHECKSUM)
+                               for a in stream_digests)
+                patch_digests = True
+            fields = [('json_data', _json_data(pending))]
+
+        body = multipart.MultipartFileBody(fields,
+                                           'attached_file',
+                                           filename,
+                                           chunk_size=self.upload_chunk_size,
+                                           digests=stream_digests,
+                                           trailing_fields=trailing_fields)
+        headers = self._json_request_headers()
+        headers['Content-Type'] = body.content_type
+
+        send_body = body
+        if READABLE_UPLOAD_BODIES:
+            send_body = body.reader()
+
+        response = self.do_post_request('dataset_file',
+                                        send_body,
+                                        extra_headers=headers)
+
+        if patch_digests and response.ok and 'Location' in response.headers:
+            self.set_datafile_digests(response.headers['Location'],
+                                      body.hexdigests)
+        return response
 
     def _register_datafile_staging(self, data):
         raise NotImplementedError("Registering datafiles in a staging location"
@@ -536,20 +660,47 @@ class MyTardisUploader:
 
         return data.headers.get('Location', None)
 
+    def _cached_query(self, kind, query_params):
+        """
+        Makes a GET request for a list of objects, returning the cached
+        response (from self.lookups) if the same query has been made
+        recently. Empty results aren't cached, so objects created on the
+        server are found straight away.
+
+        The cache is shared between threads (and persisted between runs),
+        so callers always get their own copy of the response, which they
+        are free to modify.
+
+        :type kind: str
+        :type query_params: dict
+        :rtype: dict
+        """
+        key = json.dumps(query_params, sort_keys=True)
+        result = self.lookups.get(kind, key)
+        if result is not None:
+            return copy.deepcopy(result)
+
+        response = self.do_get_request(kind, query_params)
+        result = response.json()
+        if response.ok and result.get('objects', None):
+            self.lookups.put(kind, key, copy.deepcopy(result))
+        return result
+
+    def _invalidate_query(self, kind, query_params):
+        self.lookups.invalidate(kind, json.dumps(query_params,
+                                                 sort_keys=True))
+
     def query_instrument(self, name):
         query_params = {u'name': name}
-        response = self.do_get_request('instrument', query_params)
-        return response.json()
+        return self._cached_query('instrument', query_params)
 
     def query_group(self, name):
         query_params = {u'name': name}
-        response = self.do_get_request('group', query_params)
-        return response.json()
+        return self._cached_query('group', query_params)
 
     def query_user(self, name):
         query_params = {u'username': name}
-        response = self.do_get_request('user', query_params)
-        return response.json()
+        return self._cached_query('user', query_params)
 
     def query_objectacl(self, object_id,
                         content_type='experiment',
@@ -596,11 +747,27 @@ class MyTardisUploader:
 
         return data.headers.get('Location', None)
 
-    def upload_file(self, file_path, dataset_url_path,
-                    parameter_sets_list=None,
-                    replica_url='',
-                    md5_checksum=None):
-
+    def datafile_dict(self, file_path, dataset_url_path,
+                      parameter_sets_list=None,
+                      replica_url='',
+                      md5_checksum=None,
+                      file_size=None,
+                      digests=None,
+                      calculate_digests=True):
+        """
+        Assembles the dictionary representing a DataFile for the MyTardis
+        REST API, calculating any checksums not given (unless
+        calculate_digests is False).
+
+        :param file_path: The path to the file.
+        :type file_path: str
+        :param dataset_url_path: The URI of the Dataset the file belongs to.
+        :type dataset_url_path: str
+        :param digests: Hex digests already calculated, keyed by algorithm
+                        name.
+        :type digests: dict[str, str]
+        :rtype: dict
+        """
         if not parameter_sets_list:
             parameter_sets_list = []
 
@@ -615,25 +782,63 @@ class MyTardisUploader:
                          u'location': self.storage_box_name,
                          u'protocol': u'file'},
                         ]
-        file_size = os.path.getsize(file_path)
+        if file_size is None:
+            file_size = os.path.getsize(file_path)
         # Hack to work around MyTardis not accepting
         # files of zero bytes
         # file_size = (file_size if file_size > 0 else -1)
-        if md5_checksum is None and not self.fast_mode:
-            md5_checksum = self._md5_file_calc(file_path)
-        else:
-            md5_checksum = '__undetermined__'
+        # any digests (eg {'sha512': '...'}) not already calculated by the
+        # caller are calculated together, in one pass over the file
+        digests = dict(digests or {})
+        if md5_checksum is not None:
+            digests['md5'] = md5_checksum
+        if self.fast_mode:
+            digests.setdefault('md5', '__undetermined__')
+        elif calculate_digests:
+            missing = [a for a in self.digests if a not in digests]
+            if missing:
+                digests.update(checksums.digest_file(file_path, missing))
 
         file_dict = {
             u'dataset': dataset_url_path,
             u'filename': filename,
-            u'md5sum': md5_checksum,
             u'mimetype': mimetypes.guess_type(file_path)[0],
             u'size': file_size,
             u'parameter_sets': parameter_sets_list,
             u'replicas': replica_list,
         }
+        file_dict.update(checksums.datafile_digest_fields(digests))
+        return file_dict
 
+    def upload_file(self, file_path, dataset_url_path,
+                    parameter_sets_list=None,
+                    replica_url='',
+                    md5_checksum=None,
+                    file_size=None,
+                    digests=None):
+
+        # when uploading, any digests not given are calculated as the file
+        # is sent, so it's only read once
+        stream_digests = []
+        if self.storage_mode == 'upload' and not self.fast_mode:
+            known = set(digests or {})
+            if md5_checksum is not None:
+                known.add('md5')
+            stream_digests = [a for a in self.digests if a not in known]
+
+        file_dict = self.datafile_dict(file_path, dataset_url_path,
+                                       parameter_sets_list=parameter_sets_list,
+                                       replica_url=replica_url,
+                                       md5_checksum=md5_checksum,
+                                       file_size=file_size,
+                                       digests=digests,
+                                       calculate_digests=not stream_digests)
+        return self._register_datafile(file_dict,
+                                       file_path=os.path.normpath(file_path),
+                                       stream_digests=stream_digests)
+
+    def _register_datafile(self, file_dict, file_path=None,
+                           stream_digests=()):
         if self.storage_mode == 'shared':
             data = self._register_datafile_shared_storage(
                 self.dict_to_json(file_dict)
@@ -645,8 +850,9 @@ class MyTardisUploader:
         elif self.storage_mode == 'upload':
             # file_dict.pop(u'replicas', None)
             data = self._send_datafile(
-                self.dict_to_json(file_dict),
-                filename=file_path
+                file_dict,
+                filename=file_path,
+                stream_digests=stream_digests
             )
         else:
             # we should never get here
@@ -658,6 +864,240 @@ class MyTardisUploader:
 
         return data.headers.get('Location', None)
 
+    def register_datafiles(self, file_dicts, batch_size=None,
+                           on_registered=None):
+        """
+        Registers DataFiles at a shared storage location, sending them to the
+        server in batches (Tastypie list PATCH requests to dataset_file) rather
+        than making a request per file.
+
+        If a batch fails, each of its DataFiles is registered with its own
+        request instead, so a single bad DataFile is reported (and stops
+        the upload) without losing the rest of the batch. If the server
+        doesn't accept batched requests at all, no more batches are
+        attempted.
+
+        :param file_dicts: DataFile dictionaries, as returned by
+                           datafile_dict.
+        :type file_dicts: list[dict]
+        :param batch_size: The maximum number of DataFiles per request
+                           (default: self.datafile_batch_size).
+        :type batch_size: int
+        :param on_registered: An optional function called with the index
+                              (in file_dicts) and URI of each DataFile as
+                              it's created, so progress can be recorded
+                              before any later DataFile fails.
+        :type on_registered: function
+        :return: The URIs of the created DataFiles, in the same order as
+                 file_dicts.
+        :rtype: list[str]
+        """
+        if self.storage_mode != 'shared':
+            raise ValueError("Batch registration of Datafiles requires "
+                             "storage mode 'shared'")
+        if batch_size is None:
+            batch_size = self.datafile_batch_size
+        batch_size = max(batch_size, 1)
+
+        datafile_urls = []
+        for start in range(0, len(file_dicts), batch_size):
+            batch = file_dicts[start:start + batch_size]
+            urls = None
+            if len(batch) > 1 and self.batch_registration:
+                urls = self._register_datafile_batch(batch)
+            if urls is not None:
+                for url in urls:
+                    if on_registered is not None:
+                        on_registered(len(datafile_urls), url)
+                    datafile_urls.append(url)
+                continue
+
+            for d in batch:
+                url = self._register_datafile(d)
+                if on_registered is not None:
+                    on_registered(len(datafile_urls), url)
+                datafile_urls.append(url)
+
+        return datafile_urls
+
+    def _register_datafile_batch(self, batch):
+        """
+        Creates a batch of DataFiles with a single list PATCH request.
+        Returns the URIs of the created DataFiles, or None if the batch
+        failed (or the server doesn't accept batches), so its DataFiles
+        should be registered individually.
+
+        :type batch: list[dict]
+        :rtype: list[str] | None
+        """
+        filenames = ', '.join(d[u'filename'] for d in batch)
+        try:
+            response = self.do_patch_request(
+                'dataset_file',
+                self.dict_to_json({'objects': batch}))
+        except requests.exceptions.RequestException as e:
+            logger.warning("Batch registration of Datafiles failed (%s) - "
+                           "registering them individually: %s", e, filenames)
+            return None
+
+        if response.status_code in BATCH_REJECTED_STATUS_CODES:
+            logger.warning("Server doesn't accept batched Datafile "
+                           "registration (%s %s) - registering Datafiles "
+                           "individually", response.status_code,
+                           response.reason)
+            self.batch_registration = False
+            return None
+
+        if not response.ok:
+            # eg a single invalid DataFile, which registering the batch
+            # individually will identify
+            logger.warning("Batch registration of Datafiles failed: "
+                           "%s (%s) - registering them individually: %s",
+                           response.reason, response.status_code, filenames)
+            logger.debug("Response: %s", response.text)
+            return None
+
+        # With always_return_data the created objects are returned in the
+        # order they were sent, otherwise (202 Accepted, no content) we
+        # need to look them up
+        try:
+            created = response.json().get('objects', None)
+        except ValueError:
+            created = None
+        if created and len(created) == len(batch) and \
+                all(o.get('resource_uri', None) for o in created):
+            return [o['resource_uri'] for o in created]
+
+        return self._find_batch_datafiles(batch)
+
+    def _find_batch_datafiles(self, batch):
+        """
+        Finds the URIs of DataFiles created by a batch, matching them by
+        Dataset, filename and replica URL. Only DataFiles with the batch's
+        filenames are requested (see _query_datafiles_by_filename), so each
+        batch transfers about as many DataFiles as it created, however
+        many the Dataset already has.
+
+        :type batch: list[dict]
+        :rtype: list[str]
+        """
+        filenames = {}
+        for d in batch:
+            dataset_id = self._resource_uri_to_id(d[u'dataset'])
+            filenames.setdefault(dataset_id, set()).add(d[u'filename'])
+
+        existing = {}
+        for dataset_id, dataset_filenames in filenames.items():
+            for obj in self._query_datafiles_by_filename(
+                    dataset_id, sorted(dataset_filenames)):
+                existing.setdefault((dataset_id, obj.get('filename')),
+                                    []).append(obj)
+
+        datafile_urls = []
+        claimed = set()
+        for d in batch:
+            key = (self._resource_uri_to_id(d[u'dataset']), d[u'filename'])
+            replica_urls = set(r[u'url'] for r in d.get(u'replicas', []))
+            candidates = [
+                o for o in existing.get(key, [])
+                if o['resource_uri'] not in claimed and
+                (not o.get('replicas') or
+                 replica_urls & set(r.get('url') for r in o['replicas']))]
+            if not candidates:
+                logger.error("Couldn't find Datafile created by batch "
+                             "registration: %s", d[u'filename'])
+                sys.exit(1)
+            # the most recently created, if the file was registered before
+            newest = max(candidates,
+                         key=lambda o: self._resource_uri_to_id(
+                             o['resource_uri']))
+            claimed.add(newest['resource_uri'])
+            datafile_urls.append(newest['resource_uri'])
+
+        return datafile_urls
+
+    def _query_datafiles_by_filename(self, dataset_id, filenames):
+        """
+        Returns the DataFiles in a Dataset with any of the given filenames.
+
+        Filenames are looked up in groups with a filename__in filter. If
+        the server doesn't allow that filter (or a filename contains a
+        comma, the filter's separator), each filename is looked up with
+        its own request instead.
+
+        :type dataset_id: int
+        :type filenames: list[str]
+        :rtype: list[dict]
+        """
+        def _get(params):
+            params = dict(params, dataset__id=dataset_id, limit=0)
+            return self.do_get_request('dataset_file', params)
+
+        singles = [f for f in filenames if u',' in f]
+        groups = []
+        if self.filename_in_filter:
+            group, length = [], 0
+            for filename in filenames:
+                if u',' in filename:
+                    continue
+                if group and length + len(filename) > \
+                        MAX_FILENAME_FILTER_LENGTH:
+                    groups.append(group)
+                    group, length = [], 0
+                group.append(filename)
+                length += len(filename) + 1
+            if group:
+                groups.append(group)
+        else:
+            singles = filenames
+
+        objects = []
+        for i, group in enumerate(groups):
+            response = _get({u'filename__in': u','.join(group)})
+            if response.status_code == 400 and i == 0:
+                # eg Tastypie's InvalidFilterError
+                logger.warning("Server doesn't allow filename__in filters "
+                               "for Datafiles (%s) - looking up Datafiles "
+                               "by filename individually", response.text)
+                self.filename_in_filter = False
+                singles = filenames
+                break
+            if not response.ok:
+                self._raise_request_exception(response)
+            objects.extend(response.json().get('objects', []))
+
+        for filename in singles:
+            response = _get({u'filename': filename})
+            if not response.ok:
+                self._raise_request_exception(response)
+            objects.extend(response.json().get('objects', []))
+
+        return objects
+
+    def set_datafile_digests(self, datafile_url, digests):
+        """
+        Sets the checksums of an existing DataFile on the server (eg one
+        registered with pending checksums), via a PATCH request.
+
+        :param datafile_url: The URI of the DataFile, as returned by
+                             upload_file.
+        :type datafile_url: str
+        :param digests: Hex digests keyed by algorithm name, eg
+                        {'md5': '...'}. Digests the server doesn't store
+                        are ignored.
+        :type digests: dict[str, str]
+        :rtype: requests.Response
+        """
+        datafile_id = self._resource_uri_to_id(datafile_url)
+        response = self.do_patch_request(
+            'dataset_file/%d' % datafile_id,
+            self.dict_to_json(checksums.datafile_digest_fields(digests)))
+        if not response.ok:
+            logger.error("Setting checksums for %s failed: %s",
+                         datafile_url, response.text)
+            self._raise_request_exception(response)
+        return response
+
     def _resource_uri_to_id(self, uri):
         """
         Takes resource URI like: http://example.org/api/v1/experiment/998
@@ -742,11 +1182,22 @@ class MyTardisUploader:
         """
 
         group_id = self.query_group(group_name)['objects'][0]['id']
-        return self._share_experiment(experiment,
-                                      'django_group',
-                                      group_id,
-                                      *args,
-                                      **kwargs)
+        response = self._share_experiment(experiment,
+                                          'django_group',
+                                          group_id,
+                                          *args,
+                                          **kwargs)
+        if not response.ok:
+            # the cached group ID may be stale, try again with a fresh one
+            self._invalidate_query('group', {u'name': group_name})
+            fresh_id = self.query_group(group_name)['objects'][0]['id']
+            if fresh_id != group_id:
+                response = self._share_experiment(experiment,
+                                                  'django_group',
+                                                  fresh_id,
+                                                  *args,
+                                                  **kwargs)
+        return response
 
     def share_experiment_with_user(self, experiment, username, *args, **kwargs):
         """
@@ -762,11 +1213,22 @@ class MyTardisUploader:
         """
 
         user_id = self.query_user(username)['objects'][0]['id']
-        return self._share_experiment(experiment,
-                                      'django_user',
-                                      user_id,
-                                      *args,
-                                      **kwargs)
+        response = self._share_experiment(experiment,
+                                          'django_user',
+                                          user_id,
+                                          *args,
+                                          **kwargs)
+        if not response.ok:
+            # the cached user ID may be stale, try again with a fresh one
+            self._invalidate_query('user', {u'username': username})
+            fresh_id = self.query_user(username)['objects'][0]['id']
+            if fresh_id != user_id:
+                response = self._share_experiment(experiment,
+                                                  'django_user',
+                                                  fresh_id,
+                                                  *args,
+                                                  **kwargs)
+        return response
 
     def remove_object_acl(self, object_id):
         self.do_get_request('objectacl', {})
@@ -910,6 +1372,16 @@ def add_config_args(parser, add_extra_options_fn=None):
                         default=False,
                         help="Skip some time consuming steps but upload "
                              "incomplete metadata (eg, no md5 checksums)")
+    parser.add_argument("--digests",
+                        dest="digests",
+                        nargs="+",
+                        default=list(checksums.DEFAULT_DIGESTS),
+                        help="The checksums calculated for each file, in a "
+                             "single read of the file. md5 and sha512 are "
+                             "sent to the server, others (eg xxh64, with "
+                             "the xxhash package installed) are only cached "
+                             "locally (space separated, default: md5)",
+                        metavar="DIGESTS")
     parser.add_argument("--storage-mode",
                         dest="storage_mode",
                         type=str,
@@ -920,12 +1392,52 @@ def add_config_args(parser, add_extra_options_fn=None):
                              "shared storage area without uploading. "
                              "Valid values are: upload, staging or shared."
                              "Defaults to upload.")
+    parser.add_argument("--datafile-batch-size",
+                        dest="datafile_batch_size",
+                        type=int,
+                        default=DEFAULT_DATAFILE_BATCH_SIZE,
+                        help="The number of Datafiles registered per "
+                             "request in shared storage mode. Set to 1 to "
+                             "register each Datafile with its own request.",
+                        metavar="DATAFILE_BATCH_SIZE")
+    parser.add_argument("--lookup-cache-ttl",
+                        dest="lookup_cache_ttl",
+                        type=float,
+                        default=lookup_cache.DEFAULT_LOOKUP_CACHE_TTL,
+                        help="The number of seconds the IDs of Instruments, "
+                             "Groups and Users looked up on the server are "
+                             "cached for. 0 disables the cache.",
+                        metavar="LOOKUP_CACHE_TTL")
+    parser.add_argument("--upload-chunk-size",
+                        dest="upload_chunk_size",
+                        type=int,
+                        default=multipart.DEFAULT_UPLOAD_CHUNK_SIZE,
+                        help="The size in bytes of each chunk of a file "
+                             "sent to the server in upload storage mode.",
+                        metavar="UPLOAD_CHUNK_SIZE")
+    parser.add_argument("--streamed-checksums",
+                        dest="streamed_checksums",
+                        type=str,
+                        default=STREAMED_CHECKSUM_MODES[0],
+                        help="How checksums calculated while uploading a "
+                             "file are sent: 'trailing' (in the form data "
+                             "after the file) or 'patch' (in a request after "
+                             "the upload, for servers that need them first).",
+                        metavar="STREAMED_CHECKSUMS")
     parser.add_argument("--exclude",
                         dest="exclude",
                         action="append",
                         help="Exclude files with paths matching this regex. "
                              "Can be specified multiple times.",
                         metavar="REGEX")
+    parser.add_argument("--connection-pool-size",
+                        dest="connection_pool_size",
+                        type=int,
+                        default=DEFAULT_POOL_MAXSIZE,
+                        help="The maximum number of keep-alive connections "
+                             "held open to the MyTardis server. Should be at "
+                             "least the number of threads making requests.",
+                        metavar="CONNECTION_POOL_SIZE")
     # NOTE: When using this option in code, you probably want to use the value
     #       of options.verify_certificate rather than options.certificate
     #       (see logic in validate_config where the verify_certificate
@@ -1002,7 +1514,7 @@ def get_config(default_config_filename='uploader_config.yaml',
     return parser, options
 
 
-def validate_config(parser, options):
+def validate_config(parser, options, require_path=True):
     """
     Validates config options, throws errors and stops excution if
     there is an issue (invalid value or required value missing).
@@ -1010,12 +1522,14 @@ def validate_config(parser, options):
     :rtype : object
     :type options: object
     :type parser: argparse.ArgumentParser
+    :param require_path: False for commands that don't ingest a path.
+    :type require_path: bool
     :return:
     """
-    if not options.path:
+    if require_path and not options.path:
         parser.error('File path not given (--path)')
 
-    if not os.path.isabs(options.path):
+    if require_path and not os.path.isabs(options.path):
         parser.error('Path must be an absolute path (--path)')
 
     if not options.url:
@@ -1030,6 +1544,10 @@ def validate_config(parser, options):
         parser.error('--storage-mode must be one of: ' +
                      ', '.join(valid_storage_modes))
 
+    if options.streamed_checksums not in STREAMED_CHECKSUM_MODES:
+        parser.error('--streamed-checksums must be one of: ' +
+                     ', '.join(STREAMED_CHECKSUM_MODES))
+
     if options.storage_mode == 'shared' and not options.storage_base_path:
         parser.error("--storage-base-path (storage_base_path) must be"
                      "specified when using 'shared' storage mode.")
@@ -1038,6 +1556,12 @@ def validate_config(parser, options):
             not os.path.isabs(options.storage_base_path):
         parser.error('--storage-base-path must be an absolute path')
 
+    for algorithm in options.digests or []:
+        try:
+            checksums.new_hash(algorithm)
+        except ValueError as e:
+            parser.error('--digests: %s' % e)
+
     # We want to force certificate verification if this value is unset.
     # We set options.verify_certificate (a bool OR str) based on the
     # value of options.certificate.
@@ -1137,7 +1661,14 @@ def run():
         storage_box_location=options.storage_base_path,
         storage_box_name=options.storage_box_name,
         verify_certificate=options.verify_certificate,
-        fast_mode=options.fast
+        fast_mode=options.fast,
+        pool_maxsize=options.connection_pool_size,
+        digests=options.digests,
+        datafile_batch_size=options.datafile_batch_size,
+        lookups=lookup_cache.LookupCache(ttl=options.lookup_cache_ttl,
+                                         namespace=options.url),
+        upload_chunk_size=options.upload_chunk_size,
+        streamed_checksums=options.streamed_checksums,
     )
 
     mytardis_uploader.upload_directory(
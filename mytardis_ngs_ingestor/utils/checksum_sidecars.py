@@ -0,0 +1,214 @@
+from __future__ import absolute_import, division, print_function
+
+import io
+import logging
+import os
+import random
+import re
+import threading
+
+logger = logging.getLogger()
+
+# md5sum-style manifests (one '<hex digest>  <path>' line per file) looked
+# for in the directory of each file and its parent directory
+DEFAULT_MANIFEST_NAMES = ('md5sums.txt', 'MD5SUMS', 'checksums.md5',
+                          'sha512sums.txt', 'SHA512SUMS', 'checksums.sha512')
+
+# The fraction of files with trusted checksums that are hashed anyway, to
+# verify the checksums written by the pipeline
+DEFAULT_SPOT_CHECK_FRACTION = 0.01
+
+# The algorithm of a hex digest in a manifest, by length
+_ALGORITHMS_BY_HEX_LENGTH = {32: 'md5', 40: 'sha1', 64: 'sha256',
+                             128: 'sha512'}
+
+# GNU coreutils style: '<hex>  <path>' or '<hex> *<path>' (binary mode)
+_GNU_LINE_RE = re.compile(r'^\\?([0-9a-fA-F]+) [ *](.+)$')
+# BSD style: 'MD5 (<path>) = <hex>'
+_BSD_LINE_RE = re.compile(r'^(\w+) ?\((.+)\) ?= ?([0-9a-fA-F]+)$')
+
+
+def _parse_checksum_line(line):
+    line = line.strip()
+    m = _GNU_LINE_RE.match(line)
+    if m is not None:
+        hexdigest, path = m.groups()
+        return _ALGORITHMS_BY_HEX_LENGTH.get(len(hexdigest)), path, hexdigest
+    m = _BSD_LINE_RE.match(line)
+    if m is not None:
+        algorithm, path, hexdigest = m.groups()
+        return algorithm.lower().replace('-', ''), path, hexdigest
+    return None
+
+
+class ChecksumSidecars(object):
+    """
+    Finds checksums already calculated for files (eg by the demultiplexing
+    pipeline), so files don't need to be read again to hash them.
+
+    Checksums are read from sidecar files next to each file (eg
+    reads.fastq.gz.md5, reads.fastq.gz.sha512) or from md5sum-style manifests
+    in the same or the parent directory. A checksum is only trusted if the
+    file it came from was modified after the file it describes - otherwise
+    the file has changed since it was checksummed, and is hashed as usual.
+
+    A random fraction of files with trusted checksums are spot checked, by
+    hashing them anyway and comparing. If any don't match, no more
+    checksums are trusted for the rest of the ingestion.
+
+    A single instance can be shared between threads.
+    """
+    def __init__(self, manifest_names=DEFAULT_MANIFEST_NAMES,
+                 spot_check_fraction=DEFAULT_SPOT_CHECK_FRACTION):
+        """
+        :param manifest_names: Filenames of manifests to look for.
+        :type manifest_names: list[str]
+        :param spot_check_fraction: The fraction (0.0 - 1.0) of files with
+                                    trusted checksums that are verified.
+        :type spot_check_fraction: float
+        """
+        self.manifest_names = tuple(manifest_names or ())
+        self.spot_check_fraction = spot_check_fraction
+        self.trusted = True
+        self._lock = threading.Lock()
+        # manifest path -> (mtime, {abspath: {algorithm: hexdigest}})
+        self._manifests = {}
+
+    def _read_manifest(self, manifest_path):
+        try:
+            mtime = os.stat(manifest_path).st_mtime
+        except OSError:
+            return None, {}
+
+        with self._lock:
+            cached = self._manifests.get(manifest_path, None)
+        if cached is not None and cached[0] == mtime:
+            return cached
+
+        manifest_dir = os.path.dirname(manifest_path)
+        entries = {}
+        with io.open(manifest_path, 'r', encoding='utf-8',
+                     errors='replace') as f:
+            for line in f:
+                parsed = _parse_checksum_line(line)
+                if parsed is None or parsed[0] is None:
+                    continue
+                algorithm, path, hexdigest = parsed
+                path = os.path.normpath(os.path.join(manifest_dir, path))
+                entries.setdefault(path, {})[algorithm] = hexdigest.lower()
+
+        with self._lock:
+            self._manifests[manifest_path] = (mtime, entries)
+        return mtime, entries
+
+    def _read_sidecar(self, sidecar_path, file_path):
+        with io.open(sidecar_path, 'r', encoding='utf-8',
+                     errors='replace') as f:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                parsed = _parse_checksum_line(line)
+                if parsed is not None:
+                    # the path in a sidecar must refer to this file
+                    if os.path.basename(parsed[1]) == \
+                            os.path.basename(file_path):
+                        return parsed[2].lower()
+                    return None
+                # just the hex digest on its own
+                if re.match(r'^[0-9a-fA-F]+$', line):
+                    return line.lower()
+                return None
+        return None
+
+    def get(self, file_path, algorithms, stat=None):
+        """
+        Returns the trusted checksums found for a file, as a dictionary of
+        hex digests keyed by algorithm name, or None unless all of the
+        requested algorithms were found.
+
+        :param file_path: The path to the file.
+        :type file_path: str
+        :param algorithms: The digest algorithms needed (eg ['md5']).
+        :type algorithms: list[str]
+        :param stat: An optional os.stat result for the file.
+        :type stat: os.stat_result
+        :rtype: dict[str, str] | None
+        """
+        if not self.trusted:
+            return None
+        if stat is None:
+            stat = os.stat(file_path)
+        file_path = os.path.abspath(file_path)
+
+        found = {}
+        for algorithm in algorithms:
+            sidecar_path = '%s.%s' % (file_path, algorithm)
+            try:
+                sidecar_mtime = os.stat(sidecar_path).st_mtime
+            except OSError:
+                continue
+            if sidecar_mtime < stat.st_mtime:
+                logger.warning("Ignoring stale checksum file: %s",
+                               sidecar_path)
+                continue
+            hexdigest = self._read_sidecar(sidecar_path, file_path)
+            if hexdigest is not None:
+                found[algorithm] = hexdigest
+
+        file_dir = os.path.dirname(file_path)
+        for manifest_dir in (file_dir, os.path.dirname(file_dir)):
+            if all(a in found for a in algorithms):
+                break
+            for name in self.manifest_names:
+                manifest_path = os.path.join(manifest_dir, name)
+                mtime, entries = self._read_manifest(manifest_path)
+                checksums = entries.get(file_path, None)
+                if not checksums:
+                    continue
+                if mtime < stat.st_mtime:
+                    logger.warning("Ignoring stale checksums for %s in %s",
+                                   file_path, manifest_path)
+                    continue
+                for algorithm in algorithms:
+                    if algorithm in checksums:
+                        found.setdefault(algorithm, checksums[algorithm])
+
+        if all(a in found for a in algorithms):
+            return dict((a, found[a]) for a in algorithms)
+        return None
+
+    def spot_check(self):
+        """
+        Returns True if the next file with trusted checksums should be
+        verified by hashing it anyway.
+
+        :rtype: bool
+        """
+        return random.random() < self.spot_check_fraction
+
+    def verify(self, file_path, expected, calculated):
+        """
+        Compares trusted checksums with those calculated by hashing the file.
+        If they differ, no more checksums are trusted.
+
+        :param file_path: The path to the file.
+        :type file_path: str
+        :param expected: The trusted checksums, keyed by algorithm name.
+        :type expected: dict[str, str]
+        :param calculated: The calculated checksums, keyed by algorithm name.
+        :type calculated: dict[str, str]
+        :return: True if all the checksums match.
+        :rtype: bool
+        """
+        mismatched = [a for a in expected
+                      if a in calculated and expected[a] != calculated[a]]
+        if mismatched:
+            logger.error("Checksum file for %s doesn't match the file "
+                         "(%s) - no longer trusting checksum files",
+                         file_path, ', '.join(mismatched))
+            self.trusted = False
+            return False
+
+        logger.debug("Spot checked checksums for %s", file_path)
+        return True
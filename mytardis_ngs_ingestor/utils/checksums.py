@@ -0,0 +1,176 @@
+from __future__ import absolute_import, division, print_function
+
+import hashlib
+import io
+import logging
+import os
+from time import time
+
+logger = logging.getLogger()
+
+# Files are read in blocks of this size, into a single reusable buffer
+DEFAULT_BLOCKSIZE = 8 * 1024 * 1024
+
+DEFAULT_DIGESTS = ('md5',)
+
+# The MyTardis DataFile field for each digest that the server stores.
+# Other digests (eg xxh64) are only kept locally, in the metadata cache.
+DATAFILE_DIGEST_FIELDS = {'md5': u'md5sum',
+                          'sha512': u'sha512sum'}
+
+# The checksum a DataFile is registered with until the real checksum is
+# set, eg by backfill-checksums or once an upload has been sent
+PENDING_CHECKSUM = '__pending__'
+
+
+def new_hash(algorithm):
+    """
+    Returns a new hash object for a hashlib algorithm name (eg 'md5',
+    'sha512'), or for the xxHash algorithms 'xxh32', 'xxh64' and 'xxh128'
+    if the optional xxhash package is installed.
+
+    :type algorithm: str
+    :rtype: hashlib.Hash
+    """
+    if algorithm.startswith('xxh'):
+        try:
+            import xxhash
+        except ImportError:
+            raise ValueError("The xxhash package is required for the "
+                             "'%s' digest" % algorithm)
+        if not hasattr(xxhash, algorithm):
+            raise ValueError("Unsupported digest: %s" % algorithm)
+        return getattr(xxhash, algorithm)()
+
+    return hashlib.new(algorithm)
+
+
+class MultiHasher(object):
+    """
+    Calculates several digests (eg MD5 and SHA-512) of the same data at
+    once, so each block of a file only needs to be read once however many
+    digests are wanted.
+    """
+    def __init__(self, algorithms=DEFAULT_DIGESTS):
+        """
+        :param algorithms: Digest algorithm names (see new_hash).
+        :type algorithms: list[str]
+        """
+        self.algorithms = tuple(algorithms)
+        self._hashes = [new_hash(a) for a in self.algorithms]
+
+    def update(self, data):
+        for h in self._hashes:
+            h.update(data)
+
+    def hexdigests(self):
+        """
+        :return: The hex digests, keyed by algorithm name.
+        :rtype: dict[str, str]
+        """
+        return dict((a, h.hexdigest())
+                    for a, h in zip(self.algorithms, self._hashes))
+
+
+def digest_file(file_path,
+                algorithms=DEFAULT_DIGESTS,
+                blocksize=DEFAULT_BLOCKSIZE):
+    """
+    Calculates one or more digests of a file in a single pass over the
+    file, returning a dictionary of hex digests keyed by algorithm name,
+    eg {'md5': '...', 'sha512': '...'}.
+
+    The file is read unbuffered in large blocks into a single preallocated
+    buffer (via readinto), so no new bytes objects are created per block.
+    hashlib releases the GIL while hashing large blocks, so this can run
+    concurrently in several threads. The throughput (MB/s) is logged.
+
+    :param file_path: The path to the file.
+    :type file_path: str
+    :param algorithms: Digest algorithm names (see new_hash).
+    :type algorithms: list[str]
+    :param blocksize: The size of each read, in bytes.
+    :type blocksize: int
+    :rtype: dict[str, str]
+    """
+    hasher = MultiHasher(algorithms)
+    size = 0
+    start = time()
+    with io.open(file_path, 'rb', buffering=0) as f:
+        # small files don't need a large buffer
+        buf = bytearray(max(1, min(blocksize, os.fstat(f.fileno()).st_size)))
+        view = memoryview(buf)
+        while True:
+            n = f.readinto(buf)
+            if not n:
+                break
+            hasher.update(view[:n])
+            size += n
+
+    _log_throughput('+'.join(a.upper() for a in hasher.algorithms),
+                    file_path, size, time() - start)
+    return hasher.hexdigests()
+
+
+def md5_file(file_path, blocksize=DEFAULT_BLOCKSIZE):
+    """
+    Calculates the MD5 checksum of a file, returns the hex digest as a
+    string (see digest_file).
+
+    :param file_path: The path to the file.
+    :type file_path: str
+    :param blocksize: The size of each read, in bytes.
+    :type blocksize: int
+    :return: The MD5 hex digest.
+    :rtype: str
+    """
+    return digest_file(file_path, ('md5',), blocksize=blocksize)['md5']
+
+
+def datafile_digest_fields(digests):
+    """
+    Maps a dictionary of hex digests (as returned by digest_file) to the
+    corresponding MyTardis DataFile fields, eg {'md5sum': '...'}. Digests
+    the server doesn't store are omitted.
+
+    :type digests: dict[str, str]
+    :rtype: dict[str, str]
+    """
+    return dict((DATAFILE_DIGEST_FIELDS[a], d) for a, d in digests.items()
+                if a in DATAFILE_DIGEST_FIELDS)
+
+
+def _md5_file_worker(file_path):
+    return file_path, md5_file(file_path)
+
+
+def md5_files(file_paths, processes=1):
+    """
+    Calculates MD5 checksums for a list of files, optionally in parallel
+    using a pool of worker processes.
+
+    Returns a list of (file_path, md5_hex_digest) tuples, in the same order
+    as file_paths.
+
+    :param file_paths: A list of file paths.
+    :type file_paths: list[str]
+    :param processes: The number of worker processes.
+    :type processes: int
+    :rtype: list[(str, str)]
+    """
+    if not processes or processes <= 1 or len(file_paths) <= 1:
+        return [_md5_file_worker(p) for p in file_paths]
+
+    from concurrent.futures import ProcessPoolExecutor
+    with ProcessPoolExecutor(max_workers=processes) as executor:
+        return list(executor.map(_md5_file_worker, file_paths))
+
+
+def _log_throughput(label, file_path, size, elapsed):
+    mb = size / (1024 * 1024)
+    if elapsed > 0:
+        logger.info("%s: %s (%.1f MB at %.1f MB/s)",
+                    label, os.path.basename(file_path), mb, mb / elapsed)
+    else:
+        logger.info("%s: %s (%.1f MB)",
+                    label, os.path.basename(file_path), mb)
@@ -0,0 +1,174 @@
+from __future__ import absolute_import, division, print_function
+
+import json
+import logging
+import os
+import sqlite3
+import threading
+from time import time
+
+logger = logging.getLogger()
+
+DEFAULT_CACHE_FILENAME = 'file_metadata_cache.sqlite'
+DEFAULT_MAX_ENTRIES = 1000000
+# How often (in number of writes) we check if entries need to be evicted.
+# Smaller caches are checked more often, so they overshoot max_entries
+# by at most ~10%
+EVICTION_CHECK_INTERVAL = 1000
+
+
+class FileMetadataCache(object):
+    """
+    A persistent on-disk (SQLite) cache of metadata calculated from files
+    (eg checksums, read counts), so that they don't need to be recalculated
+    when a failed ingestion is run again.
+
+    Entries are keyed by the absolute path of a file and are only returned
+    if the size, modification time and inode of the file are unchanged since
+    the entry was stored - otherwise the stale entry is discarded.
+
+    When more than max_entries are stored, the least recently used entries
+    are evicted.
+
+    A single instance can be shared between threads.
+    """
+    def __init__(self, cache_dir,
+                 filename=DEFAULT_CACHE_FILENAME,
+                 max_entries=DEFAULT_MAX_ENTRIES):
+        """
+        :param cache_dir: The directory where the cache database is stored.
+                          Created if it doesn't exist.
+        :type cache_dir: str
+        :param filename: The filename of the cache database.
+        :type filename: str
+        :param max_entries: The maximum number of entries kept.
+        :type max_entries: int
+        """
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+
+        self.db_path = os.path.join(cache_dir, filename)
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._writes = 0
+        self._conn = sqlite3.connect(self.db_path, check_same_thread=False)
+        with self._lock:
+            self._conn.execute('PRAGMA journal_mode=WAL')
+            self._conn.execute('CREATE TABLE IF NOT EXISTS files ('
+                               'path TEXT PRIMARY KEY, '
+                               'size INTEGER, '
+                               'mtime REAL, '
+                               'inode INTEGER, '
+                               'data TEXT, '
+                               'last_access REAL)')
+            self._conn.execute('CREATE INDEX IF NOT EXISTS '
+                               'files_last_access ON files (last_access)')
+            self._conn.commit()
+
+    @staticmethod
+    def _key(file_path, stat=None):
+        if stat is None:
+            stat = os.stat(file_path)
+        return (os.path.abspath(file_path),
+                stat.st_size,
+                stat.st_mtime,
+                stat.st_ino)
+
+    def get(self, file_path, stat=None):
+        """
+        Returns the cached metadata dictionary for a file, or None if the
+        file isn't in the cache or has changed since it was cached.
+
+        :param file_path: The path to the file.
+        :type file_path: str
+        :param stat: An optional os.stat result for the file, to avoid
+                     calling stat again.
+        :type stat: os.stat_result
+        :rtype: dict | None
+        """
+        path, size, mtime, inode = self._key(file_path, stat)
+        with self._lock:
+            row = self._conn.execute(
+                'SELECT size, mtime, inode, data FROM files WHERE path = ?',
+                (path,)).fetchone()
+            if row is None:
+                return None
+
+            if tuple(row[:3]) != (size, mtime, inode):
+                logger.debug("Discarding stale cache entry: %s", path)
+                self._conn.execute('DELETE FROM files WHERE path = ?',
+                                   (path,))
+                self._conn.commit()
+                return None
+
+            self._conn.execute(
+                'UPDATE files SET last_access = ? WHERE path = ?',
+                (time(), path))
+            self._conn.commit()
+
+        return json.loads(row[3])
+
+    def put(self, file_path, data, stat=None):
+        """
+        Stores a metadata dictionary (which must be JSON serializable) for
+        a file, replacing any existing entry.
+
+        :param file_path: The path to the file.
+        :type file_path: str
+        :param data: The metadata to store.
+        :type data: dict
+        :param stat: An optional os.stat result for the file, taken
+                     before the metadata was calculated.
+        :type stat: os.stat_result
+        """
+        path, size, mtime, inode = self._key(file_path, stat)
+        with self._lock:
+            self._conn.execute(
+                'INSERT OR REPLACE INTO files '
+                '(path, size, mtime, inode, data, last_access) '
+                'VALUES (?, ?, ?, ?, ?, ?)',
+                (path, size, mtime, inode, json.dumps(data), time()))
+            self._conn.commit()
+
+            self._writes += 1
+            interval = max(1, min(EVICTION_CHECK_INTERVAL,
+                                  self.max_entries // 10))
+            if self._writes % interval == 0:
+                self._evict()
+
+    def _evict(self):
+        count = self._conn.execute('SELECT COUNT(*) FROM files').fetchone()[0]
+        excess = count - self.max_entries
+        if excess > 0:
+            self._conn.execute(
+                'DELETE FROM files WHERE path IN '
+                '(SELECT path FROM files ORDER BY last_access LIMIT ?)',
+                (excess,))
+            self._conn.commit()
+            logger.debug("Evicted %d entries from cache: %s",
+                         excess, self.db_path)
+
+    def invalidate(self, file_path=None):
+        """
+        Removes the entry for a single file from the cache, or all entries
+        if no file_path is given.
+
+        :param file_path: The path to the file.
+        :type file_path: str
+        """
+        with self._lock:
+            if file_path is None:
+                self._conn.execute('DELETE FROM files')
+            else:
+                self._conn.execute('DELETE FROM files WHERE path = ?',
+                                   (os.path.abspath(file_path),))
+            self._conn.commit()
+
+    def __len__(self):
+        with self._lock:
+            return self._conn.execute(
+                'SELECT COUNT(*) FROM files').fetchone()[0]
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
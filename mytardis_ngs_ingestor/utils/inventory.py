@@ -0,0 +1,100 @@
+from __future__ import absolute_import, division, print_function
+
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+try:
+    from os import scandir
+except ImportError:
+    # Python < 3.5
+    from scandir import scandir
+
+logger = logging.getLogger()
+
+# Listing directories is dominated by filesystem latency (particularly on
+# NFS) rather than CPU, so we can usefully have more than one directory
+# listing in flight per core
+DEFAULT_SCAN_THREADS = 8
+
+
+def _scan_directory(dir_path, relative_dir, match, select):
+    files = []
+    subdirs = []
+    for entry in scandir(dir_path):
+        relpath = (entry.name if not relative_dir
+                   else relative_dir + '/' + entry.name)
+        if entry.is_dir():
+            subdirs.append((entry.path, relpath))
+        elif match is None or match(entry.name):
+            stat = entry.stat()
+            if select is None or select(relpath, stat):
+                files.append((relpath, stat))
+    return files, subdirs
+
+
+def scan_tree(basepath, match=None, select=None, limit=None,
+              threads=DEFAULT_SCAN_THREADS):
+    """
+    Recursively lists the files below basepath, listing directories in
+    parallel using a pool of worker threads.
+
+    Directories are listed with scandir, so files are only stat'd if their
+    filename is accepted by the match function, and each matching file is
+    stat'd exactly once. The select function filters files on their stat
+    result in the worker threads, so large trees can be searched (eg for
+    empty files) without holding a record for every file.
+
+    Returns a list of (relative_path, os.stat_result) tuples, sorted by
+    relative path. Relative paths always use '/' as the separator.
+
+    :param basepath: The top level directory.
+    :type basepath: str
+    :param match: A function taking a filename (without any directory) and
+                  returning True if the file should be included. By default
+                  all files are included.
+    :type match: types.FunctionType
+    :param select: A function taking a relative path and os.stat_result,
+                   returning True if the file should be included.
+    :type select: types.FunctionType
+    :param limit: Stop listing directories once this many files have been
+                  found (eg 1, when we only need to know if there are any).
+    :type limit: int
+    :param threads: The maximum number of directories listed concurrently.
+    :type threads: int
+    :rtype: list[(str, os.stat_result)]
+    """
+    files = []
+    if not threads or threads <= 1:
+        pending = [(basepath, '')]
+        while pending and (limit is None or len(files) < limit):
+            dir_path, relative_dir = pending.pop()
+            dir_files, subdirs = _scan_directory(dir_path, relative_dir,
+                                                 match, select)
+            files.extend(dir_files)
+            pending.extend(subdirs)
+    else:
+        executor = ThreadPoolExecutor(max_workers=threads)
+        pending = set()
+        try:
+            pending.add(executor.submit(_scan_directory, basepath, '',
+                                        match, select))
+            while pending and (limit is None or len(files) < limit):
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    dir_files, subdirs = future.result()
+                    files.extend(dir_files)
+                    for dir_path, relative_dir in subdirs:
+                        pending.add(executor.submit(_scan_directory,
+                                                    dir_path, relative_dir,
+                                                    match, select))
+        finally:
+            for future in pending:
+                future.cancel()
+            executor.shutdown(wait=True)
+
+    if limit is not None:
+        files = files[:limit]
+
+    logger.debug("Found %d files in %s", len(files), basepath)
+    return sorted(files, key=lambda f: f[0])
@@ -0,0 +1,150 @@
+from __future__ import absolute_import, division, print_function
+
+import io
+import json
+import logging
+import os
+import threading
+
+logger = logging.getLogger()
+
+
+class IngestJournal(object):
+    """
+    An append-only local record of the steps of an ingestion that have
+    completed, and the URIs of the server objects (Experiments, Datasets,
+    Datafiles) each step created.
+
+    Each step is written (and fsync'd) to a JSON-lines file as soon as it
+    completes, so when an ingestion fails part way through it can be resumed
+    from the journal, skipping steps that have already been done rather than
+    starting again from scratch.
+
+    Steps are identified by a step name (eg 'run_experiment') and an optional
+    name to distinguish between instances of the step (eg a project ID, or
+    the path of a FASTQ file).
+
+    A single instance can be shared between threads.
+    """
+    def __init__(self, journal_path, resume=False):
+        """
+        :param journal_path: The path to the journal file. The parent
+                             directory is created if it doesn't exist.
+        :type journal_path: str
+        :param resume: If True, steps recorded in an existing journal are
+                       loaded, otherwise any existing journal is discarded.
+        :type resume: bool
+        """
+        self.journal_path = journal_path
+        self._lock = threading.Lock()
+        self._steps = {}
+
+        journal_dir = os.path.dirname(os.path.abspath(journal_path))
+        if not os.path.isdir(journal_dir):
+            os.makedirs(journal_dir)
+
+        if resume and os.path.exists(journal_path):
+            truncated = self._load()
+            logger.info("Resuming from journal: %s (%d completed steps)",
+                        journal_path, len(self._steps))
+            self._fh = io.open(journal_path, 'a', encoding='utf-8')
+            if truncated:
+                # don't append to the end of a partially written line
+                self._fh.write(u'\n')
+        else:
+            self._fh = io.open(journal_path, 'w', encoding='utf-8')
+
+    def _load(self):
+        line = u''
+        with io.open(self.journal_path, 'r', encoding='utf-8') as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # a partially written final line, from a crash while
+                    # recording that step - the step is redone
+                    logger.warning("Ignoring incomplete journal entry: %s",
+                                   line.strip())
+                    continue
+                self._steps[(entry['step'], entry['name'])] = entry['value']
+
+        return bool(line) and not line.endswith(u'\n')
+
+    def get(self, step, name=None):
+        """
+        Returns the value recorded for a completed step, or None if the step
+        hasn't been completed.
+
+        :param step: The step name.
+        :type step: str
+        :param name: Distinguishes between instances of the step.
+        :type name: str
+        :rtype: object
+        """
+        with self._lock:
+            return self._steps.get((step, name), None)
+
+    def is_complete(self, step, name=None):
+        """
+        :param step: The step name.
+        :type step: str
+        :param name: Distinguishes between instances of the step.
+        :type name: str
+        :rtype: bool
+        """
+        with self._lock:
+            return (step, name) in self._steps
+
+    def record(self, step, value=True, name=None):
+        """
+        Records a step as completed, with a value (usually the URI of the
+        object created on the server), which must be JSON serializable.
+
+        :param step: The step name.
+        :type step: str
+        :param value: The value recorded for the step.
+        :type value: object
+        :param name: Distinguishes between instances of the step.
+        :type name: str
+        """
+        line = json.dumps({'step': step, 'name': name, 'value': value})
+        with self._lock:
+            self._fh.write(u'%s\n' % line)
+            self._fh.flush()
+            os.fsync(self._fh.fileno())
+            self._steps[(step, name)] = value
+
+    def values(self, step):
+        """
+        Returns the values recorded for all completed instances of a step.
+
+        :param step: The step name.
+        :type step: str
+        :rtype: list
+        """
+        with self._lock:
+            return [v for (s, _), v in self._steps.items() if s == step]
+
+    def items(self, step):
+        """
+        Returns (name, value) tuples for all completed instances of a step.
+
+        :param step: The step name.
+        :type step: str
+        :rtype: list[(str, object)]
+        """
+        with self._lock:
+            return [(n, v) for (s, n), v in self._steps.items() if s == step]
+
+    def close(self):
+        with self._lock:
+            self._fh.close()
+
+    def remove(self):
+        """
+        Closes and deletes the journal file, eg once an ingestion has
+        completed successfully and there is nothing left to resume.
+        """
+        self.close()
+        if os.path.exists(self.journal_path):
+            os.remove(self.journal_path)
@@ -0,0 +1,159 @@
+from __future__ import absolute_import, division, print_function
+
+import io
+import json
+import logging
+import os
+import threading
+from time import time
+
+logger = logging.getLogger()
+
+DEFAULT_LOOKUP_CACHE_FILENAME = 'server_lookups.json'
+# Instruments, groups and users are rarely renamed or recreated, but
+# entries still expire so long running or repeated ingestions eventually
+# see any changes
+DEFAULT_LOOKUP_CACHE_TTL = 3600
+
+
+class LookupCache(object):
+    """
+    A cache of the results of server lookups that rarely change (eg the
+    IDs of Instruments, Groups and Users by name), so each is only requested
+    from the server once rather than for every Dataset or Experiment.
+
+    Entries are keyed by a kind (eg 'instrument') and a key (eg the
+    instrument name), and expire ttl seconds after they were stored.
+    Entries can also be invalidated explicitly, eg when a cached ID turns
+    out to be stale.
+
+    If a cache_path is given, unexpired entries are loaded from it and can
+    be written back with save, so they are reused between invocations.
+    Entries are only reused if they were cached for the same namespace
+    (eg the MyTardis server URL).
+
+    A single instance can be shared between threads.
+    """
+    def __init__(self, ttl=DEFAULT_LOOKUP_CACHE_TTL, cache_path=None,
+                 namespace=None):
+        """
+        :param ttl: The number of seconds entries are valid for. Nothing is
+                    cached if this is 0.
+        :type ttl: float
+        :param cache_path: An optional JSON file the cache is persisted in.
+        :type cache_path: str
+        :param namespace: Identifies what the entries were looked up from,
+                          eg the server URL.
+        :type namespace: str
+        """
+        self.ttl = ttl
+        self.cache_path = cache_path
+        self.namespace = namespace
+        self._lock = threading.Lock()
+        # (kind, key) -> (expiry time, value)
+        self._entries = {}
+
+        if cache_path is not None and os.path.exists(cache_path):
+            self._load()
+
+    def _load(self):
+        try:
+            with io.open(self.cache_path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+        except (IOError, OSError, ValueError) as ex:
+            logger.warning("Ignoring unreadable lookup cache: %s (%s)",
+                           self.cache_path, ex)
+            return
+
+        if data.get('namespace', None) != self.namespace:
+            return
+
+        now = time()
+        for kind, key, expires, value in data.get('entries', []):
+            if expires > now:
+                self._entries[(kind, key)] = (expires, value)
+        logger.debug("Loaded %d entries from lookup cache: %s",
+                     len(self._entries), self.cache_path)
+
+    def get(self, kind, key):
+        """
+        Returns the cached value, or None if there is no unexpired entry.
+
+        :param kind: The kind of lookup, eg 'instrument'.
+        :type kind: str
+        :param key: The key looked up, eg the instrument name.
+        :type key: str
+        :rtype: object
+        """
+        with self._lock:
+            entry = self._entries.get((kind, key), None)
+            if entry is None:
+                return None
+            expires, value = entry
+            if expires <= time():
+                del self._entries[(kind, key)]
+                return None
+            return value
+
+    def put(self, kind, key, value):
+        """
+        Stores a value, which must be JSON serializable.
+
+        :param kind: The kind of lookup, eg 'instrument'.
+        :type kind: str
+        :param key: The key looked up, eg the instrument name.
+        :type key: str
+        :param value: The value to store.
+        :type value: object
+        """
+        if not self.ttl or self.ttl <= 0:
+            return
+        with self._lock:
+            self._entries[(kind, key)] = (time() + self.ttl, value)
+
+    def invalidate(self, kind=None, key=None):
+        """
+        Removes a single entry, all entries of a kind (if no key is given)
+        or all entries (if no kind is given).
+
+        :param kind: The kind of lookup, eg 'instrument'.
+        :type kind: str
+        :param key: The key looked up, eg the instrument name.
+        :type key: str
+        """
+        with self._lock:
+            if kind is None:
+                self._entries.clear()
+            elif key is None:
+                for k in [k for k in self._entries if k[0] == kind]:
+                    del self._entries[k]
+            else:
+                self._entries.pop((kind, key), None)
+
+    def save(self):
+        """
+        Writes the unexpired entries to cache_path (if set), replacing the
+        file atomically.
+        """
+        if self.cache_path is None:
+            return
+
+        now = time()
+        with self._lock:
+            entries = [[kind, key, expires, value]
+                       for (kind, key), (expires, value)
+                       in self._entries.items()
+                       if expires > now]
+
+        cache_dir = os.path.dirname(os.path.abspath(self.cache_path))
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        tmp_path = '%s.%d.tmp' % (self.cache_path, os.getpid())
+        with io.open(tmp_path, 'w', encoding='utf-8') as f:
+            f.write(u'%s' % json.dumps({'namespace': self.namespace,
+                                        'entries': entries}))
+        os.rename(tmp_path, self.cache_path)
+
+    def __len__(self):
+        with self._lock:
+            return len(self._entries)
@@ -0,0 +1,248 @@
+from __future__ import absolute_import, division, print_function
+
+import logging
+import mmap
+import os
+import uuid
+
+import six
+
+from .checksums import MultiHasher, new_hash
+
+logger = logging.getLogger()
+
+# Large chunks mean fewer (and larger) socket writes for multi-GB files
+DEFAULT_UPLOAD_CHUNK_SIZE = 8 * 1024 * 1024
+
+
+def _quote(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"')
+
+
+class MultipartFileBody(object):
+    """
+    A multipart/form-data request body made of some form fields followed by
+    the contents of a single file, streamed from disk.
+
+    The Content-Length is known up front (len(body)), so the body is sent
+    with a Content-Length header rather than chunked transfer encoding.
+    The file is memory mapped and sent as memoryview slices of chunk_size
+    bytes, so file data is never copied into intermediate Python buffers.
+
+    Each iteration over the body starts again from the beginning, so the
+    same body can be sent again when a request is retried.
+
+    Digests of the file can be calculated from the chunks as they are sent,
+    so the file is only read once. Once the whole body has been sent they
+    are available as hexdigests, and can be sent in trailing fields after
+    the file. The value of a trailing field must have the same length
+    whatever the digests are (eg JSON containing the hex digests), so the
+    Content-Length can still be calculated up front.
+    """
+    def __init__(self, fields, file_field, file_path,
+                 chunk_size=DEFAULT_UPLOAD_CHUNK_SIZE,
+                 digests=(),
+                 trailing_fields=()):
+        """
+        :param fields: Form fields sent before the file, as (name, value)
+                       tuples.
+        :type fields: list[(str, str)]
+        :param file_field: The name of the form field for the file.
+        :type file_field: str
+        :param file_path: The path to the file.
+        :type file_path: str
+        :param chunk_size: The size of each chunk of the file sent.
+        :type chunk_size: int
+        :param digests: Digest algorithms calculated as the file is sent
+                        (see checksums.new_hash).
+        :type digests: list[str]
+        :param trailing_fields: Form fields sent after the file, as
+                                (name, function) tuples. Each function
+                                takes the hex digests of the file (keyed by
+                                algorithm) and returns the field value.
+        :type trailing_fields: list[(str, types.FunctionType)]
+        """
+        self.file_path = file_path
+        self.chunk_size = max(int(chunk_size), 1)
+        self.boundary = uuid.uuid4().hex
+        self.content_type = 'multipart/form-data; boundary=%s' % self.boundary
+        # the size when the body was created - the file mustn't change
+        # while it's being sent
+        self.file_size = os.path.getsize(file_path)
+
+        self.digests = tuple(digests)
+        self.trailing_fields = list(trailing_fields)
+        # set once the whole file has been sent
+        self.hexdigests = None
+
+        parts = [self._encode_field(name, value) for name, value in fields]
+        filename = os.path.basename(file_path)
+        if isinstance(filename, six.binary_type):
+            filename = filename.decode('utf-8')
+        parts.append(u'--%s\r\n'
+                     u'Content-Disposition: form-data; name="%s"; '
+                     u'filename="%s"\r\n'
+                     u'Content-Type: application/octet-stream\r\n'
+                     u'\r\n' % (self.boundary, _quote(file_field),
+                                _quote(filename)))
+        self._preamble = u''.join(parts).encode('utf-8')
+        self._epilogue = (u'\r\n--%s--\r\n' % self.boundary).encode('utf-8')
+
+        # trailing fields are sized with placeholder digests of the right
+        # length
+        placeholders = dict((a, u'0' * len(new_hash(a).hexdigest()))
+                            for a in self.digests)
+        self._trailer_length = len(self._encode_trailer(placeholders))
+
+    def _encode_field(self, name, value):
+        if isinstance(value, six.binary_type):
+            value = value.decode('utf-8')
+        return (u'--%s\r\n'
+                u'Content-Disposition: form-data; name="%s"\r\n'
+                u'\r\n'
+                u'%s\r\n' % (self.boundary, _quote(name), value))
+
+    def _encode_trailer(self, hexdigests):
+        return u''.join(self._encode_field(name, value_fn(hexdigests))
+                        for name, value_fn in self.trailing_fields
+                        ).encode('utf-8')
+
+    def __len__(self):
+        return (len(self._preamble) + self.file_size +
+                len(self._epilogue) + self._trailer_length)
+
+    def _file_chunks(self):
+        if self.file_size == 0:
+            return
+        with open(self.file_path, 'rb') as f:
+            try:
+                mm = mmap.mmap(f.fileno(), self.file_size,
+                               access=mmap.ACCESS_READ)
+            except (ValueError, EnvironmentError) as ex:
+                # eg a filesystem that doesn't support mmap
+                logger.debug("Can't mmap %s, reading instead (%s)",
+                             self.file_path, ex)
+                mm = None
+            if mm is None or six.PY2:
+                # (Python 2 mmaps don't support memoryview)
+                if mm is not None:
+                    mm.close()
+                remaining = self.file_size
+                while remaining > 0:
+                    chunk = f.read(min(self.chunk_size, remaining))
+                    if not chunk:
+                        raise IOError("File truncated while uploading: %s" %
+                                      self.file_path)
+                    remaining -= len(chunk)
+                    yield chunk
+                return
+
+            view = memoryview(mm)
+            try:
+                for offset in range(0, self.file_size, self.chunk_size):
+                    yield view[offset:offset + self.chunk_size]
+            finally:
+                view.release()
+                try:
+                    mm.close()
+                except BufferError:
+                    # a slice is still referenced by the caller - the map
+                    # is closed when it's garbage collected
+                    pass
+
+    def __iter__(self):
+        # a retried request starts hashing again
+        self.hexdigests = None
+        hasher = MultiHasher(self.digests) if self.digests else None
+
+        yield self._preamble
+        for chunk in self._file_chunks():
+            if hasher is not None:
+                hasher.update(chunk)
+            yield chunk
+
+        hexdigests = hasher.hexdigests() if hasher is not None else {}
+        if not self.trailing_fields:
+            self.hexdigests = hexdigests
+            yield self._epilogue
+            return
+
+        trailer = self._encode_trailer(hexdigests)
+        if len(trailer) != self._trailer_length:
+            raise ValueError("The length of the trailing fields of %s "
+                             "changed" % self.file_path)
+        self.hexdigests = hexdigests
+        # the CRLF ending the file part, the trailing fields, then the
+        # closing boundary
+        yield b'\r\n' + trailer + self._epilogue[2:]
+
+    def reader(self):
+        """
+        Returns a file-like view of the body, for HTTP clients that read
+        request bodies rather than iterating over them (eg Python 2's
+        httplib). Python 3 clients should be given the body itself, since
+        file-like bodies are read in small blocks.
+
+        :rtype: MultipartBodyReader
+        """
+        return MultipartBodyReader(self)
+
+
+class MultipartBodyReader(object):
+    """
+    File-like access to a MultipartFileBody, which can be rewound to the
+    beginning (eg before retrying a request).
+    """
+    def __init__(self, body):
+        self.body = body
+        self._chunks = None
+        self._chunk = b''
+        self._offset = 0
+
+    def __len__(self):
+        return len(self.body)
+
+    @property
+    def hexdigests(self):
+        """
+        The digests of the file, once the whole body has been read (see
+        MultipartFileBody).
+
+        :rtype: dict
+        """
+        return self.body.hexdigests
+
+    def rewind(self):
+        """
+        Starts the body again from the beginning.
+        """
+        if self._chunks is not None:
+            self._chunks.close()
+        self._chunks = None
+        self._chunk = b''
+        self._offset = 0
+
+    def read(self, size=-1):
+        """
+        :param size: The maximum number of bytes returned (all if < 0).
+        :type size: int
+        :rtype: bytes
+        """
+        if self._chunks is None:
+            self._chunks = iter(self.body)
+        data = []
+        remaining = size
+        while remaining != 0:
+            if self._offset >= len(self._chunk):
+                try:
+                    self._chunk = next(self._chunks)
+                except StopIteration:
+                    break
+                self._offset = 0
+            end = len(self._chunk) if remaining < 0 else \
+                min(len(self._chunk), self._offset + remaining)
+            data.append(bytes(self._chunk[self._offset:end]))
+            if remaining > 0:
+                remaining -= end - self._offset
+            self._offset = end
+        return b''.join(data)
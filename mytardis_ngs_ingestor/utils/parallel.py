@@ -0,0 +1,70 @@
+from __future__ import absolute_import, division, print_function
+
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+
+def imap_ordered(fn, items, threads=1, window=None):
+    """
+    Applies fn to each item using a bounded pool of worker threads, yielding
+    (item, result) tuples in the same order as the input.
+
+    At most 'window' items (default, twice the number of threads) are
+    submitted ahead of the item currently being yielded, so progress (and any
+    logging done by the caller) stays in input order and memory use is
+    bounded for very long lists of items.
+
+    If fn raises an exception for any item, no more items are submitted,
+    work that hasn't yet started is cancelled and the exception is
+    re-raised to the caller (fail fast) - even if earlier items in the
+    window are still running.
+
+    With threads <= 1, items are processed serially in the calling thread.
+
+    :param fn: A callable taking a single item.
+    :type fn: types.FunctionType
+    :param items: An iterable of items.
+    :type items: collections.Iterable
+    :param threads: The maximum number of worker threads.
+    :type threads: int
+    :param window: The maximum number of items submitted but not yet yielded.
+    :type window: int
+    :rtype: collections.Iterator[(object, object)]
+    """
+    if not threads or threads <= 1:
+        for item in items:
+            yield item, fn(item)
+        return
+
+    if window is None:
+        window = threads * 2
+    window = max(window, threads)
+
+    pending = deque()
+    # futures that raised, in the order they finished
+    failed = []
+
+    def _check_failed(future):
+        if not future.cancelled() and future.exception() is not None:
+            failed.append(future)
+
+    executor = ThreadPoolExecutor(max_workers=threads)
+    try:
+        for item in items:
+            if failed:
+                # an item behind the head of the window failed
+                failed[0].result()
+            future = executor.submit(fn, item)
+            future.add_done_callback(_check_failed)
+            pending.append((item, future))
+            if len(pending) >= window:
+                item, future = pending.popleft()
+                yield item, future.result()
+
+        while pending:
+            item, future = pending.popleft()
+            yield item, future.result()
+    finally:
+        for _, future in pending:
+            future.cancel()
+        executor.shutdown(wait=True)
@@ -82,13 +82,14 @@ setup(
                       'backoff',
                       'colorlog',
                       'fs',
+                      'futures; python_version < "3"',
                       'ndg-httpsclient',
                       'pyasn1',
                       'pyopenssl',
                       'python-dateutil',
                       'pyyaml',  # apt: libyaml-dev python-dev
                       'requests >= 2.7.0',
-                      'requests-toolbelt >= 0.4.0',
+                      'scandir; python_version < "3.5"',
                       'urllib3',
                       'xmltodict',
                       'semantic_version',
@@ -1,5 +1,10 @@
 import unittest
+import json
 import os
+import sys
+import shutil
+import tempfile
+import threading
 from os import path
 from mytardis_ngs_ingestor.illumina import fastqc
 
@@ -936,6 +941,163 @@ class FastqcParserTestCase(unittest.TestCase):
 
         self.assertDictEqual(expected, result)
 
+    def test_fastqc_result_is_shared(self):
+        fastqc.clear_fastqc_results()
+        result = fastqc.get_fastqc_result(self.fastqc_zip)
+        self.assertIs(result, fastqc.get_fastqc_result(self.fastqc_zip))
+        self.assertIn('fastqc_report.html', result.members)
+
+        # parsed once, with each caller of the parse functions given a copy
+        data = fastqc.parse_data_txt(self.fastqc_zip)
+        self.assertEqual(result.data, data)
+        self.assertIsNot(result.data, data)
+        summary = fastqc.parse_summary_txt(self.fastqc_zip)
+        self.assertEqual(result.summary, summary)
+        self.assertIsNot(result.summary, summary)
+        self.assertEqual(result.fastqc_version, u'0.11.3')
+
+        # so modifying a copy doesn't affect the shared result
+        data['Basic Statistics']['rows'].append((u'Extra', u'1'))
+        del data['fastqc_version']
+        summary.pop()
+        self.assertDictEqual(fastqc.parse_data_txt(self.fastqc_zip),
+                             self.parsed_data_txt)
+        self.assertListEqual(fastqc.parse_summary_txt(self.fastqc_zip),
+                             self.qc_summary)
+
+        fastqc.clear_fastqc_results(path.dirname(self.fastqc_zip))
+        self.assertIsNot(result, fastqc.get_fastqc_result(self.fastqc_zip))
+
+    def test_fastqc_result_extract_report(self):
+        result = fastqc.FastqcResult(self.fastqc_zip)
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            report = result.extract_report(tmp_dir)
+            self.assertEqual(report, path.join(tmp_dir,
+                                               'Q1N_S7_L004_R1_001_fastqc',
+                                               'fastqc_report.html'))
+            self.assertTrue(path.isfile(report))
+            # only the report is extracted
+            self.assertEqual(os.listdir(path.dirname(report)),
+                             ['fastqc_report.html'])
+
+            report = result.extract_report(tmp_dir, images=True)
+            report_dir = path.dirname(report)
+            self.assertEqual(sorted(os.listdir(report_dir)),
+                             ['Icons', 'Images', 'fastqc_report.html'])
+            self.assertEqual(len(os.listdir(path.join(report_dir,
+                                                      'Images'))), 8)
+            self.assertFalse(path.exists(path.join(report_dir,
+                                                   'fastqc_data.txt')))
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    def test_fastqc_project_summary_lookups(self):
+        summary = fastqc.FastqcProjectSummary(
+            {u'samples': [], u'fastqc_version': u'0.11.3'})
+        self.assertIsNone(summary.get_sample_by_filename('A_R1.fastq.gz'))
+
+        # samples added after a lookup are still found
+        for name in ['A_R1', 'A_R2']:
+            summary.add_sample({u'sample_id': name,
+                                u'filename': name + '.fastq.gz'})
+        self.assertEqual(
+            summary.get_sample_by_filename('A_R2.fastq.gz')['sample_id'],
+            'A_R2')
+        self.assertEqual(summary.get_sample_by_id('A_R1')['filename'],
+                         'A_R1.fastq.gz')
+        self.assertEqual(len(summary['samples']), 2)
+
+        # as are samples in a list given when it's created, or replacing
+        # the list
+        summary = fastqc.FastqcProjectSummary(summary)
+        self.assertEqual(summary.get_sample_by_id('A_R2')['filename'],
+                         'A_R2.fastq.gz')
+        summary[u'samples'] = [{u'sample_id': u'B_R1',
+                                u'filename': u'B_R1.fastq.gz'}]
+        self.assertIsNone(summary.get_sample_by_id('A_R2'))
+        self.assertEqual(summary.get_sample_by_filename('B_R1.fastq.gz'),
+                         summary[u'samples'][0])
+
+        # the indexes aren't serialized
+        self.assertEqual(json.dumps(summary, sort_keys=True),
+                         json.dumps(dict(summary), sort_keys=True))
+
+
+# Stands in for the fastqc executable: sleeps briefly, then writes an empty
+# _fastqc.zip for each input file (or fails for files named 'bad*')
+FAKE_FASTQC = '''
+import os, sys, time
+outdir = sys.argv[sys.argv.index('--outdir') + 1]
+for fastq in sys.argv[sys.argv.index('--outdir') + 2:]:
+    name = os.path.basename(fastq)
+    if name.startswith('bad'):
+        print('Failed to process file %s' % name)
+        sys.exit(1)
+    time.sleep(0.05)
+    open(os.path.join(outdir, name.split('.')[0] + '_fastqc.zip'), 'w').close()
+    print('Analysis complete for %s' % name)
+'''
+
+
+class FastqcSchedulerTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        fake_bin = path.join(self.tmp_dir, 'fake_fastqc.py')
+        with open(fake_bin, 'w') as f:
+            f.write(FAKE_FASTQC)
+        self.fastqc_bin = '%s %s' % (sys.executable, fake_bin)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def _project(self, name, fastq_names):
+        output_directory = path.join(self.tmp_dir, name)
+        os.mkdir(output_directory)
+        return [path.join(self.tmp_dir, n) for n in fastq_names], \
+            output_directory
+
+    def test_projects_complete_with_summary(self):
+        completed = []
+
+        def _summarize(output_directory):
+            completed.append(threading.current_thread().name)
+            return sorted(os.listdir(output_directory))
+
+        scheduler = fastqc.FastqcScheduler(fastqc_bin=self.fastqc_bin,
+                                           threads=3)
+        small = scheduler.submit_project(
+            *self._project('small', ['a.fastq.gz']),
+            on_complete=_summarize)
+        large = scheduler.submit_project(
+            *self._project('large', ['b%d.fastq.gz' % i for i in range(4)]),
+            on_complete=_summarize)
+        failed = scheduler.submit_project(
+            *self._project('failed', ['c.fastq.gz', 'bad.fastq.gz']),
+            on_complete=_summarize)
+        scheduler.shutdown()
+
+        self.assertEqual(small.result(), ['a_fastqc.zip'])
+        self.assertEqual(large.result(),
+                         ['b%d_fastqc.zip' % i for i in range(4)])
+        self.assertIsNone(failed.result())
+        # summaries are parsed in the worker thread that finishes a project
+        self.assertEqual(len(completed), 2)
+        self.assertNotIn(threading.current_thread().name, completed)
+
+    def test_cancelled_jobs_complete_projects(self):
+        scheduler = fastqc.FastqcScheduler(fastqc_bin=self.fastqc_bin,
+                                           threads=1)
+        started = scheduler.submit_project(
+            *self._project('started', ['a%d.fastq.gz' % i for i in range(2)]))
+        pending = scheduler.submit_project(
+            *self._project('pending', ['b.fastq.gz']))
+        scheduler.shutdown(cancel_pending=True)
+
+        # projects with cancelled jobs still complete, without a result
+        self.assertIsNone(started.result(timeout=5))
+        self.assertIsNone(pending.result(timeout=5))
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -1,5 +1,9 @@
 import os
 from os import path
+import gzip
+import hashlib
+import shutil
+import tempfile
 import unittest
 from datetime import datetime
 from collections import OrderedDict
@@ -9,8 +13,12 @@ from mytardis_ngs_ingestor.illumina.run_info import \
     parse_samplesheet, \
     filter_samplesheet_by_project, \
     filter_samplesheet_by_project, \
-    rta_complete_parser, get_sample_project_mapping, \
-    parse_sample_info_from_filename
+    SampleSheet, get_samplesheet, \
+    rta_complete_parser, get_sample_project_mapping, get_fastq_inventory, \
+    parse_sample_info_from_filename, get_number_of_reads_fastq, \
+    FastqFilenameMatcher, set_fastq_filename_patterns, \
+    find_truncated_files, FASTQ_SUFFIXES, scan_rta_logs, \
+    get_fastq_stats
 
 
 class IlluminaParserTestCase(unittest.TestCase):
@@ -160,6 +168,44 @@ class IlluminaParserTestCase(unittest.TestCase):
         for expected_line, project_line in zip(expected, project_lines):
             self.assertEqual(project_line, expected_line)
 
+    def test_samplesheet_indexes(self):
+        # IEMv3 - sample names are the SampleID
+        samplesheet = SampleSheet(self.samplesheet_csv_path)
+        self.assertEqual(samplesheet.iem_version, 3)
+        self.assertEqual(samplesheet.chemistry, 'TruSeq LT')
+        self.assertEqual(len(samplesheet), 12)
+        self.assertEqual(samplesheet.project_ids, ['GusFring', 'Walter_White'])
+        self.assertEqual(
+            samplesheet.find_sample_position('14-05659-SW42', lane=2,
+                                             index='GGAGAA'), 7)
+        self.assertIsNone(
+            samplesheet.find_sample_position('14-05659-SW42', lane=1))
+        self.assertEqual(samplesheet.find_sample('14-06205-OCT4-5')
+                         ['Description'], 'May contain nuts')
+
+        # IEMv4 - the same sample can appear in several lanes
+        samplesheet = SampleSheet(self.samplesheet_v4_path)
+        self.assertEqual(samplesheet.iem_version, 4)
+        self.assertEqual([s['Lane'] for s in samplesheet.samples_by_id(
+            '16-01787')], ['3', '4'])
+        self.assertEqual(len(samplesheet.samples_by_name('Q1N')), 2)
+        self.assertEqual(samplesheet.find_sample_position('Q1N', lane=4), 8)
+        sample = samplesheet.find_sample('Q1L', lane=3, index='TGGTGA')
+        self.assertEqual(samplesheet.get_index_sequence(sample), 'TGGTGA')
+        self.assertEqual(len(samplesheet.samples_by_project('Phr00t')), 3)
+
+        self.assertEqual(
+            samplesheet.project_csv_lines('Shigeru_Miyamoto'),
+            ['Lane,Sample_ID,Sample_Name,Sample_Plate,Sample_Well,'
+             'I7_Index_ID,index,Sample_Project,Description\r\n',
+             '2,16-00487,QQInputF2,,,A001,AACCAG,Shigeru_Miyamoto,\r\n',
+             '2,16-00488,QQH4K4F2,,,A002,TGGTGA,Shigeru_Miyamoto,\r\n',
+             '2,16-00489,QQH4K9F2,,,A003,AGTGAG,Shigeru_Miyamoto,\r\n'])
+
+    def test_get_samplesheet_parses_once(self):
+        samplesheet = get_samplesheet(self.samplesheet_v4_path)
+        self.assertIs(samplesheet, get_samplesheet(self.samplesheet_v4_path))
+
     def test_get_sample_project_mapping(self):
         bcl2fastq_output_path = path.join(self.run2_dir,
                                           'Data/Intensities/BaseCalls')
@@ -215,6 +261,103 @@ class IlluminaParserTestCase(unittest.TestCase):
 
         self.assertDictEqual(mapping, expected)
 
+    def test_get_fastq_inventory(self):
+        bcl2fastq_output_path = path.join(self.run2_dir,
+                                          'Data/Intensities/BaseCalls')
+        inventory = get_fastq_inventory(bcl2fastq_output_path)
+        self.assertEqual(len(inventory), 17)
+        self.assertEqual([r.path for r in inventory],
+                         sorted(r.path for r in inventory))
+
+        record = next(r for r in inventory
+                      if r.path.endswith('Q1N_S7_L004_R1_001.fastq.gz'))
+        self.assertEqual(record.project, u'Phr00t')
+        self.assertEqual(record.sample, u'16-01787')
+        self.assertEqual(record.fields['sample_name'], 'Q1N')
+        self.assertEqual(record.fields['lane'], 4)
+        self.assertEqual(record.size,
+                         path.getsize(path.join(bcl2fastq_output_path,
+                                                record.path)))
+
+        # listing directories serially gives the same records
+        serial = get_fastq_inventory(bcl2fastq_output_path, threads=1)
+        self.assertEqual([(r.path, r.size, r.project) for r in serial],
+                         [(r.path, r.size, r.project) for r in inventory])
+
+    def test_find_truncated_files(self):
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            basecalls = path.join(tmp_dir, 'Data/Intensities/BaseCalls')
+            for lane in [1, 2]:
+                cycle_dir = path.join(basecalls, 'L00%d' % lane, 'C1.1')
+                os.makedirs(cycle_dir)
+                for tile in [1101, 1102]:
+                    with open(path.join(cycle_dir,
+                                        's_%d_%d.bcl.gz' % (lane, tile)),
+                              'wb') as f:
+                        f.write(_gzip_compress(b'\x01\x00\x00\x00\x20'))
+            # zero size, and too small to hold a complete gzip member
+            open(path.join(basecalls, 'L002/C1.1/s_2_1103.bcl.gz'),
+                 'w').close()
+            with open(path.join(basecalls, 'L002/C1.1/s_2_1104.bcl.gz'),
+                      'wb') as f:
+                f.write(b'\x1f\x8b')
+            # not a BCL file
+            open(path.join(basecalls, 'L001/C1.1/s_1_1101.filter'),
+                 'w').close()
+
+            truncated = find_truncated_files(basecalls)
+            self.assertEqual(dict(truncated),
+                             {2: ['L002/C1.1/s_2_1103.bcl.gz',
+                                  'L002/C1.1/s_2_1104.bcl.gz']})
+            self.assertEqual(
+                sum(len(f) for f in
+                    find_truncated_files(basecalls,
+                                         first_only=True).values()),
+                1)
+
+            bcl2fastq_output_path = path.join(self.run2_dir,
+                                              'Data/Intensities/BaseCalls')
+            self.assertFalse(find_truncated_files(bcl2fastq_output_path,
+                                                  suffixes=FASTQ_SUFFIXES))
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    def test_scan_rta_logs(self):
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            with open(path.join(tmp_dir, '01_Log.txt'), 'wb') as f:
+                f.write(b'9/7/2013\t18:12:53.149\tStarting run\r\n'
+                        b'9/7/2013\t18:13:01.001\tCopy failed, retrying '
+                        b'(Failed 1 time)\r\n'
+                        b'9/7/2013\t18:13:05.500\tCopy succeeded\r\n'
+                        b'Transfer Failed')
+            with open(path.join(tmp_dir, '02_Error.txt'), 'wb') as f:
+                f.write(b'2017-02-17 10:46:02 Disk full\n')
+            open(path.join(tmp_dir, '03_Empty.txt'), 'w').close()
+
+            hits = scan_rta_logs(tmp_dir)
+            self.assertEqual([(path.basename(h.file), h.line_number)
+                              for h in hits],
+                             [('01_Log.txt', 2), ('01_Log.txt', 4)])
+            self.assertEqual(hits[0].timestamp,
+                             datetime(2013, 9, 7, 18, 13, 1, 1000))
+            self.assertEqual(hits[0].line,
+                             u'9/7/2013\t18:13:01.001\tCopy failed, '
+                             u'retrying (Failed 1 time)')
+            self.assertIsNone(hits[1].timestamp)
+
+            hits = scan_rta_logs(tmp_dir, patterns=[r'Disk\s+full', 'Copy'],
+                                 processes=2)
+            self.assertEqual([(path.basename(h.file), h.line_number)
+                              for h in hits],
+                             [('01_Log.txt', 2), ('01_Log.txt', 3),
+                              ('02_Error.txt', 1)])
+            self.assertEqual(hits[2].timestamp,
+                             datetime(2017, 2, 17, 10, 46, 2))
+        finally:
+            shutil.rmtree(tmp_dir)
+
     # TODO: These times and RTA versions aren't actually consistent
     #       with the other times of the mock runs. Make them
     #       consistent.
@@ -238,6 +381,96 @@ class IlluminaParserTestCase(unittest.TestCase):
         self.assertEqual(fq_info.get('read', None), 2)
         self.assertEqual(fq_info.get('set_number', None), 1)
 
+    def test_fastq_filename_matcher(self):
+        matcher = FastqFilenameMatcher(
+            patterns=['{sample_name}_{lane}_{read}',
+                      r'(?P<sample_name>[A-Z]+)-(?P<read>\d)'],
+            suffix='.fq.gz')
+        self.assertEqual(matcher.match('/data/ABC_L002_R1.fq.gz'),
+                         {'sample_name': 'ABC', 'lane': 2, 'read': 1})
+        self.assertEqual(matcher.match('XYZ-2.fq.gz'),
+                         {'sample_name': 'XYZ', 'read': 2})
+        self.assertIsNone(matcher.match('XYZ-2.fastq.gz'))
+
+        # memoized, but callers can't modify the memoized result
+        matcher.match('XYZ-2.fq.gz')['read'] = 3
+        self.assertEqual(matcher.match('XYZ-2.fq.gz')['read'], 2)
+
+        set_fastq_filename_patterns(['{sample_name}-{lane}'])
+        try:
+            fq_info = parse_sample_info_from_filename('DMSO-L007.fastq.gz')
+            self.assertEqual(fq_info, {'sample_name': 'DMSO', 'lane': 7})
+        finally:
+            set_fastq_filename_patterns(None)
+        self.assertEqual(
+            parse_sample_info_from_filename(
+                'DMSO-7_S7_L008_I2_001.fastq.gz')['sample_name'],
+            'DMSO-7')
+
+    def test_get_number_of_reads_fastq(self):
+        # bcl2fastq output is BGZF (blocked, multi-member gzip)
+        fastq_path = path.join(
+            self.run1_dir,
+            '130907_SNL177_0001_AH9PJLADXZ.bcl2fastq/Project_GusFring/'
+            'Sample_14-06200-Input/14-06200-Input_TTGGCA_L001_R1_001.fastq.gz')
+        self.assertEqual(get_number_of_reads_fastq(fastq_path), 2000)
+        self.assertEqual(get_number_of_reads_fastq(fastq_path, threads=4),
+                         2000)
+
+        # plain gzip, with two concatenated members
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            plain_path = path.join(tmp_dir, 'plain_R1_001.fastq.gz')
+            record = b'@read\nACGT\n+\nFFFF\n'
+            with open(plain_path, 'wb') as f:
+                for _ in range(2):
+                    f.write(_gzip_compress(record * 3))
+            self.assertEqual(get_number_of_reads_fastq(plain_path), 6)
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    def test_get_fastq_stats(self):
+        fastq_path = path.join(
+            self.run1_dir,
+            '130907_SNL177_0001_AH9PJLADXZ.bcl2fastq/Project_GusFring/'
+            'Sample_14-06200-Input/14-06200-Input_TTGGCA_L001_R1_001.fastq.gz')
+        md5sum = 'ff63ae7d95e95206d59a9c8069bea0cb'
+        stats, digests = get_fastq_stats(fastq_path)
+        self.assertDictEqual(stats, {'number_of_reads': 2000,
+                                     'read_length': 51,
+                                     'min_read_length': 51,
+                                     'percent_gc': 52.0})
+        self.assertEqual(digests, {'md5': md5sum})
+
+        # several digests from the same pass over the file, returned in the
+        # same form
+        _, digests = get_fastq_stats(fastq_path, digests=['md5', 'sha512'])
+        with open(fastq_path, 'rb') as f:
+            sha512sum = hashlib.sha512(f.read()).hexdigest()
+        self.assertEqual(digests, {'md5': md5sum, 'sha512': sha512sum})
+
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            fastq_path = path.join(tmp_dir, 'mixed_R1_001.fastq.gz')
+            with open(fastq_path, 'wb') as f:
+                f.write(_gzip_compress(b'@r1\nGGCCNN\n+\nFFFFFF\n'
+                                       b'@r2\nAT\n+\nFF\n'))
+            stats, _ = get_fastq_stats(fastq_path)
+            self.assertDictEqual(stats, {'number_of_reads': 2,
+                                         'read_length': 6,
+                                         'min_read_length': 2,
+                                         'percent_gc': 67.0})
+        finally:
+            shutil.rmtree(tmp_dir)
+
+
+def _gzip_compress(data):
+    from io import BytesIO
+    buf = BytesIO()
+    with gzip.GzipFile(fileobj=buf, mode='wb') as f:
+        f.write(data)
+    return buf.getvalue()
+
 
 class VersionTest(unittest.TestCase):
     def setUp(self):
@@ -0,0 +1,504 @@
+import os
+import sys
+import json
+import hashlib
+import threading
+import shutil
+import tempfile
+import unittest
+import zipfile
+from collections import OrderedDict
+from concurrent.futures import Future
+from os import path
+
+# illumina_uploader uses script-style imports (eg 'from models import ...'),
+# so like the illumina_uploader script we need the package directories on
+# the path to import it
+sys.path.insert(0, path.join(path.dirname(__file__),
+                             '..', 'mytardis_ngs_ingestor'))
+sys.path.append(path.join(path.dirname(__file__),
+                          '..', 'mytardis_ngs_ingestor', 'illumina'))
+
+import illumina_uploader
+from mytardis_uploader import MyTardisUploader
+from utils import checksums
+from utils import journal
+from mytardis_ngs_ingestor.illumina import fastqc
+from mytardis_ngs_ingestor.illumina.run_info import get_samplesheet, \
+    set_fastq_filename_patterns
+
+from tests.test_uploader import StandInServer
+
+TEST_DATA = path.join(path.dirname(__file__), 'test_data')
+
+
+class RecordingScheduler(object):
+    """
+    Stands in for fastqc.FastqcScheduler, recording the projects submitted
+    rather than running FastQC.
+    """
+    def __init__(self):
+        self.submitted = []
+
+    def submit_project(self, fastq_paths, output_directory, on_complete=None):
+        self.submitted.append((fastq_paths, output_directory))
+        future = Future()
+        future.set_result((output_directory, {}))
+        return future
+
+
+class PipelineFastqcTest(unittest.TestCase):
+    def setUp(self):
+        illumina_uploader.TMPDIRS = []
+        self.output_dir = tempfile.mkdtemp()
+        self.projects = OrderedDict()
+        for i in range(5):
+            proj_id = 'Project_%d' % i
+            os.mkdir(path.join(self.output_dir, proj_id))
+            self.projects[proj_id] = [
+                path.join(self.output_dir, proj_id,
+                          'Sample%d_S%d_L001_R1_001.fastq.gz' % (i, i))]
+
+    def tearDown(self):
+        shutil.rmtree(self.output_dir)
+        illumina_uploader._cleanup_tmp()
+
+    def _pipeline(self, scheduler, depth=2):
+        return illumina_uploader.pipeline_fastqc_for_projects(
+            self.projects,
+            self.output_dir,
+            samplesheet=None,
+            scheduler=scheduler,
+            depth=depth)
+
+    def test_projects_yielded_in_order(self):
+        scheduler = RecordingScheduler()
+        yielded = [(proj_id, fastq_files)
+                   for proj_id, fastq_files, _ in self._pipeline(scheduler)]
+        self.assertEqual(yielded, list(self.projects.items()))
+        # FastQC is queued in the same order
+        self.assertEqual([fastq_files for fastq_files, _
+                          in scheduler.submitted],
+                         list(self.projects.values()))
+
+    def test_depth_limits_projects_queued_ahead(self):
+        for depth in (0, 1, 2, 10):
+            scheduler = RecordingScheduler()
+            for i, (proj_id, _, job) in enumerate(
+                    self._pipeline(scheduler, depth=depth)):
+                # the yielded project, and at most depth after it
+                self.assertEqual(len(scheduler.submitted),
+                                 min(i + 1 + depth, len(self.projects)))
+                self.assertEqual(job.result()[0],
+                                 scheduler.submitted[i][1])
+
+    def test_projects_with_fastqc_output_are_skipped(self):
+        os.mkdir(path.join(self.output_dir, 'Project_1', 'FastQC.out'))
+        scheduler = RecordingScheduler()
+        jobs = dict((proj_id, job)
+                    for proj_id, _, job in self._pipeline(scheduler))
+
+        self.assertIsNone(jobs['Project_1'])
+        self.assertEqual(len(scheduler.submitted), len(self.projects) - 1)
+        self.assertNotIn(self.projects['Project_1'],
+                         [fastq_files for fastq_files, _
+                          in scheduler.submitted])
+        # existing output is never written to
+        self.assertEqual(
+            os.listdir(path.join(self.output_dir, 'Project_1', 'FastQC.out')),
+            [])
+
+    def test_no_scheduler(self):
+        yielded = list(self._pipeline(None))
+        self.assertEqual([(proj_id, fastq_files)
+                          for proj_id, fastq_files, _ in yielded],
+                         list(self.projects.items()))
+        self.assertTrue(all(job is None for _, _, job in yielded))
+        # no temporary output directories are created
+        self.assertEqual(illumina_uploader.TMPDIRS, [])
+
+
+class RecordingUploader(object):
+    """
+    Stands in for MyTardisUploader, recording the files uploaded.
+    """
+    storage_mode = 'upload'
+
+    def __init__(self):
+        self.uploaded = []
+
+    def upload_file(self, file_path, dataset_url, **kwargs):
+        with open(file_path, 'rb') as f:
+            self.uploaded.append((path.basename(file_path), dataset_url,
+                                  f.read()))
+
+
+class UploadFastqcReportsTest(unittest.TestCase):
+    def setUp(self):
+        self.fastqc_out_dir = tempfile.mkdtemp()
+        self.fastqc_zip = path.join(self.fastqc_out_dir,
+                                    'Q1N_S7_L004_R1_001_fastqc.zip')
+        shutil.copy(path.join(TEST_DATA, 'fastqc',
+                              'Q1N_S7_L004_R1_001_fastqc.zip'),
+                    self.fastqc_zip)
+
+    def tearDown(self):
+        fastqc.clear_fastqc_results()
+        shutil.rmtree(self.fastqc_out_dir)
+
+    def test_upload_fastqc_reports(self):
+        uploader = RecordingUploader()
+        illumina_uploader.upload_fastqc_reports(self.fastqc_out_dir,
+                                                '/api/v1/dataset/1/',
+                                                uploader)
+
+        result = fastqc.get_fastqc_result(self.fastqc_zip)
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            with open(result.extract_report(tmp_dir), 'rb') as f:
+                report = f.read()
+        finally:
+            shutil.rmtree(tmp_dir)
+        # FastQC 0.11.3 reports already have inline images, so are
+        # uploaded as they are
+        self.assertEqual(uploader.uploaded,
+                         [('Q1N_S7_L004_R1_001_fastqc.html',
+                           '/api/v1/dataset/1/',
+                           report)])
+
+
+class FastqcSummaryTest(unittest.TestCase):
+    def setUp(self):
+        self.fastqc_out_dir = tempfile.mkdtemp()
+        self.samplesheet = get_samplesheet(path.join(
+            TEST_DATA, 'runs', '150907_M04242_0003_000000000-ANV1L',
+            'SampleSheet.csv'))
+
+        # FastQC output for each sample in the SampleSheet, based on the
+        # output for a single sample
+        example_id = 'Q1N_S7_L004_R1_001'
+        with zipfile.ZipFile(path.join(TEST_DATA, 'fastqc',
+                                       example_id + '_fastqc.zip')) as zf:
+            members = dict((path.basename(name), zf.read(name))
+                           for name in ('%s_fastqc/summary.txt' % example_id,
+                                        '%s_fastqc/fastqc_data.txt' %
+                                        example_id))
+        for sample_id in ('DRUGS-2_S4_L001_R1_001', 'BUGS-1_S1_L001_R1_001',
+                          'DRUGS-1_S3_L001_R1_001', 'BUGS-2_S2_L001_R1_001'):
+            zip_path = path.join(self.fastqc_out_dir,
+                                 sample_id + '_fastqc.zip')
+            with zipfile.ZipFile(zip_path, 'w') as zf:
+                for filename, content in members.items():
+                    zf.writestr('%s_fastqc/%s' % (sample_id, filename),
+                                content.replace(example_id.encode('ascii'),
+                                                sample_id.encode('ascii')))
+
+    def tearDown(self):
+        set_fastq_filename_patterns(None)
+        fastqc.clear_fastqc_results()
+        shutil.rmtree(self.fastqc_out_dir)
+
+    def _sample_names(self):
+        summary = illumina_uploader.get_fastqc_summary_for_project(
+            self.fastqc_out_dir, self.samplesheet)
+        return [(sample['sample_name'], sample['lane'], sample['read'])
+                for sample in summary['samples']]
+
+    def test_samples_in_samplesheet_order(self):
+        self.assertEqual(self._sample_names(),
+                         [('BUGS-1', 1, 1), ('BUGS-2', 1, 1),
+                          ('DRUGS-1', 1, 1), ('DRUGS-2', 1, 1)])
+
+    def test_filename_pattern_without_lane_or_read(self):
+        set_fastq_filename_patterns(['{sample_name}_{sample_number}_.*'])
+        self.assertEqual(self._sample_names(),
+                         [('BUGS-1', None, None), ('BUGS-2', None, None),
+                          ('DRUGS-1', None, None), ('DRUGS-2', None, None)])
+
+        # without a sample number, samples are found in the SampleSheet by
+        # name alone
+        set_fastq_filename_patterns([r'{sample_name}_S\d+_.*'])
+        self.assertEqual(self._sample_names(),
+                         [('BUGS-1', None, None), ('BUGS-2', None, None),
+                          ('DRUGS-1', None, None), ('DRUGS-2', None, None)])
+
+
+class RegisterProjectFastqDatafilesTest(unittest.TestCase):
+    sample_ids = ('BUGS-1_S1_L001_R1_001', 'BUGS-2_S2_L001_R1_001',
+                  'DRUGS-1_S3_L001_R1_001', 'DRUGS-2_S4_L001_R1_001')
+
+    def setUp(self):
+        self.server = StandInServer()
+        self.server_thread = threading.Thread(
+            target=self.server.serve_forever)
+        self.server_thread.daemon = True
+        self.server_thread.start()
+        self.uploader = MyTardisUploader(self.server.url,
+                                         'testuser',
+                                         api_key='notasecret')
+
+        self.data_dir = tempfile.mkdtemp()
+        self.samplesheet = get_samplesheet(path.join(
+            TEST_DATA, 'runs', '150907_M04242_0003_000000000-ANV1L',
+            'SampleSheet.csv'))
+        self.fastq_paths = []
+        samples = []
+        for i, sample_id in enumerate(self.sample_ids):
+            fastq_path = path.join(self.data_dir, sample_id + '.fastq.gz')
+            with open(fastq_path, 'wb') as f:
+                f.write(os.urandom(1000 * (i + 1)))
+            self.fastq_paths.append(fastq_path)
+            samples.append({'filename': path.basename(fastq_path),
+                            'sample_id': sample_id,
+                            'basic_stats': {'number_of_reads': 10,
+                                            'read_length': 151,
+                                            'percent_gc': 50.0}})
+        # read statistics come from FastQC, so the files are only read for
+        # their checksums
+        self.fastqc_data = {'samples': samples}
+        self.run_journal = None
+
+    def tearDown(self):
+        if self.run_journal is not None:
+            self.run_journal.close()
+        self.uploader.close()
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.data_dir)
+
+    def _register(self, **kwargs):
+        illumina_uploader.register_project_fastq_datafiles(
+            'RUN1',
+            self.fastq_paths,
+            self.samplesheet,
+            '/api/v1/dataset/1/',
+            self.uploader,
+            fastqc_data=self.fastqc_data,
+            **kwargs)
+
+    def _md5(self, i):
+        with open(self.fastq_paths[i], 'rb') as f:
+            return hashlib.md5(f.read()).hexdigest()
+
+    def _posted(self):
+        return [json.loads(body.decode('utf-8'))
+                for method, _, body in self.server.requests
+                if method == 'POST']
+
+    def _share(self, batch_size):
+        self.uploader.storage_mode = 'shared'
+        self.uploader.storage_box_location = self.data_dir
+        self.uploader.datafile_batch_size = batch_size
+        self.run_journal = journal.IngestJournal(
+            path.join(self.data_dir, 'RUN1.journal'))
+
+    def _assert_journaled(self, datafile_urls):
+        self.assertEqual(
+            [self.run_journal.get('fastq_datafile', name=p)
+             for p in self.fastq_paths],
+            datafile_urls)
+
+    def test_register_serially(self):
+        self._share(batch_size=1)
+        self._register(threads=2, run_journal=self.run_journal)
+
+        # sent concurrently, so in any order
+        posted = dict((d['filename'], d) for d in self._posted())
+        self.assertEqual(len(posted), len(self.server.requests))
+        for i, fastq_path in enumerate(self.fastq_paths):
+            datafile = posted[path.basename(fastq_path)]
+            self.assertEqual(datafile['md5sum'], self._md5(i))
+            self.assertEqual(datafile['replicas'][0]['url'],
+                             path.basename(fastq_path))
+        self.assertEqual(
+            sorted(self.run_journal.values('fastq_datafile')),
+            sorted('/api/v1/dataset_file/%d/' % (i + 1)
+                   for i in range(len(self.fastq_paths))))
+
+        # already registered Datafiles are skipped when resuming
+        self._register(run_journal=self.run_journal)
+        self.assertEqual(len(self.server.requests), len(self.fastq_paths))
+
+    def test_register_in_batches(self):
+        self._share(batch_size=2)
+        self._register(threads=2, run_journal=self.run_journal)
+
+        self.assertEqual([r[0] for r in self.server.requests],
+                         ['PATCH', 'PATCH'])
+        self.assertEqual([d['filename'] for d in self.server.datafiles],
+                         [path.basename(p) for p in self.fastq_paths])
+        self.assertEqual([d['md5sum'] for d in self.server.datafiles],
+                         [self._md5(i) for i in range(len(self.fastq_paths))])
+        self._assert_journaled([d['resource_uri']
+                                for d in self.server.datafiles])
+
+    def test_register_rejected_batch_falls_back(self):
+        self.server.accept_batches = False
+        self._share(batch_size=3)
+        self._register(run_journal=self.run_journal)
+
+        # the last batch is a single Datafile, so isn't sent as a batch
+        self.assertEqual([r[0] for r in self.server.requests],
+                         ['PATCH'] + ['POST'] * 4)
+        self.assertEqual([d['filename'] for d in self._posted()],
+                         [path.basename(p) for p in self.fastq_paths])
+        self._assert_journaled(['/api/v1/dataset_file/%d/' % (i + 2)
+                                for i in range(len(self.fastq_paths))])
+
+    def test_deferred_checksums_are_queued(self):
+        self._share(batch_size=2)
+        checksum_queue = journal.IngestJournal(
+            path.join(self.data_dir,
+                      'RUN1' + illumina_uploader.CHECKSUM_QUEUE_SUFFIX))
+        self._register(run_journal=self.run_journal,
+                       checksum_queue=checksum_queue)
+
+        self.assertEqual(
+            [d['md5sum'] for d in self.server.datafiles],
+            [checksums.PENDING_CHECKSUM] * len(self.fastq_paths))
+        queued = dict(checksum_queue.items('pending_checksum'))
+        self.assertEqual(sorted(queued), sorted(self.fastq_paths))
+        for fastq_path, datafile in zip(self.fastq_paths,
+                                        self.server.datafiles):
+            stat = os.stat(fastq_path)
+            self.assertEqual(queued[fastq_path],
+                             {'digests': ['md5'],
+                              'size': stat.st_size,
+                              'mtime': stat.st_mtime,
+                              'datafile': datafile['resource_uri']})
+        checksum_queue.close()
+
+    def test_upload_checksums_calculated_while_sending(self):
+        self._register(threads=2)
+
+        posts = [r for r in self.server.requests if r[0] == 'POST']
+        self.assertEqual(len(posts), len(self.fastq_paths))
+        md5s = {}
+        for _, _, body in posts:
+            # json_data follows the file, with the checksum
+            self.assertLess(body.index(b'name="attached_file"'),
+                            body.index(b'name="json_data"'))
+            json_data = body.split(b'name="json_data"\r\n\r\n')[1]
+            json_data = json.loads(
+                json_data.split(b'\r\n')[0].decode('utf-8'))
+            md5s[json_data['filename']] = json_data['md5sum']
+        self.assertEqual(md5s,
+                         dict((path.basename(p), self._md5(i))
+                              for i, p in enumerate(self.fastq_paths)))
+
+
+class BackfillChecksumsTest(unittest.TestCase):
+    def setUp(self):
+        self.server = StandInServer()
+        self.server_thread = threading.Thread(
+            target=self.server.serve_forever)
+        self.server_thread.daemon = True
+        self.server_thread.start()
+        self.uploader = MyTardisUploader(self.server.url,
+                                         'testuser',
+                                         api_key='notasecret',
+                                         digests=['md5', 'sha512'])
+
+        self.data_dir = tempfile.mkdtemp()
+        self.journal_dir = path.join(self.data_dir, 'journals')
+        self.queue_path = path.join(
+            self.journal_dir,
+            'RUN1' + illumina_uploader.CHECKSUM_QUEUE_SUFFIX)
+
+        # Datafiles registered with pending checksums by --defer-checksums
+        checksum_queue = journal.IngestJournal(self.queue_path)
+        self.fastq_paths = []
+        for i in range(4):
+            fastq_path = path.join(self.data_dir, 'reads_%d.fastq.gz' % i)
+            with open(fastq_path, 'wb') as f:
+                f.write(b'@read\nACGT\n+\nFFFF\n' * (i + 1))
+            stat = os.stat(fastq_path)
+            checksum_queue.record('pending_checksum',
+                                  {'digests': ['md5', 'sha512'],
+                                   'size': stat.st_size,
+                                   'mtime': stat.st_mtime,
+                                   'datafile':
+                                       '/api/v1/dataset_file/%d/' % (i + 1)},
+                                  name=fastq_path)
+            self.fastq_paths.append(fastq_path)
+        checksum_queue.close()
+
+    def tearDown(self):
+        self.uploader.close()
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.data_dir)
+
+    def _backfill(self):
+        return illumina_uploader.set_pending_checksums(self.uploader,
+                                                       self.journal_dir,
+                                                       processes=2)
+
+    def _patched(self):
+        patched = {}
+        for method, url, body in self.server.requests:
+            self.assertEqual(method, 'PATCH')
+            patched[url] = json.loads(body.decode('utf-8'))
+        return patched
+
+    def _digest_fields(self, i):
+        with open(self.fastq_paths[i], 'rb') as f:
+            content = f.read()
+        return {'md5sum': hashlib.md5(content).hexdigest(),
+                'sha512sum': hashlib.sha512(content).hexdigest()}
+
+    def test_backfill_sets_checksums(self):
+        self.assertEqual(self._backfill(), 0)
+
+        self.assertEqual(self._patched(),
+                         dict(('/api/v1/dataset_file/%d/' % (i + 1),
+                               self._digest_fields(i))
+                              for i in range(4)))
+        # nothing left to do
+        self.assertFalse(path.exists(self.queue_path))
+        self.assertEqual(self._backfill(), 0)
+        self.assertEqual(len(self.server.requests), 4)
+
+    def test_backfill_resumes(self):
+        # a previous backfill set the first two before it was interrupted
+        checksum_queue = journal.IngestJournal(self.queue_path, resume=True)
+        for i in range(2):
+            checksum_queue.record('checksum_done',
+                                  '/api/v1/dataset_file/%d/' % (i + 1),
+                                  name=self.fastq_paths[i])
+        checksum_queue.close()
+
+        self.assertEqual(self._backfill(), 0)
+        self.assertEqual(sorted(self._patched()),
+                         ['/api/v1/dataset_file/3/',
+                          '/api/v1/dataset_file/4/'])
+        self.assertFalse(path.exists(self.queue_path))
+
+    def test_modified_files_are_reported(self):
+        with open(self.fastq_paths[1], 'ab') as f:
+            f.write(b'@extra\nACGT\n+\nFFFF\n')
+        os.remove(self.fastq_paths[2])
+
+        self.assertEqual(self._backfill(), 2)
+        self.assertEqual(sorted(self._patched()),
+                         ['/api/v1/dataset_file/1/',
+                          '/api/v1/dataset_file/4/'])
+
+        # the queue is finished with, and kept as a report of the failures
+        self.assertFalse(path.exists(self.queue_path))
+        report_path = path.join(
+            self.journal_dir,
+            'RUN1' + illumina_uploader.CHECKSUM_FAILURES_SUFFIX)
+        report = journal.IngestJournal(report_path, resume=True)
+        self.assertEqual(sorted(report.items('checksum_failed')),
+                         [(self.fastq_paths[1], 'modified'),
+                          (self.fastq_paths[2], 'missing')])
+        report.close()
+
+        # so later backfills don't fail on the same files again
+        self.assertEqual(self._backfill(), 0)
+        self.assertEqual(len(self.server.requests), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
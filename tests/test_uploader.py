@@ -0,0 +1,428 @@
+import os
+import sys
+import json
+import hashlib
+import shutil
+import tempfile
+import threading
+import unittest
+from os import path
+from six.moves.BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from six.moves.socketserver import ThreadingMixIn
+from six.moves.urllib.parse import parse_qs
+
+# mytardis_uploader uses script-style imports (eg 'from __init__ import ...'),
+# so like the illumina_uploader script we need the package directory on the
+# path to import it
+sys.path.insert(0, path.join(path.dirname(__file__),
+                             '..', 'mytardis_ngs_ingestor'))
+
+from mytardis_ngs_ingestor import mytardis_uploader
+from mytardis_ngs_ingestor.mytardis_uploader import MyTardisUploader
+
+
+class StandInRequestHandler(BaseHTTPRequestHandler):
+    """
+    Answers every request like a (very forgetful) MyTardis server would,
+    recording the requests made and the number of TCP connections opened.
+    """
+    protocol_version = 'HTTP/1.1'
+    # headers and body are written separately, so avoid Nagle / delayed ACK
+    # stalls on keep-alive connections
+    disable_nagle_algorithm = True
+
+    def setup(self):
+        BaseHTTPRequestHandler.setup(self)
+        with self.server.lock:
+            self.server.connections += 1
+
+    def log_message(self, format, *args):
+        pass
+
+    def _respond(self):
+        length = int(self.headers.get('Content-Length', 0) or 0)
+        body = self.rfile.read(length) if length else b''
+        with self.server.lock:
+            self.server.requests.append((self.command, self.path, body))
+            object_id = len(self.server.requests)
+
+        objects = []
+        status = 201 if self.command == 'POST' else 200
+        with self.server.lock:
+            failing = self.server.fail_next > 0
+            self.server.fail_next -= 1
+        if failing:
+            # Bad Gateway, retried by the uploader
+            status = 502
+        if self.command == 'POST' and self.path.endswith('/objectacl/'):
+            entity_id = json.loads(body.decode('utf-8'))['entityId']
+            if int(entity_id) in self.server.rejected_entity_ids:
+                status = 400
+        if self.command == 'GET':
+            resource = self.path.split('?')[0].rstrip('/').split('/')[-1]
+            objects = self.server.lookup_objects.get(resource, [])
+            if resource == 'dataset_file':
+                objects, status = self._find_datafiles()
+        returned = True
+        if self.command == 'PATCH' and self.path.endswith('/dataset_file/'):
+            # a Tastypie list PATCH, with always_return_data unless
+            # return_batch_objects is False
+            with self.server.lock:
+                failing_batch = self.server.fail_batches > 0
+                self.server.fail_batches -= 1
+            if not self.server.accept_batches:
+                status = 405
+            elif failing_batch:
+                status = 500
+            else:
+                status = 202
+                for i, obj in enumerate(
+                        json.loads(body.decode('utf-8'))['objects']):
+                    obj['resource_uri'] = '/api/v1/dataset_file/%d/' % (
+                        object_id * 1000 + i)
+                    objects.append(obj)
+                with self.server.lock:
+                    self.server.datafiles.extend(objects)
+                returned = self.server.return_batch_objects
+
+        content = b''
+        if returned:
+            content = json.dumps({'objects': objects}).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(content)))
+        self.send_header('Location',
+                         '/api/v1/dataset_file/%d/' % object_id)
+        self.end_headers()
+        self.wfile.write(content)
+
+    def _find_datafiles(self):
+        # the DataFiles created by batches, filtered like Tastypie would
+        query = parse_qs(self.path.partition('?')[2])
+        if 'filename__in' in query and not self.server.filename_in_filter:
+            return [], 400
+        dataset_id = int(query['dataset__id'][0])
+        filenames = None
+        if 'filename__in' in query:
+            filenames = set(query['filename__in'][0].split(','))
+        elif 'filename' in query:
+            filenames = set(query['filename'])
+        with self.server.lock:
+            return [o for o in self.server.datafiles
+                    if o['dataset'] == '/api/v1/dataset/%d/' % dataset_id and
+                    (filenames is None or o['filename'] in filenames)], 200
+
+    do_GET = _respond
+    do_POST = _respond
+    do_PUT = _respond
+    do_PATCH = _respond
+
+
+class StandInServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def __init__(self):
+        HTTPServer.__init__(self, ('127.0.0.1', 0), StandInRequestHandler)
+        self.lock = threading.Lock()
+        self.connections = 0
+        self.requests = []
+        self.accept_batches = True
+        # if False, batches are answered with 202 Accepted and no content
+        # (MyTardis's default), so created DataFiles have to be looked up
+        self.return_batch_objects = True
+        self.filename_in_filter = True
+        # the number of batches answered with 500 Internal Server Error
+        self.fail_batches = 0
+        # DataFiles created by batches
+        self.datafiles = []
+        # objects returned by GET requests, by resource name
+        self.lookup_objects = {}
+        # users / groups that experiments can't be shared with (eg deleted)
+        self.rejected_entity_ids = set()
+        # the number of requests answered with an error before succeeding
+        self.fail_next = 0
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:%d' % self.server_address[1]
+
+
+class UploaderTestCase(unittest.TestCase):
+    def setUp(self):
+        self.server = StandInServer()
+        self.server_thread = threading.Thread(
+            target=self.server.serve_forever)
+        self.server_thread.daemon = True
+        self.server_thread.start()
+
+        self.uploader = MyTardisUploader(self.server.url,
+                                         'testuser',
+                                         api_key='notasecret')
+
+    def tearDown(self):
+        self.uploader.close()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_connections_are_reused(self):
+        for i in range(20):
+            self.uploader.query_instrument(u'HiSeq %d' % i)
+
+        self.assertEqual(len(self.server.requests), 20)
+        self.assertEqual(self.server.connections, 1)
+
+    def _datafile_dicts(self, n):
+        return [{u'dataset': u'/api/v1/dataset/1/',
+                 u'filename': u'reads_%d.fastq.gz' % i,
+                 u'size': i,
+                 u'md5sum': u'0' * 32,
+                 u'replicas': [{u'url': u'run/reads_%d.fastq.gz' % i,
+                                u'location': u'default',
+                                u'protocol': u'file'}]}
+                for i in range(n)]
+
+    def test_register_datafiles_in_batches(self):
+        self.uploader.storage_mode = 'shared'
+        urls = self.uploader.register_datafiles(self._datafile_dicts(250),
+                                                batch_size=100)
+
+        # 3 requests rather than 250
+        self.assertEqual(len(self.server.requests), 3)
+        self.assertEqual([r[0] for r in self.server.requests],
+                         ['PATCH'] * 3)
+        self.assertEqual(len(urls), 250)
+        self.assertEqual(len(set(urls)), 250)
+        # URIs are returned in the order the files were given
+        self.assertEqual(urls[:2], ['/api/v1/dataset_file/1000/',
+                                    '/api/v1/dataset_file/1001/'])
+        self.assertEqual(urls[-1], '/api/v1/dataset_file/3049/')
+
+    def test_register_datafiles_rejected_batch_falls_back(self):
+        self.server.accept_batches = False
+        self.uploader.storage_mode = 'shared'
+        urls = self.uploader.register_datafiles(self._datafile_dicts(10),
+                                                batch_size=5)
+
+        # one rejected batch, then a POST per Datafile
+        self.assertEqual([r[0] for r in self.server.requests],
+                         ['PATCH'] + ['POST'] * 10)
+        self.assertFalse(self.uploader.batch_registration)
+        self.assertEqual(len(urls), 10)
+        self.assertTrue(all(u.endswith('/api/v1/dataset_file/%d/' % (i + 2))
+                            for i, u in enumerate(urls)))
+
+    def test_register_datafiles_failed_batch_falls_back(self):
+        self.server.fail_batches = 1
+        self.uploader.storage_mode = 'shared'
+        registered = []
+        urls = self.uploader.register_datafiles(
+            self._datafile_dicts(10),
+            batch_size=5,
+            on_registered=lambda i, url: registered.append((i, url)))
+
+        # the failed batch is registered a Datafile at a time, later
+        # batches are still sent together
+        self.assertEqual([r[0] for r in self.server.requests],
+                         ['PATCH'] + ['POST'] * 5 + ['PATCH'])
+        self.assertTrue(self.uploader.batch_registration)
+        self.assertEqual(len(set(urls)), 10)
+        self.assertEqual(registered, list(enumerate(urls)))
+
+    def _get_requests(self):
+        return [parse_qs(r[1].partition('?')[2])
+                for r in self.server.requests if r[0] == 'GET']
+
+    def test_register_datafiles_without_returned_objects(self):
+        self.server.return_batch_objects = False
+        self.uploader.storage_mode = 'shared'
+        file_dicts = self._datafile_dicts(250)
+        urls = self.uploader.register_datafiles(file_dicts, batch_size=100)
+
+        self.assertEqual(urls, [o['resource_uri']
+                                for o in self.server.datafiles])
+        # each batch's DataFiles are looked up by filename, rather than
+        # listing every DataFile in the Dataset
+        self.assertEqual([r[0] for r in self.server.requests],
+                         ['PATCH', 'GET'] * 3)
+        gets = self._get_requests()
+        self.assertEqual(
+            [len(q['filename__in'][0].split(',')) for q in gets],
+            [100, 100, 50])
+        self.assertEqual(set(gets[2]['filename__in'][0].split(',')),
+                         set(d[u'filename'] for d in file_dicts[200:]))
+
+        # registering the same files again finds the new DataFiles
+        self.server.requests = []
+        urls = self.uploader.register_datafiles(file_dicts[:10],
+                                                batch_size=100)
+        self.assertEqual(urls, [o['resource_uri']
+                                for o in self.server.datafiles[250:]])
+
+    def test_register_datafiles_without_filename_in_filter(self):
+        self.server.return_batch_objects = False
+        self.server.filename_in_filter = False
+        self.uploader.storage_mode = 'shared'
+        urls = self.uploader.register_datafiles(self._datafile_dicts(10),
+                                                batch_size=5)
+
+        self.assertEqual(urls, [o['resource_uri']
+                                for o in self.server.datafiles])
+        self.assertFalse(self.uploader.filename_in_filter)
+        # one rejected filter, then a lookup per filename
+        self.assertEqual([r[0] for r in self.server.requests],
+                         ['PATCH'] + ['GET'] * 6 + ['PATCH'] + ['GET'] * 5)
+        self.assertEqual([sorted(q) for q in self._get_requests()[1:]],
+                         [['dataset__id', 'filename', 'limit']] * 10)
+
+    def test_lookups_are_cached(self):
+        self.server.lookup_objects['group'] = [
+            {'id': 7, 'name': 'facility',
+             'resource_uri': '/api/v1/group/7/'}]
+        for i in range(10):
+            self.uploader.share_experiment_with_group(
+                '/api/v1/experiment/%d/' % i, 'facility')
+            # no instrument is defined, so these aren't cached
+            self.uploader.query_instrument(u'HiSeq')
+
+        methods = [(r[0], r[1].split('?')[0]) for r in self.server.requests]
+        self.assertEqual(methods.count(('GET', '/api/v1/group/')), 1)
+        self.assertEqual(methods.count(('GET', '/api/v1/instrument/')), 10)
+        self.assertEqual(methods.count(('POST', '/api/v1/objectacl/')), 10)
+
+        self.uploader.lookups.invalidate('group')
+        self.uploader.query_group('facility')
+        methods = [(r[0], r[1].split('?')[0]) for r in self.server.requests]
+        self.assertEqual(methods.count(('GET', '/api/v1/group/')), 2)
+
+    def test_cached_lookups_are_copies(self):
+        self.server.lookup_objects['instrument'] = [
+            {'id': 3, 'name': 'HiSeq', 'resource_uri': '/api/v1/instrument/3/'}]
+        result = self.uploader.query_instrument(u'HiSeq')
+        result['objects'][0]['id'] = 99
+        result = self.uploader.query_instrument(u'HiSeq')
+        self.assertEqual(result['objects'][0]['id'], 3)
+        result['objects'].pop()
+        self.assertEqual(
+            self.uploader.query_instrument(u'HiSeq')['objects'][0]['id'], 3)
+        # only the first query was sent to the server
+        self.assertEqual(len(self.server.requests), 1)
+
+    def test_failed_share_refreshes_cached_id(self):
+        self.server.lookup_objects['group'] = [
+            {'id': 7, 'name': 'facility',
+             'resource_uri': '/api/v1/group/7/'}]
+        self.uploader.query_group('facility')
+
+        # the group was recreated on the server with a new ID
+        self.server.rejected_entity_ids.add(7)
+        self.server.lookup_objects['group'] = [
+            {'id': 8, 'name': 'facility',
+             'resource_uri': '/api/v1/group/8/'}]
+        self.server.requests = []
+        response = self.uploader.share_experiment_with_group(
+            '/api/v1/experiment/1/', 'facility')
+
+        self.assertTrue(response.ok)
+        requests = [(r[0], r[1].split('?')[0]) for r in self.server.requests]
+        self.assertEqual(requests, [('POST', '/api/v1/objectacl/'),
+                                    ('GET', '/api/v1/group/'),
+                                    ('POST', '/api/v1/objectacl/')])
+        self.assertEqual(
+            [json.loads(r[2].decode('utf-8'))['entityId']
+             for r in self.server.requests if r[0] == 'POST'],
+            ['7', '8'])
+        # and the fresh ID is cached
+        self.assertEqual(
+            self.uploader.query_group('facility')['objects'][0]['id'], 8)
+        self.assertEqual(len(self.server.requests), 3)
+
+    def _upload(self, content, **kwargs):
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            file_path = path.join(tmp_dir, 'reads.fastq.gz')
+            with open(file_path, 'wb') as f:
+                f.write(content)
+            return self.uploader.upload_file(file_path, '/api/v1/dataset/1/',
+                                             **kwargs)
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    def _json_data(self, body):
+        json_data = body.split(b'name="json_data"\r\n\r\n')[1]
+        return json.loads(json_data.split(b'\r\n')[0].decode('utf-8'))
+
+    def test_upload_is_resent_on_retry(self):
+        content = os.urandom(100000)
+        self.uploader.upload_chunk_size = 4096
+        self.server.fail_next = 1
+        self._upload(content, digests={'md5': '0' * 32})
+
+        self.assertEqual(len(self.server.requests), 2)
+        first, retry = [r[2] for r in self.server.requests]
+        # the whole body was sent again
+        self.assertEqual(first, retry)
+        self.assertIn(b'name="json_data"', retry)
+        self.assertIn(b'filename="reads.fastq.gz"', retry)
+        self.assertIn(b'\r\n\r\n' + content + b'\r\n--', retry)
+
+    def test_upload_checksums_calculated_while_sending(self):
+        content = os.urandom(100000)
+        md5 = hashlib.md5(content).hexdigest()
+        self.uploader.upload_chunk_size = 4096
+        # the retry hashes the file again from the start
+        self.server.fail_next = 1
+        self._upload(content)
+
+        self.assertEqual(len(self.server.requests), 2)
+        body = self.server.requests[-1][2]
+        # json_data follows the file, with the checksum
+        self.assertLess(body.index(b'name="attached_file"'),
+                        body.index(b'name="json_data"'))
+        self.assertEqual(self._json_data(body)['md5sum'], md5)
+
+    def test_upload_checksums_patched_after_sending(self):
+        content = os.urandom(100000)
+        self.uploader.streamed_checksums = 'patch'
+        self._upload(content)
+
+        (post, post_path, body), (patch, patch_path, patch_body) = \
+            self.server.requests
+        self.assertEqual((post, patch), ('POST', 'PATCH'))
+        self.assertEqual(self._json_data(body)['md5sum'], '__pending__')
+        self.assertEqual(patch_path, '/api/v1/dataset_file/1/')
+        self.assertEqual(json.loads(patch_body.decode('utf-8')),
+                         {'md5sum': hashlib.md5(content).hexdigest()})
+
+    def test_upload_checksums_patched_after_sending_readable_body(self):
+        # as sent by Python 2, where httplib reads the body
+        content = os.urandom(100000)
+        self.uploader.streamed_checksums = 'patch'
+        self.uploader.upload_chunk_size = 4096
+        readable = mytardis_uploader.READABLE_UPLOAD_BODIES
+        mytardis_uploader.READABLE_UPLOAD_BODIES = True
+        try:
+            self._upload(content)
+        finally:
+            mytardis_uploader.READABLE_UPLOAD_BODIES = readable
+
+        (post, _, body), (patch, patch_path, patch_body) = \
+            self.server.requests
+        self.assertEqual((post, patch), ('POST', 'PATCH'))
+        self.assertIn(b'\r\n\r\n' + content + b'\r\n--', body)
+        self.assertEqual(patch_path, '/api/v1/dataset_file/1/')
+        self.assertEqual(json.loads(patch_body.decode('utf-8')),
+                         {'md5sum': hashlib.md5(content).hexdigest()})
+
+    def test_set_datafile_digests(self):
+        self.uploader.set_datafile_digests('/api/v1/dataset_file/42/',
+                                           {'md5': 'abc', 'sha512': 'def'})
+
+        method, request_path, body = self.server.requests[-1]
+        self.assertEqual(method, 'PATCH')
+        self.assertEqual(request_path, '/api/v1/dataset_file/42/')
+        self.assertEqual(json.loads(body.decode('utf-8')),
+                         {'md5sum': 'abc', 'sha512sum': 'def'})
+
+
+if __name__ == '__main__':
+    unittest.main()
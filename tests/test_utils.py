@@ -0,0 +1,408 @@
+import os
+import time
+import shutil
+import hashlib
+import tempfile
+import unittest
+from os import path
+from mytardis_ngs_ingestor.utils.parallel import imap_ordered
+from mytardis_ngs_ingestor.utils import checksums
+from mytardis_ngs_ingestor.utils.file_cache import FileMetadataCache
+from mytardis_ngs_ingestor.utils.journal import IngestJournal
+from mytardis_ngs_ingestor.utils.checksum_sidecars import ChecksumSidecars
+from mytardis_ngs_ingestor.utils.lookup_cache import LookupCache
+from mytardis_ngs_ingestor.utils.multipart import MultipartFileBody
+
+
+class ImapOrderedTestCase(unittest.TestCase):
+    def setUp(self):
+        pass
+
+    def tearDown(self):
+        pass
+
+    def test_imap_ordered_preserves_order(self):
+        def slow_square(x):
+            # later items finish first
+            time.sleep((10 - x) * 0.001)
+            return x * x
+
+        for threads in [1, 4]:
+            results = list(imap_ordered(slow_square, range(10),
+                                        threads=threads))
+            self.assertEqual(results, [(x, x * x) for x in range(10)])
+
+    def test_imap_ordered_fails_fast(self):
+        processed = []
+
+        def fail_on_three(x):
+            if x == 3:
+                raise ValueError("Bad item")
+            processed.append(x)
+            return x
+
+        with self.assertRaises(ValueError):
+            for _ in imap_ordered(fail_on_three, range(1000),
+                                  threads=2, window=4):
+                pass
+
+        # items beyond the submission window are never started
+        self.assertLess(len(processed), 10)
+
+    def test_imap_ordered_fails_fast_behind_slow_item(self):
+        processed = []
+
+        def fail_on_one(x):
+            if x == 0:
+                time.sleep(0.2)
+            if x == 1:
+                raise ValueError("Bad item")
+            processed.append(x)
+            return x
+
+        def items():
+            for x in range(1000):
+                if x > 1:
+                    # item 1 has failed before any more are submitted
+                    time.sleep(0.02)
+                yield x
+
+        with self.assertRaises(ValueError):
+            for _ in imap_ordered(fail_on_one, items(),
+                                  threads=2, window=4):
+                pass
+
+        # nothing more is submitted once item 1 fails, even though it isn't
+        # the item being waited for
+        self.assertEqual(processed, [0])
+
+
+class ChecksumsTestCase(unittest.TestCase):
+    def setUp(self):
+        self.fastqc_zip = path.join(
+            path.dirname(__file__),
+            'test_data/fastqc/Q1N_S7_L004_R1_001_fastqc.zip')
+        self.samplesheet = path.join(
+            path.dirname(__file__),
+            'test_data/runs/130907_DMO177_0001_AH9PJLADXZ/SampleSheet.csv')
+
+    def tearDown(self):
+        pass
+
+    def _expected_md5(self, file_path):
+        with open(file_path, 'rb') as f:
+            return hashlib.md5(f.read()).hexdigest()
+
+    def test_md5_file(self):
+        # a blocksize smaller than the file exercises the buffer reuse
+        for blocksize in [100, checksums.DEFAULT_BLOCKSIZE]:
+            self.assertEqual(checksums.md5_file(self.fastqc_zip,
+                                                blocksize=blocksize),
+                             self._expected_md5(self.fastqc_zip))
+
+    def test_digest_file(self):
+        with open(self.fastqc_zip, 'rb') as f:
+            data = f.read()
+        expected = {'md5': hashlib.md5(data).hexdigest(),
+                    'sha512': hashlib.sha512(data).hexdigest()}
+        self.assertEqual(checksums.digest_file(self.fastqc_zip,
+                                               ['md5', 'sha512'],
+                                               blocksize=100),
+                         expected)
+        self.assertEqual(checksums.datafile_digest_fields(expected),
+                         {'md5sum': expected['md5'],
+                          'sha512sum': expected['sha512']})
+        with self.assertRaises(ValueError):
+            checksums.new_hash('not_a_digest')
+
+    def test_md5_files(self):
+        file_paths = [self.fastqc_zip, self.samplesheet]
+        expected = [(p, self._expected_md5(p)) for p in file_paths]
+        self.assertEqual(checksums.md5_files(file_paths), expected)
+        self.assertEqual(checksums.md5_files(file_paths, processes=2),
+                         expected)
+
+
+class FileMetadataCacheTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.cache_dir = path.join(self.tmp_dir, 'cache')
+        self.data_file = path.join(self.tmp_dir, 'reads.fastq.gz')
+        with open(self.data_file, 'wb') as f:
+            f.write(b'not really a fastq')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_get_put(self):
+        cache = FileMetadataCache(self.cache_dir)
+        self.assertIsNone(cache.get(self.data_file))
+        cache.put(self.data_file, {'md5sum': 'abc'})
+        self.assertEqual(cache.get(self.data_file), {'md5sum': 'abc'})
+        cache.close()
+
+        # entries persist between instances
+        cache = FileMetadataCache(self.cache_dir)
+        self.assertEqual(cache.get(self.data_file), {'md5sum': 'abc'})
+
+        # modifying the file makes the entry stale
+        with open(self.data_file, 'ab') as f:
+            f.write(b' at all')
+        self.assertIsNone(cache.get(self.data_file))
+        self.assertEqual(len(cache), 0)
+        cache.close()
+
+    def test_invalidate_and_evict(self):
+        cache = FileMetadataCache(self.cache_dir, max_entries=2)
+        paths = []
+        for i in range(3):
+            p = path.join(self.tmp_dir, 'file%d' % i)
+            with open(p, 'w') as f:
+                f.write(str(i))
+            paths.append(p)
+            cache.put(p, {'i': i})
+            time.sleep(0.01)
+
+        # the least recently used entry was evicted
+        self.assertIsNone(cache.get(paths[0]))
+        self.assertEqual(cache.get(paths[2]), {'i': 2})
+
+        cache.invalidate(paths[2])
+        self.assertIsNone(cache.get(paths[2]))
+        cache.invalidate()
+        self.assertEqual(len(cache), 0)
+        cache.close()
+
+
+class IngestJournalTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.journal_path = path.join(self.tmp_dir, 'journals', 'run.journal')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_resume(self):
+        journal = IngestJournal(self.journal_path)
+        journal.record('run_experiment', '/api/v1/experiment/1/')
+        journal.record('project_experiment', '/api/v1/experiment/2/',
+                       name='Project_A')
+        journal.record('fastq_datafile', '/api/v1/dataset_file/3/',
+                       name='/data/A_R1.fastq.gz')
+        journal.close()
+
+        # simulate a crash part way through writing an entry
+        with open(self.journal_path, 'a') as f:
+            f.write('{"step": "fastq_data')
+
+        journal = IngestJournal(self.journal_path, resume=True)
+        self.assertEqual(journal.get('run_experiment'),
+                         '/api/v1/experiment/1/')
+        self.assertEqual(journal.values('project_experiment'),
+                         ['/api/v1/experiment/2/'])
+        self.assertTrue(journal.is_complete('fastq_datafile',
+                                            name='/data/A_R1.fastq.gz'))
+        self.assertFalse(journal.is_complete('fastq_datafile',
+                                             name='/data/A_R2.fastq.gz'))
+        journal.record('fastq_datafile', '/api/v1/dataset_file/4/',
+                       name='/data/A_R2.fastq.gz')
+        journal.close()
+
+        journal = IngestJournal(self.journal_path, resume=True)
+        self.assertEqual(journal.get('fastq_datafile',
+                                     name='/data/A_R2.fastq.gz'),
+                         '/api/v1/dataset_file/4/')
+        journal.remove()
+        self.assertFalse(path.exists(self.journal_path))
+
+    def test_without_resume_starts_again(self):
+        journal = IngestJournal(self.journal_path)
+        journal.record('run_experiment', '/api/v1/experiment/1/')
+        journal.close()
+
+        journal = IngestJournal(self.journal_path)
+        self.assertIsNone(journal.get('run_experiment'))
+        journal.close()
+
+    def test_items(self):
+        journal = IngestJournal(self.journal_path)
+        journal.record('pending_checksum',
+                       {'datafile': '/api/v1/dataset_file/3/'},
+                       name='/data/A_R1.fastq.gz')
+        journal.record('checksum_done', '/api/v1/dataset_file/3/',
+                       name='/data/A_R1.fastq.gz')
+        self.assertEqual(journal.items('pending_checksum'),
+                         [('/data/A_R1.fastq.gz',
+                           {'datafile': '/api/v1/dataset_file/3/'})])
+        journal.close()
+
+
+class ChecksumSidecarsTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.sample_dir = path.join(self.tmp_dir, 'Project_A', 'Sample_1')
+        os.makedirs(self.sample_dir)
+        self.data_files = []
+        for name in ['A_R1.fastq.gz', 'A_R2.fastq.gz']:
+            p = path.join(self.sample_dir, name)
+            with open(p, 'wb') as f:
+                f.write(name.encode('utf-8'))
+            self.data_files.append(p)
+        self.md5s = [self._md5(p) for p in self.data_files]
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def _md5(self, file_path):
+        with open(file_path, 'rb') as f:
+            return hashlib.md5(f.read()).hexdigest()
+
+    def _set_mtime(self, file_path, offset):
+        mtime = path.getmtime(self.data_files[0]) + offset
+        os.utime(file_path, (mtime, mtime))
+
+    def test_sidecars_and_manifests(self):
+        r1, r2 = self.data_files
+        with open(r1 + '.md5', 'w') as f:
+            f.write('%s  A_R1.fastq.gz\n' % self.md5s[0])
+        self._set_mtime(r1 + '.md5', 10)
+        # a manifest in the project directory
+        manifest = path.join(self.tmp_dir, 'Project_A', 'md5sums.txt')
+        with open(manifest, 'w') as f:
+            f.write('%s  Sample_1/A_R2.fastq.gz\n' % self.md5s[1])
+        self._set_mtime(manifest, 10)
+
+        sidecars = ChecksumSidecars(spot_check_fraction=0.0)
+        self.assertEqual(sidecars.get(r1, ['md5']), {'md5': self.md5s[0]})
+        self.assertEqual(sidecars.get(r2, ['md5']), {'md5': self.md5s[1]})
+        self.assertIsNone(sidecars.get(r1, ['md5', 'sha512']))
+
+        # checksums older than the file are stale
+        self._set_mtime(r1 + '.md5', -10)
+        self.assertIsNone(sidecars.get(r1, ['md5']))
+
+    def test_spot_check_mismatch_stops_trust(self):
+        r1, r2 = self.data_files
+        for p in self.data_files:
+            with open(p + '.md5', 'w') as f:
+                f.write('%s\n' % ('0' * 32))
+            self._set_mtime(p + '.md5', 10)
+
+        sidecars = ChecksumSidecars(spot_check_fraction=1.0)
+        self.assertTrue(sidecars.spot_check())
+        expected = sidecars.get(r1, ['md5'])
+        self.assertFalse(sidecars.verify(r1, expected,
+                                         {'md5': self.md5s[0]}))
+        self.assertIsNone(sidecars.get(r2, ['md5']))
+
+
+class LookupCacheTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.cache_path = path.join(self.tmp_dir, 'lookups.json')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_expiry_and_invalidation(self):
+        cache = LookupCache(ttl=0.05)
+        cache.put('group', 'facility', {'id': 7})
+        cache.put('group', 'lab', {'id': 8})
+        cache.put('user', 'bob', {'id': 1})
+        self.assertEqual(cache.get('group', 'facility'), {'id': 7})
+
+        cache.invalidate('group', 'facility')
+        self.assertIsNone(cache.get('group', 'facility'))
+        cache.invalidate('group')
+        self.assertIsNone(cache.get('group', 'lab'))
+        self.assertEqual(cache.get('user', 'bob'), {'id': 1})
+
+        time.sleep(0.06)
+        self.assertIsNone(cache.get('user', 'bob'))
+
+        # a ttl of 0 disables caching
+        cache = LookupCache(ttl=0)
+        cache.put('user', 'bob', {'id': 1})
+        self.assertIsNone(cache.get('user', 'bob'))
+
+    def test_persistence(self):
+        cache = LookupCache(cache_path=self.cache_path,
+                            namespace='http://tardis.example.com')
+        cache.put('instrument', 'HiSeq', {'id': 3})
+        cache.save()
+
+        cache = LookupCache(cache_path=self.cache_path,
+                            namespace='http://tardis.example.com')
+        self.assertEqual(cache.get('instrument', 'HiSeq'), {'id': 3})
+
+        # entries looked up from another server aren't reused
+        cache = LookupCache(cache_path=self.cache_path,
+                            namespace='http://other.example.com')
+        self.assertIsNone(cache.get('instrument', 'HiSeq'))
+
+
+class MultipartFileBodyTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.file_path = path.join(self.tmp_dir, 'reads.fastq.gz')
+        self.content = os.urandom(10000)
+        with open(self.file_path, 'wb') as f:
+            f.write(self.content)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_body(self):
+        body = MultipartFileBody([('json_data', '{"filename": "x"}')],
+                                 'attached_file', self.file_path,
+                                 chunk_size=3000)
+        data = b''.join(bytes(c) for c in body)
+        self.assertEqual(len(data), len(body))
+        self.assertTrue(data.startswith(b'--' + body.boundary.encode()))
+        self.assertIn(b'\r\n\r\n{"filename": "x"}\r\n', data)
+        self.assertIn(b'\r\n\r\n' + self.content + b'\r\n', data)
+        self.assertTrue(data.endswith(b'--%s--\r\n' %
+                                      body.boundary.encode()))
+
+        # sending again starts from the beginning
+        self.assertEqual(b''.join(bytes(c) for c in body), data)
+
+        reader = body.reader()
+        self.assertEqual(reader.read(100), data[:100])
+        reader.rewind()
+        chunks = []
+        while True:
+            chunk = reader.read(777)
+            if not chunk:
+                break
+            chunks.append(chunk)
+        self.assertEqual(b''.join(chunks), data)
+
+    def test_digests_and_trailing_fields(self):
+        body = MultipartFileBody(
+            [], 'attached_file', self.file_path,
+            chunk_size=3000,
+            digests=['md5'],
+            trailing_fields=[('json_data',
+                              lambda d: '{"md5sum": "%s"}' % d['md5'])])
+        md5 = hashlib.md5(self.content).hexdigest()
+        for _ in range(2):
+            data = b''.join(bytes(c) for c in body)
+            self.assertEqual(len(data), len(body))
+            self.assertEqual(body.hexdigests, {'md5': md5})
+            self.assertIn(self.content + b'\r\n--' + body.boundary.encode(),
+                          data)
+            self.assertTrue(data.endswith(
+                ('\r\n\r\n{"md5sum": "%s"}\r\n--%s--\r\n' %
+                 (md5, body.boundary)).encode()))
+
+    def test_empty_file(self):
+        open(self.file_path, 'wb').close()
+        body = MultipartFileBody([], 'attached_file', self.file_path)
+        data = b''.join(bytes(c) for c in body)
+        self.assertEqual(len(data), len(body))
+        self.assertIn(b'\r\n\r\n\r\n--', data)
+
+
+if __name__ == '__main__':
+    unittest.main()